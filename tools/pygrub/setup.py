@@ -23,7 +23,7 @@ setup(name='pygrub',
       author_email='katzj@redhat.com',
       license='GPL',
       package_dir={'grub': 'src', 'fsimage': 'src'},
-      scripts = ["src/pygrub"],
+      scripts = ["src/pygrub", "src/pygrub-client"],
       packages=pkgs,
       ext_modules = [ fsimage ]
       )
@@ -0,0 +1,582 @@
+#! /usr/bin/env python
+#
+# tests.py - unit tests for pygrub
+#
+# This software may be freely redistributed under the terms of the GNU
+# general public license.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; If not, see <http://www.gnu.org/licenses/>.
+#
+# Needs the fsimage module and the grub package on the path, as built by
+# 'make test'.
+#
+
+import errno
+import hashlib
+import imp
+import os
+import shutil
+import signal
+import socket
+import stat
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+
+SRC = os.path.join(os.path.dirname(os.path.abspath(__file__)), "src")
+
+pygrub = imp.load_source("pygrub", os.path.join(SRC, "pygrub"))
+client = imp.load_source("pygrub_client", os.path.join(SRC, "pygrub-client"))
+
+LINUX = "0FC63DAF-8483-4772-8E79-3D69D8477DE4"
+SWAP = "0657FD6D-A4AB-43C4-84E5-0933C84B4F4F"
+BIOS_BOOT = "21686148-6449-6E6F-744E-656564454649"
+
+def guid(text):
+    """The on disk form of a GUID, as gpt_type_guid reads it."""
+    fields = text.split("-")
+    return (struct.pack("<LHH", *[int(f, 16) for f in fields[0:3]]) +
+            (fields[3] + fields[4]).decode("hex"))
+
+def mbr(parts):
+    """An MBR of (active, type, start sector) partitions."""
+    buf = bytearray(512)
+    for (i, (active, type, start)) in enumerate(parts):
+        entry = 446 + 16 * i
+        buf[entry] = active and 0x80 or 0
+        buf[entry + 4] = type
+        buf[entry + 8:entry + 12] = struct.pack("<L", start)
+    buf[510:512] = "\x55\xaa"
+    return str(buf)
+
+def gpt(parts, entrylba = 2, count = 128, size = 128):
+    """A protective MBR and a GPT of (type, start sector) partitions, its
+    header giving an entry array at entrylba of count entries of size
+    bytes.  For corrupt headers to be made, the entries are laid out 128
+    bytes apart whatever the header says, and right after it when
+    entrylba is out of reach."""
+    header = bytearray(512)
+    header[0:8] = "EFI PART"
+    header[72:88] = struct.pack("<QLL", entrylba, count, size)
+    stride = max(size, 128)
+    entries = bytearray(max(len(parts), 1) * stride)
+    for (i, (type, start)) in enumerate(parts):
+        entries[i * stride:i * stride + 16] = guid(type)
+        entries[i * stride + 32:i * stride + 40] = struct.pack("<Q", start)
+    return (mbr([(False, 0xee, 1)]) + str(header) +
+            "\0" * (2 <= entrylba < 1024 and entrylba - 2 or 0) * 512 +
+            str(entries) + "\0" * 4096)
+
+class TestPartitions(unittest.TestCase):
+
+    def setUp(self):
+        self.image = tempfile.NamedTemporaryFile()
+
+    def offsets(self, data):
+        self.image.seek(0)
+        self.image.truncate()
+        self.image.write(data)
+        self.image.flush()
+        return pygrub.get_partition_offsets(self.image.name)
+
+    def test_raw(self):
+        self.assertEqual(self.offsets("\0" * 4096), [0])
+
+    def test_mbr(self):
+        # the active partition first, then in order
+        self.assertEqual(self.offsets(mbr([(False, 0x83, 2048),
+                                           (True, 0x83, 4096),
+                                           (False, 0x83, 0),
+                                           (False, 0x83, 8192)])),
+                         [4096 * 512, 2048 * 512, 8192 * 512])
+        # a boot sector with no partitions is a filesystem
+        self.assertEqual(self.offsets(mbr([])), [0])
+
+    def test_gpt(self):
+        self.assertEqual(self.offsets(gpt([(BIOS_BOOT, 34), (LINUX, 2048),
+                                           (SWAP, 4096), (LINUX, 8192)])),
+                         [2048 * 512, 8192 * 512])
+        self.assertEqual(self.offsets(gpt([(LINUX, 2048), (LINUX, 4096)],
+                                          size = 256, count = 2)),
+                         [2048 * 512, 4096 * 512])
+
+        # entries beyond the start of the disk read in one go
+        self.assertEqual(self.offsets(gpt([(LINUX, 2048)], entrylba = 300)),
+                         [2048 * 512])
+
+    def test_gpt_corrupt(self):
+        # entries too small or misaligned, too many of them, and at the
+        # start of the disk or far beyond its end: nothing to boot from
+        for header in ({"size": 0}, {"size": 64}, {"size": 132},
+                       {"count": 0xffffffff}, {"count": 8, "size": 1 << 20},
+                       {"entrylba": 0}, {"entrylba": 1},
+                       {"entrylba": 1 << 60}):
+            self.assertEqual(self.offsets(gpt([(LINUX, 2048)], **header)),
+                             [0])
+
+class FakeFile(object):
+
+    def __init__(self, data):
+        self.data = data
+
+    def read(self, size, offset = 0):
+        return self.data[offset:offset + size]
+
+class FakeFS(object):
+    """A filesystem holding a grub config, or nothing: config is whether
+    there is one, or what it says."""
+
+    def __init__(self, config):
+        self.config = config
+
+    def file_exists(self, path):
+        return bool(self.config) and path == "/boot/grub/grub.cfg"
+
+    def open_file(self, path):
+        if not self.file_exists(path):
+            raise IOError("%s not found" % path)
+        return FakeFile(self.config)
+
+class FakeFsimage(object):
+    """Opens filesystems after a delay, by partition offset: partitions
+    maps each offset to (seconds to open it, whether it has a config)."""
+
+    def __init__(self, partitions):
+        self.partitions = partitions
+
+    def open(self, file, offset, options = ""):
+        (delay, config) = self.partitions[offset]
+        time.sleep(delay)
+        if config is None:
+            raise IOError("no filesystem at %d" % offset)
+        return FakeFS(config)
+
+class TestProbePartitions(unittest.TestCase):
+
+    def setUp(self):
+        self.fsimage = pygrub.fsimage
+
+    def tearDown(self):
+        pygrub.fsimage = self.fsimage
+
+    def probe(self, partitions, order, jobs = 4):
+        pygrub.fsimage = FakeFsimage(partitions)
+        return pygrub.probe_partitions(os.devnull, order, "", jobs)
+
+    def test_priority(self):
+        # the first partition, say the active one, wins over a later one
+        # answering first
+        self.assertEqual(self.probe({1: (0.3, True), 2: (0, True)}, [1, 2]),
+                         [1, 2])
+        # unless it can't boot
+        self.assertEqual(self.probe({1: (0.3, False), 2: (0, True)}, [1, 2]),
+                         [2])
+        self.assertEqual(self.probe({1: (0.3, None), 2: (0, True)}, [1, 2]),
+                         [2])
+        self.assertEqual(self.probe({1: (0, False), 2: (0, None)}, [1, 2]),
+                         [])
+
+    def test_kill(self):
+        # the rest are not waited for once the winner is known
+        start = time.time()
+        self.assertEqual(self.probe({1: (0, False), 2: (0.1, True),
+                                     3: (30, True)}, [1, 2, 3]), [2, 3])
+        self.assertTrue(time.time() - start < 10)
+
+    def test_jobs(self):
+        # two at a time, the third started as the first is done
+        start = time.time()
+        self.assertEqual(self.probe({1: (0.2, False), 2: (0.4, False),
+                                     3: (0.3, True)}, [1, 2, 3], jobs = 2),
+                         [3])
+        self.assertTrue(time.time() - start >= 0.5)
+
+    def test_other_children(self):
+        # children of the caller are left for it to wait for
+        sys.stdout.flush()
+        sys.stderr.flush()
+        pid = os.fork()
+        if pid == 0:
+            os._exit(7)
+        time.sleep(0.1)
+        self.assertEqual(self.probe({1: (0.2, True), 2: (0.1, True)},
+                                    [1, 2]), [1, 2])
+        (pid, status) = os.waitpid(pid, 0)
+        self.assertEqual(os.WEXITSTATUS(status), 7)
+
+class FakeGrub(object):
+    """What the probe cache keeps of a Grub."""
+
+    def __init__(self, filename, config):
+        self.cf = pygrub.grub.GrubConf.Grub2ConfigFile()
+        self.cf.filename = filename
+        self.cf_digest = hashlib.sha256(config).hexdigest()
+
+class TestProbeCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.cache = pygrub.ProbeCache(os.path.join(self.tmpdir, "probes"))
+        self.image = os.path.join(self.tmpdir, "image")
+        open(self.image, "wb").write("\0" * 4096)
+        self.config = ("set default=0\n"
+                       "menuentry 'Linux' {\n"
+                       "\tlinux /vmlinuz root=/dev/xvda1\n"
+                       "\tinitrd /initrd.img\n"
+                       "}\n"
+                       "menuentry 'Linux, rescue' {\n"
+                       "\tlinux /vmlinuz root=/dev/xvda1 single\n"
+                       "}\n")
+        self.fsimage = pygrub.fsimage
+        self.entries = pygrub.PROBE_CACHE_ENTRIES
+
+    def tearDown(self):
+        pygrub.fsimage = self.fsimage
+        pygrub.PROBE_CACHE_ENTRIES = self.entries
+        shutil.rmtree(self.tmpdir)
+
+    def key(self, image):
+        probe = pygrub.DiskProbe(image)
+        try:
+            return self.cache.key(probe)
+        finally:
+            probe.close()
+
+    def test_key(self):
+        key = self.key(self.image)
+        self.assertEqual(len(key), 64)
+        self.assertEqual(self.key(self.image), key)
+
+        others = []
+        os.utime(self.image, (0, 0))
+        others.append(self.key(self.image))
+        open(self.image, "r+b").write("\1")
+        os.utime(self.image, (0, 0))
+        others.append(self.key(self.image))
+        pygrub.PROBE_CACHE_VERSION += 1
+        try:
+            others.append(self.key(self.image))
+        finally:
+            pygrub.PROBE_CACHE_VERSION -= 1
+        self.assertEqual(len(set(others + [key])), 4)
+
+        # block devices may change unnoticed, so are not cached
+        self.assertEqual(self.key(os.devnull), None)
+
+    def test_lookup(self):
+        key = self.key(self.image)
+        self.assertEqual(self.cache.lookup(key), None)
+
+        grub = FakeGrub("/boot/grub2/grub.cfg", self.config)
+        self.cache.store(key, 1048576, grub)
+        self.assertEqual(self.cache.lookup(key),
+                         (1048576, "/boot/grub2/grub.cfg", grub.cf_digest))
+
+        # entries of other versions, or cut short, are ignored
+        for data in ("\x80\x02(K\x01tq\x01.",
+                     "1048576\n/boot/grub2/grub.cfg\n", ""):
+            open(os.path.join(self.cache.directory, key), "w").write(data)
+            self.assertEqual(self.cache.lookup(key), None)
+
+    def test_prune(self):
+        pygrub.PROBE_CACHE_ENTRIES = 3
+        grub = FakeGrub("/boot/grub/grub.cfg", "")
+        for n in range(5):
+            self.cache.store("k%d" % n, 0, grub)
+            os.utime(os.path.join(self.cache.directory, "k%d" % n),
+                     (1000 + n, 1000 + n))
+        self.cache.store("k5", 0, grub)
+        self.assertEqual(sorted(os.listdir(self.cache.directory)),
+                         ["k3", "k4", "k5"])
+
+    def test_open_config(self):
+        key = self.key(self.image)
+        grub = FakeGrub("/boot/grub/grub.cfg", self.config)
+        self.cache.store(key, 512, grub)
+
+        pygrub.fsimage = FakeFsimage({512: (0, self.config)})
+        (offset, fs, cf) = self.cache.open_config(key, self.image, [0, 512],
+                                                  "")
+        self.assertEqual(offset, 512)
+        self.assertEqual(cf.filename, "/boot/grub/grub.cfg")
+        self.assertEqual([i.title for i in cf.images],
+                         ["Linux", "Linux, rescue"])
+
+        # not if the partition went away, or the config changed
+        self.assertEqual(self.cache.open_config(key, self.image, [0], ""),
+                         None)
+        pygrub.fsimage = FakeFsimage({512: (0, self.config + "\n")})
+        self.assertEqual(self.cache.open_config(key, self.image, [512], ""),
+                         None)
+
+    def test_not_really(self):
+        # a -n run leaves no cache behind
+        cache = os.path.join(self.tmpdir, "cache")
+        proc = subprocess.Popen([sys.executable, os.path.join(SRC, "pygrub"),
+                                 "-q", "-n", "--cache-directory=%s" % cache,
+                                 "--output-directory=%s" % self.tmpdir,
+                                 self.image],
+                                stdout = subprocess.PIPE,
+                                stderr = subprocess.PIPE)
+        proc.communicate()
+        self.assertFalse(os.path.exists(cache))
+
+class TestExtractCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.cache = pygrub.ExtractCache(os.path.join(self.tmpdir, "cache"),
+                                         3 * 4096)
+        self.link = os.link
+
+    def tearDown(self):
+        os.link = self.link
+        shutil.rmtree(self.tmpdir)
+
+    def path(self, name, data = None):
+        path = os.path.join(self.tmpdir, name)
+        if data is not None:
+            open(path, "wb").write(data)
+        return path
+
+    def extract(self, key, data, name = "extracted"):
+        """Store data as extracted under key, as copy_from_image does."""
+        path = self.path(name, data)
+        digest = hashlib.sha256(data).hexdigest()
+        self.cache.store(key, digest, path)
+        os.unlink(path)
+        return digest
+
+    def test_key(self):
+        image = self.path("image", "\0" * 4096)
+        key = self.cache.key(image, 0, "/boot/vmlinuz")
+        self.assertEqual(len(key), 64)
+        self.assertEqual(self.cache.key(image, 0, "/boot/vmlinuz"), key)
+
+        others = [self.cache.key(image, 512, "/boot/vmlinuz"),
+                  self.cache.key(image, 0, "/boot/initrd")]
+        os.utime(image, (0, 0))
+        others.append(self.cache.key(image, 0, "/boot/vmlinuz"))
+        open(image, "ab").write("\0")
+        others.append(self.cache.key(image, 0, "/boot/vmlinuz"))
+        self.assertEqual(len(set(others + [key])), 5)
+
+        # block devices and the like are not indexed
+        self.assertEqual(self.cache.key(os.devnull, 0, "/boot/vmlinuz"), None)
+
+    def test_lookup(self):
+        output = self.path("output", "")
+        self.assertFalse(self.cache.lookup("0" * 64, output))
+        self.assertFalse(self.cache.lookup(None, output))
+
+        digest = self.extract("k1", "kernel")
+        self.assertTrue(os.path.exists(
+            os.path.join(self.cache.objects, digest)))
+        self.assertTrue(self.cache.lookup("k1", output))
+        self.assertEqual(open(output).read(), "kernel")
+        self.assertEqual(sorted(os.listdir(self.tmpdir)), ["cache", "output"])
+
+        # files from images that are not indexed still share objects
+        self.extract(None, "kernel")
+        self.assertEqual(os.listdir(self.cache.objects), [digest])
+
+    def test_evict(self):
+        digests = []
+        for n in range(3):
+            digests.append(self.extract("k%d" % n, chr(n) * 4096))
+            os.utime(os.path.join(self.cache.objects, digests[n]),
+                     (1000 + n, 1000 + n))
+
+        # using the oldest makes it the most recently used
+        self.assertTrue(self.cache.lookup("k0", self.path("output", "")))
+        self.extract("k3", "\3" * 4096)
+
+        self.assertEqual(sorted(os.listdir(self.cache.objects)),
+                         sorted([digests[0], digests[2],
+                                 hashlib.sha256("\3" * 4096).hexdigest()]))
+        self.assertEqual(sorted(os.listdir(self.cache.index)),
+                         ["k0", "k2", "k3"])
+        self.assertFalse(self.cache.lookup("k1", self.path("output")))
+
+    def test_copy(self):
+        # the cache on another filesystem than the output directory
+        def link(src, dst):
+            raise OSError(errno.EXDEV, os.strerror(errno.EXDEV))
+        os.link = link
+
+        src = self.path("src", "data" * 100000)
+        dst = self.path("dst")
+        pygrub.link_or_copy(src, dst)
+        self.assertEqual(open(dst).read(), "data" * 100000)
+        self.assertNotEqual(os.stat(src).st_ino, os.stat(dst).st_ino)
+        self.assertEqual(os.stat(dst).st_mode & 0777, 0600)
+
+        # and other failures are not hidden
+        os.link = self.link
+        self.assertRaises(OSError, pygrub.link_or_copy, self.path("missing"),
+                          self.path("dst2"))
+
+    def test_link(self):
+        src = self.path("src", "data")
+        dst = self.path("dst")
+        pygrub.link_or_copy(src, dst)
+        self.assertEqual(os.stat(src).st_ino, os.stat(dst).st_ino)
+
+class TestDaemon(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.socket = os.path.join(self.tmpdir, "pygrub.sock")
+        self.timeout = pygrub.REQUEST_TIMEOUT
+        pygrub.REQUEST_TIMEOUT = 0.5
+        self.pid = self.start(self.socket)
+        self.connect().close()
+
+    def tearDown(self):
+        os.kill(self.pid, signal.SIGTERM)
+        os.waitpid(self.pid, 0)
+        pygrub.REQUEST_TIMEOUT = self.timeout
+        shutil.rmtree(self.tmpdir)
+
+    # fork a daemon on path; the runs it forks for requests report what
+    # they were asked for rather than going on as pygrub
+    def start(self, path):
+        sys.stdout.flush()
+        sys.stderr.flush()
+        pid = os.fork()
+        if pid == 0:
+            try:
+                pygrub.serve(path)
+                # to the descriptors of the request, whatever unittest
+                # did to sys.stdout
+                os.write(1, "%s\n%s\n" % (os.getcwd(), " ".join(sys.argv[1:])))
+                os.write(2, "error output\n")
+                os._exit(int(sys.argv[-1]))
+            except SystemExit:
+                os._exit(3)
+            finally:
+                os._exit(127)
+        return pid
+
+    # the exit status of the daemon pid, if it exits within a few seconds
+    def wait(self, pid):
+        for i in range(500):
+            (done, status) = os.waitpid(pid, os.WNOHANG)
+            if done:
+                return os.WEXITSTATUS(status)
+            time.sleep(0.01)
+        os.kill(pid, signal.SIGTERM)
+        os.waitpid(pid, 0)
+        self.fail("daemon %d still running" % pid)
+
+    # a connection to the daemon on path, once it listens
+    def connect(self, path = None):
+        for i in range(100):
+            conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                conn.connect(path or self.socket)
+                return conn
+            except socket.error:
+                conn.close()
+                time.sleep(0.01)
+        self.fail("no daemon on %s" % (path or self.socket))
+
+    def request(self, args, path = None):
+        conn = self.connect(path)
+        request = "\0".join(args)
+        conn.sendall("%d\n" % len(request) + request)
+        (status, outlen, errlen) = [int(n) for n in
+                                    pygrub.recv_line(conn).split()]
+        out = pygrub.recv_exactly(conn, outlen)
+        err = pygrub.recv_exactly(conn, errlen)
+        self.assertEqual(conn.recv(1), "")
+        conn.close()
+        return (status, out, err)
+
+    def test_socket_mode(self):
+        self.assertEqual(stat.S_IMODE(os.stat(self.socket).st_mode) & 077, 0)
+
+    def test_request(self):
+        self.assertEqual(self.request([self.tmpdir, "-q", "disk img", "3"]),
+                         (3, "%s\n-q disk img 3\n" % self.tmpdir,
+                          "error output\n"))
+
+    def test_bad_directory(self):
+        missing = os.path.join(self.tmpdir, "missing")
+        (status, out, err) = self.request([missing, "-q", "disk", "0"])
+        self.assertEqual((status, out), (1, ""))
+        self.assertTrue(err.startswith("pygrub: %s: " % missing))
+
+        # the daemon is still there for the next one
+        self.assertEqual(self.request(["/", "0"])[0], 0)
+
+    def test_stalled_request(self):
+        # a client that never sends its request is given up on
+        conn = self.connect()
+        conn.settimeout(5)
+        conn.sendall("12\n/")
+        self.assertEqual(conn.recv(1), "")
+        conn.close()
+
+        self.assertEqual(self.request(["/", "0"])[0], 0)
+
+    def test_running_daemon(self):
+        # a second daemon leaves the socket to the first
+        self.assertEqual(self.wait(self.start(self.socket)), 3)
+        self.assertEqual(self.request(["/", "0"])[0], 0)
+
+    def test_stale_socket(self):
+        # but takes over that of one no longer running
+        path = os.path.join(self.tmpdir, "stale.sock")
+        stale = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        stale.bind(path)
+        stale.close()
+
+        pid = self.start(path)
+        try:
+            self.assertEqual(self.request(["/", "4"], path)[0], 4)
+        finally:
+            os.kill(pid, signal.SIGTERM)
+            os.waitpid(pid, 0)
+
+    def test_client(self):
+        env = dict(os.environ)
+        env["PYGRUB_SOCKET"] = self.socket
+        proc = subprocess.Popen([sys.executable,
+                                 os.path.join(SRC, "pygrub-client"),
+                                 "-q", "--output=x", "disk", "5"],
+                                cwd = self.tmpdir, env = env,
+                                stdout = subprocess.PIPE,
+                                stderr = subprocess.PIPE)
+        (out, err) = proc.communicate()
+        self.assertEqual(proc.returncode, 5)
+        self.assertEqual(out, "%s\n-q --output=x disk 5\n" %
+                         os.path.realpath(self.tmpdir))
+        self.assertEqual(err, "error output\n")
+
+    def test_interactive(self):
+        self.assertTrue(client.interactive(["disk"]))
+        self.assertTrue(client.interactive(["-q", "-i", "disk"]))
+        self.assertFalse(client.interactive(["-q", "disk"]))
+        self.assertFalse(client.interactive(["-nq", "disk"]))
+        self.assertFalse(client.interactive(["--entry=1", "disk"]))
+        self.assertFalse(client.interactive(["-i", "--quiet", "disk"]))
+
+
+def test_suite():
+    suite = unittest.TestSuite()
+
+    suite.addTest(unittest.makeSuite(TestPartitions))
+    suite.addTest(unittest.makeSuite(TestProbePartitions))
+    suite.addTest(unittest.makeSuite(TestProbeCache))
+    suite.addTest(unittest.makeSuite(TestExtractCache))
+    suite.addTest(unittest.makeSuite(TestDaemon))
+
+    return suite
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,925 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Conversion of legacy migration streams to v2 streams.
+
+All state of a conversion is held in a Converter object, so several
+streams may be converted in one process, concurrently if desired.
+"""
+
+import os
+import json
+import stat
+import time
+
+from array import array
+from struct import calcsize, unpack, pack
+
+from xen.migration import legacy, public, libxc, libxl, xl
+
+__version__ = 1
+
+# Typed array codes able to hold a legacy pfn, keyed on toolstack bitness.
+# 'L' is only 64 bits wide on LP64 hosts; elsewhere unpack_ulongs() is used.
+pfn_array_types = dict((array(c).itemsize * 8, c) for c in "LI")
+
+class StreamError(StandardError):
+    """Error with the incoming migration stream"""
+    pass
+
+class VM(object):
+    """Container of VM parameters"""
+
+    def __init__(self, fmt):
+        # Common
+        self.p2m_size = 0
+
+        # PV
+        self.max_vcpu_id = 0
+        self.online_vcpu_map = []
+        self.width = 0
+        self.levels = 0
+        self.basic_len = 0
+        self.extd = False
+        self.xsave_len = 0
+
+        # libxl
+        self.libxl = fmt == "libxl"
+        # NUL terminated key&val pairs from "toolstack" records
+        self.emu_xenstore = ""
+
+        # HVM
+        self.hvm_params = []   # Params collected from the chunks so far
+
+    def checkpoint(self):
+        """Serialise the conversion state into a json-friendly dictionary"""
+        state = dict(self.__dict__)
+        state["emu_xenstore"] = self.emu_xenstore.encode("hex")
+        return state
+
+    def restore(self, state):
+        """Restore conversion state from a checkpoint() dictionary"""
+        for key, val in state.iteritems():
+            if not hasattr(self, key):
+                raise StreamError("Unexpected VM state '%s' in journal"
+                                  % (key, ))
+            setattr(self, str(key), val)
+        self.emu_xenstore = str(self.emu_xenstore).decode("hex")
+
+class Progress(object):
+    """Rate limited reporting of conversion progress"""
+
+    def __init__(self, interval, total = None, log = None, status_file = None):
+        self.interval = interval         # Minimum seconds between reports
+        self.total = total               # Size of the input, or None
+        self.log = log                   # Function to report through, or None
+        self.status_file = status_file   # File to keep json status in, or None
+        self.pages = 0                   # Pages converted
+
+        self.start = self.last = time.time()
+        self.start_offset = 0
+
+    def begin(self, conv):
+        """Start timing a conversion, which may be resuming part way in"""
+        self.start = self.last = time.time()
+        self.start_offset = conv.in_offset
+
+    def update(self, conv, nr_pages = 0):
+        """Account for converted pages, reporting if the interval is up"""
+        self.pages += nr_pages
+
+        now = time.time()
+        if now - self.last >= self.interval:
+            self.last = now
+            self.report(conv, "running", now)
+
+    def report(self, conv, state, now = None):
+        """Unconditionally report progress"""
+        if now is None:
+            now = time.time()
+
+        in_offset, out_offset = conv.in_offset, conv.out_offset
+
+        elapsed = max(now - self.start, 1e-6)
+        rate = (in_offset - self.start_offset) / elapsed
+
+        eta = None
+        if self.total and rate > 0 and state == "running":
+            eta = max(self.total - in_offset, 0) / rate
+
+        if self.log:
+            msg = "Progress: %.1f" % (in_offset / 1048576.0, )
+            if self.total:
+                msg += "/%.1f MiB in (%d%%)" % (self.total / 1048576.0,
+                                               in_offset * 100 / self.total)
+            else:
+                msg += " MiB in"
+            msg += (", %.1f MiB out, %d pages, %.1f MiB/s"
+                    % (out_offset / 1048576.0, self.pages, rate / 1048576.0))
+            if eta is not None:
+                msg += ", ETA %dm%02ds" % divmod(int(eta), 60)
+            if state != "running":
+                msg += " - %s" % (state, )
+
+            self.log(msg)
+
+        if self.status_file:
+            tmp = self.status_file + ".tmp"
+            with open(tmp, "w") as f:
+                json.dump({ "state": state,
+                            "in_bytes": in_offset,
+                            "in_total": self.total,
+                            "out_bytes": out_offset,
+                            "pages": self.pages,
+                            "elapsed": elapsed,
+                            "rate": rate,
+                            "eta": eta,
+                            }, f)
+            os.rename(tmp, self.status_file)
+
+def filter_pfn_batch(pfns):
+    """
+    Validate a batch of legacy pfns.  XTAB entries are dropped, duplicates
+    are rejected, and the number of pages of data following the batch in the
+    stream is counted.  Returns (pfns, nr_pages).
+
+    This is on the path of every page in the stream, so is a single loop
+    over the batch, which is only filtered again if it holds XTAB entries.
+    """
+    seen = set()
+    see = seen.add
+    mask, broken = legacy.PFINFO_LTAB_MASK, legacy.PFINFO_BROKEN
+    nr_pages = 0
+
+    for pfn in pfns:
+        see(pfn)
+        nr_pages += (pfn & mask) < broken
+
+    # xc_domain_save() leaves many XEN_DOMCTL_PFINFO_XTAB records for
+    # sequences of pfns it cant map.  Drop these.
+    if legacy.PFINFO_XTAB in seen:
+        seen.discard(legacy.PFINFO_XTAB)
+        pfns = [ x for x in pfns if x != legacy.PFINFO_XTAB ]
+
+    if len(seen) != len(pfns):
+        seen = set()
+        for pfn in pfns:
+            if pfn in seen:
+                raise StreamError("Duplicate pfn 0x%x (type 0x%x) in batch"
+                                  % (pfn & ~mask, pfn & mask))
+            seen.add(pfn)
+
+    return pfns, nr_pages
+
+class Converter(object):
+    """
+    Convert a legacy stream read from 'fin' into a v2 stream written to
+    'fout'.  Both are file-like objects, needing only read() and write()
+    respectively, unless journaling, which also needs fileno(), flush(),
+    seek() and truncate().
+    """
+
+    def __init__(self, fin, fout, twidth, pv, fmt = "libxc", xl_header = False,
+                 qemu = True, discard_tmem = False, info = None, err = None,
+                 progress = None, journal = None,
+                 journal_interval = 256 << 20):
+
+        self.fin = fin                   # Input file-like object
+        self.fout = fout                 # Output file-like object
+        self.twidth = twidth             # Legacy toolstack bitness (32 or 64)
+        self.pv = pv                     # Boolean (pv or hvm)
+        self.fmt = fmt                   # Outgoing format (libxc or libxl)
+        self.xl_header = xl_header       # Boolean - xl header in the stream?
+        self.qemu = qemu                 # Boolean - process qemu record?
+        self.discard_tmem = discard_tmem # Boolean - Drop persistent tmem?
+        self.info = info or (lambda msg: None) # Info message routing
+        self.err = err or self.info      # Error message routing
+        self.progress = progress         # Progress reporter, or None
+        self.journal = journal           # Progress journal file name, or None
+        self.journal_interval = journal_interval # Input between checkpoints
+        self.journal_last = 0            # in_offset at the last checkpoint
+
+        self.in_offset = 0               # Bytes consumed from fin
+        self.out_offset = 0              # Bytes written to fout
+        self.vm = VM(fmt)
+
+    def convert(self, resume = False):
+        """
+        Convert the whole stream, or what remains of it after the last
+        journal checkpoint when resuming.  A bad stream raises IOError or
+        StreamError, and an unsupported one RuntimeError.
+        """
+        if self.journal:
+            self.check_journal_files()
+
+        if self.xl_header and not resume:
+            self.skip_xl_header(self.fmt)
+
+        self.read_legacy_stream(self.vm, resume)
+
+    def stream_read(self, _ = None):
+        """Read from the input"""
+        data = self.fin.read(_)
+        self.in_offset += len(data)
+        return data
+
+    def stream_write(self, _):
+        """Write to the output"""
+        self.out_offset += len(_)
+        return self.fout.write(_)
+
+    def write_libxc_ihdr(self):
+        self.stream_write(pack(libxc.IHDR_FORMAT,
+                               libxc.IHDR_MARKER,  # Marker
+                               libxc.IHDR_IDENT,   # Ident
+                               libxc.IHDR_VERSION, # Version
+                               libxc.IHDR_OPT_LE,  # Options
+                               0, 0))              # Reserved
+
+    def write_libxc_dhdr(self):
+        if self.pv:
+            dtype = libxc.DHDR_TYPE_x86_pv
+        else:
+            dtype = libxc.DHDR_TYPE_x86_hvm
+
+        self.stream_write(pack(libxc.DHDR_FORMAT,
+                               dtype,        # Type
+                               12,           # Page size
+                               0,            # Reserved
+                               0,            # Xen major (converted)
+                               __version__)) # Xen minor (converted)
+
+    def write_libxl_hdr(self):
+        self.stream_write(pack(libxl.HDR_FORMAT,
+                               libxl.HDR_IDENT,     # Ident
+                               libxl.HDR_VERSION,   # Version 2
+                               libxl.HDR_OPT_LE |   # Options
+                               libxl.HDR_OPT_LEGACY # Little Endian and Legacy
+                               ))
+
+    def write_record(self, rt, *argl):
+        alldata = ''.join(argl)
+        length = len(alldata)
+
+        record = pack(libxc.RH_FORMAT, rt, length) + alldata
+        plen = (8 - (length & 7)) & 7
+        record += '\x00' * plen
+
+        self.stream_write(record)
+
+    def write_libxc_pv_info(self, vm):
+        self.write_record(libxc.REC_TYPE_x86_pv_info,
+                          pack(libxc.X86_PV_INFO_FORMAT,
+                               vm.width, vm.levels, 0, 0))
+
+    def write_libxc_pv_p2m_frames(self, vm, pfns):
+        self.write_record(libxc.REC_TYPE_x86_pv_p2m_frames,
+                          pack(libxc.X86_PV_P2M_FRAMES_FORMAT,
+                               0, vm.p2m_size - 1),
+                          pack("Q" * len(pfns), *pfns))
+
+    def write_libxc_pv_vcpu_basic(self, vcpu_id, data):
+        self.write_record(libxc.REC_TYPE_x86_pv_vcpu_basic,
+                          pack(libxc.X86_PV_VCPU_HDR_FORMAT, vcpu_id, 0), data)
+
+    def write_libxc_pv_vcpu_extd(self, vcpu_id, data):
+        self.write_record(libxc.REC_TYPE_x86_pv_vcpu_extended,
+                          pack(libxc.X86_PV_VCPU_HDR_FORMAT, vcpu_id, 0), data)
+
+    def write_libxc_pv_vcpu_xsave(self, vcpu_id, data):
+        self.write_record(libxc.REC_TYPE_x86_pv_vcpu_xsave,
+                          pack(libxc.X86_PV_VCPU_HDR_FORMAT, vcpu_id, 0), data)
+
+    def write_page_data(self, pfns, pages):
+        if self.fout is None: # Save copying 1M buffers around for no reason
+            return
+
+        new_pfns = [(((x & 0xf0000000) << 32) | (x & 0x0fffffff))
+                    for x in pfns]
+
+        # Optimise the needless buffer copying in write_record()
+        self.stream_write(pack(libxc.RH_FORMAT,
+                               libxc.REC_TYPE_page_data,
+                               8 + (len(new_pfns) * 8) + len(pages)))
+        self.stream_write(pack(libxc.PAGE_DATA_FORMAT, len(new_pfns), 0))
+        self.stream_write(pack("Q" * len(new_pfns), *new_pfns))
+        self.stream_write(pages)
+
+    def write_libxc_tsc_info(self, mode, khz, nsec, incarn):
+        self.write_record(libxc.REC_TYPE_tsc_info,
+                          pack(libxc.TSC_INFO_FORMAT,
+                               mode, khz, nsec, incarn, 0))
+
+    def write_libxc_hvm_params(self, params):
+        if self.pv:
+            raise StreamError("HVM-only param in PV stream")
+        elif len(params) % 2:
+            raise RuntimeError("Expected even length list of hvm parameters")
+
+        self.write_record(libxc.REC_TYPE_hvm_params,
+                          pack(libxc.HVM_PARAMS_FORMAT, len(params) / 2, 0),
+                          pack("Q" * len(params), *params))
+
+    def write_libxl_end(self):
+        self.write_record(libxl.REC_TYPE_end, "")
+
+    def write_libxl_libxc_context(self):
+        self.write_record(libxl.REC_TYPE_libxc_context, "")
+
+    def write_libxl_emulator_xenstore_data(self, data):
+        self.write_record(libxl.REC_TYPE_emulator_xenstore_data,
+                          pack(libxl.EMULATOR_HEADER_FORMAT,
+                               libxl.EMULATOR_ID_unknown, 0) + data)
+
+    def write_libxl_emulator_context(self, blob):
+        self.write_record(libxl.REC_TYPE_emulator_context,
+                          pack(libxl.EMULATOR_HEADER_FORMAT,
+                               libxl.EMULATOR_ID_unknown, 0) + blob)
+
+    def rdexact(self, nr_bytes):
+        """Read exactly nr_bytes from fin"""
+        _ = self.stream_read(nr_bytes)
+        if len(_) != nr_bytes:
+            raise IOError("Stream truncated")
+        return _
+
+    def unpack_exact(self, fmt):
+        """Unpack a format from fin"""
+        sz = calcsize(fmt)
+        return unpack(fmt, self.rdexact(sz))
+
+    def unpack_ulongs(self, nr_ulongs):
+        if self.twidth == 32:
+            return self.unpack_exact("I" * nr_ulongs)
+        else:
+            return self.unpack_exact("Q" * nr_ulongs)
+
+    def read_pfn_batch(self, nr_pfns):
+        """Read a batch of legacy pfns, as a typed array where possible"""
+        typecode = pfn_array_types.get(self.twidth)
+        if typecode is None:
+            return self.unpack_ulongs(nr_pfns)
+
+        pfns = array(typecode)
+        pfns.fromstring(self.rdexact(nr_pfns * (self.twidth / 8)))
+        return pfns
+
+    def read_pv_extended_info(self, vm):
+
+        marker, = self.unpack_ulongs(1)
+
+        if self.twidth == 32:
+            expected = 0xffffffff
+        else:
+            expected = 0xffffffffffffffff
+
+        if marker != expected:
+            raise StreamError("Unexpected extended info marker 0x%x"
+                              % (marker, ))
+
+        total_length, = self.unpack_exact("I")
+        so_far = 0
+
+        self.info("Extended Info: length 0x%x" % (total_length, ))
+
+        while so_far < total_length:
+
+            blkid, datasz = self.unpack_exact("=4sI")
+            so_far += 8
+
+            self.info("  Record type: %s, size 0x%x" % (blkid, datasz))
+
+            data = self.rdexact(datasz)
+            so_far += datasz
+
+            # Eww, but this is how it is done :(
+            if blkid == "vcpu":
+
+                vm.basic_len = datasz
+
+                if datasz == 0x1430:
+                    vm.width = 8
+                    vm.levels = 4
+                    self.info("    64bit domain, 4 levels")
+                elif datasz == 0xaf0:
+                    vm.width = 4
+                    vm.levels = 3
+                    self.info("    32bit domain, 3 levels")
+                else:
+                    raise StreamError("Unable to determine guest width/level")
+
+                self.write_libxc_pv_info(vm)
+
+            elif blkid == "extv":
+                vm.extd = True
+
+            elif blkid == "xcnt":
+                vm.xsave_len, = unpack("I", data[:4])
+                self.info("xcnt sz 0x%x" % (vm.xsave_len, ))
+
+            else:
+                raise StreamError("Unrecognised extended block")
+
+
+        if so_far != total_length:
+            raise StreamError("Overshot Extended Info size by %d bytes"
+                              % (so_far - total_length,))
+
+    def read_pv_p2m_frames(self, vm):
+        fpp = 4096 / vm.width
+        p2m_frame_len = (vm.p2m_size - 1) / fpp + 1
+
+        self.info("P2M frames: fpp %d, p2m_frame_len %d"
+                  % (fpp, p2m_frame_len))
+        self.write_libxc_pv_p2m_frames(vm, self.unpack_ulongs(p2m_frame_len))
+
+    def read_pv_tail(self, vm):
+
+        nr_unmapped_pfns, = self.unpack_exact("I")
+
+        if nr_unmapped_pfns != 0:
+            # "Unmapped" pfns are bogus
+            _ = self.unpack_ulongs(nr_unmapped_pfns)
+            self.info("discarding %d bogus 'unmapped pfns'"
+                      % (nr_unmapped_pfns, ))
+
+        for vcpu_id in vm.online_vcpu_map:
+
+            basic = self.rdexact(vm.basic_len)
+            self.info("Got VCPU basic (size 0x%x)" % (vm.basic_len, ))
+            self.write_libxc_pv_vcpu_basic(vcpu_id, basic)
+
+            if vm.extd:
+                extd = self.rdexact(128)
+                self.info("Got VCPU extd (size 0x%x)" % (128, ))
+                self.write_libxc_pv_vcpu_extd(vcpu_id, extd)
+
+            if vm.xsave_len:
+                mask, size = self.unpack_exact("QQ")
+                assert vm.xsave_len - 16 == size
+
+                xsave = self.rdexact(size)
+                self.info("Got VCPU xsave (mask 0x%x, size 0x%x)"
+                          % (mask, size))
+                self.write_libxc_pv_vcpu_xsave(vcpu_id, xsave)
+
+        shinfo = self.rdexact(4096)
+        self.info("Got shinfo")
+
+        self.write_record(libxc.REC_TYPE_shared_info, shinfo)
+        self.write_record(libxc.REC_TYPE_end, "")
+
+
+    def read_libxl_toolstack(self, vm, data):
+
+        if len(data) < 8:
+            raise StreamError("Overly short libxl toolstack data")
+
+        ver, count = unpack("=II", data[:8])
+        data = data[8:]
+
+        if ver != 1:
+            raise StreamError("Cannot decode libxl toolstack version %u"
+                              % (ver, ))
+        self.info("    Version %u, count %u" % (ver, count))
+
+        for x in range(count):
+
+            if len(data) < 28:
+                raise StreamError("Remaining data too short for physmap"
+                                  " header")
+
+            phys, start, size, namelen = unpack("=QQQI", data[:28])
+            data = data[28:]
+
+            if namelen == 0:
+                raise StreamError("No physmap info name")
+
+            # 64bit leaked 4 bytes of padding onto the end of name
+            if self.twidth == 64:
+                namelen += 4
+
+            if len(data) < namelen:
+                raise StreamError("Remaining data too short for physmap name")
+
+            name = data[:namelen]
+            data = data[namelen:]
+
+            # Strip padding off the end of name
+            if self.twidth == 64:
+                name = name[:-4]
+
+            if name[-1] != '\x00':
+                raise StreamError("physmap name not NUL terminated")
+
+            root = "physmap/%x" % (phys,)
+            kv = [root + "/start_addr", "%x" % (start, ),
+                  root + "/size",       "%x" % (size, ),
+                  root + "/name",       name[:-1]]
+
+            for key, val in zip(kv[0::2], kv[1::2]):
+                self.info("    '%s' = '%s'" % (key, val))
+
+            vm.emu_xenstore += '\x00'.join(kv) + '\x00'
+
+
+    def journal_options(self, vm):
+        """Options which a resumed run must share with the journaled one"""
+        return { "twidth": self.twidth,
+                 "pv": self.pv,
+                 "qemu": self.qemu,
+                 "libxl": vm.libxl,
+                 }
+
+    def write_journal(self, vm):
+        """
+        Record a checkpoint from which the conversion can be resumed.  Only
+        ever called at page batch boundaries, once everything up to out_offset
+        has reached stable storage.
+        """
+
+        self.fout.flush()
+        os.fsync(self.fout.fileno())
+
+        tmp = self.journal + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump({ "version": __version__,
+                        "options": self.journal_options(vm),
+                        "in_offset": self.in_offset,
+                        "out_offset": self.out_offset,
+                        "vm": vm.checkpoint(),
+                        }, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp, self.journal)
+
+        self.journal_last = self.in_offset
+        self.info("  Checkpoint: in 0x%x, out 0x%x"
+                  % (self.in_offset, self.out_offset))
+
+    def check_journal_files(self):
+        """
+        Journaling needs the output synced to disk at each checkpoint, and
+        resuming needs both files repositioned, so both must be regular files.
+        """
+        for f in (self.fin, self.fout):
+            if not stat.S_ISREG(os.fstat(f.fileno()).st_mode):
+                raise StreamError("Cannot journal on non-regular file '%s'"
+                                  % (f.name, ))
+
+    def resume_from_journal(self, vm):
+        """
+        Reposition fin and fout to the last checkpoint recorded in the journal,
+        and restore the conversion state which went with it.
+        """
+
+        try:
+            with open(self.journal) as f:
+                state = json.load(f)
+        except (IOError, ValueError), e:
+            raise StreamError("Unable to read journal '%s': %s"
+                              % (self.journal, e))
+
+        if state.get("version") != __version__:
+            raise StreamError("Journal version %s, expected %d"
+                              % (state.get("version"), __version__))
+
+        if state["options"] != self.journal_options(vm):
+            raise StreamError("Journal was written with different options: %s"
+                              % (state["options"], ))
+
+        self.in_offset = self.journal_last = state["in_offset"]
+        self.out_offset = state["out_offset"]
+
+        self.fin.seek(self.in_offset)
+        self.fout.seek(self.out_offset)
+        self.fout.truncate()
+
+        vm.restore(state["vm"])
+        self.info("Resuming from checkpoint: in 0x%x, out 0x%x"
+                  % (self.in_offset, self.out_offset))
+
+    def read_tmem(self):
+        """
+        Skip over a tmem chunk.  A v2 stream has no representation of tmem, so
+        the pools are read a page at a time and dropped, rather than buffering
+        them.  Pages in persistent pools are guest data, so may only be dropped
+        on request.
+        """
+        version, max_pools, minusone = self.unpack_exact("=III")
+        if minusone != 0xffffffff:
+            raise StreamError("Bad tmem header terminator 0x%x" % (minusone, ))
+
+        flags, weight, cap, minusone = self.unpack_exact("=IIII")
+        if minusone != 0xffffffff:
+            raise StreamError("Bad tmem client terminator 0x%x" % (minusone, ))
+
+        self.info("  Tmem: version %d, max_pools %d, flags 0x%x, weight %d,"
+                  " cap %d" % (version, max_pools, flags, weight, cap))
+
+        nr_pools = nr_pages = 0
+        while True:
+
+            pool_id, = self.unpack_exact("=I")
+            if pool_id == 0xffffffff:
+                break
+
+            pflags, n_pages, uuid_lo, uuid_hi = self.unpack_exact("=IIQQ")
+            nr_pools += 1
+            self.info("    Pool %d: flags 0x%x, %d pages, uuid %016x%016x"
+                      % (pool_id, pflags, n_pages, uuid_hi, uuid_lo))
+
+            if n_pages and not self.discard_tmem:
+                raise StreamError("Tmem pool %d has %d persistent pages, which"
+                                  " cannot be represented in a v2 stream"
+                                  % (pool_id, n_pages))
+
+            pagesize = 1 << (((pflags >> legacy.TMEM_POOL_PAGESIZE_SHIFT) &
+                              legacy.TMEM_POOL_PAGESIZE_MASK) + 12)
+
+            for _ in xrange(n_pages):
+                if self.unpack_exact("=QQQ") == (0xffffffffffffffff, ) * 3:
+                    break
+                self.rdexact(4 + pagesize) # Index and page data
+                nr_pages += 1
+
+        if nr_pages:
+            self.err("Warning: Discarded %d persistent tmem pages from %d"
+                     " pools" % (nr_pages, nr_pools))
+        else:
+            self.info("    Discarded %d tmem pools" % (nr_pools, ))
+
+    def read_tmem_extra(self):
+        """Skip over the tmem invalidations of a tmem_extra chunk"""
+        count = 0
+        while True:
+
+            pool_id, = self.unpack_exact("=I")
+            if pool_id == 0xffffffff:
+                break
+
+            self.rdexact(28) # oid[3] and index
+            count += 1
+
+        self.info("  Tmem extra: discarded %d invalidations" % (count, ))
+
+    def read_chunks(self, vm):
+
+        while True:
+
+            marker, = self.unpack_exact("=i")
+            if marker <= 0:
+                self.info("Chunk: %d - %s" %
+                          (marker,
+                           legacy.chunk_type_to_str.get(marker, "unknown")))
+
+            if marker == legacy.CHUNK_end:
+                self.info("  End")
+
+                if vm.hvm_params:
+                    self.write_libxc_hvm_params(vm.hvm_params)
+
+                return
+
+            elif marker > 0:
+
+                if marker > legacy.MAX_BATCH:
+                    raise StreamError("Page batch (%d) exceeded MAX_BATCH (%d)"
+                                      % (marker, legacy.MAX_BATCH))
+                pfns, nr_pages = filter_pfn_batch(self.read_pfn_batch(marker))
+                pages = self.rdexact(nr_pages * 4096)
+
+                self.write_page_data(pfns, pages)
+
+                if (self.journal and self.in_offset - self.journal_last
+                    >= self.journal_interval):
+                    self.write_journal(vm)
+
+                if self.progress:
+                    self.progress.update(self, nr_pages)
+
+            elif marker == legacy.CHUNK_enable_verify_mode:
+                self.info("This is a debug stream")
+
+            elif marker == legacy.CHUNK_vcpu_info:
+                max_id, = self.unpack_exact("i")
+
+                if max_id > legacy.MAX_VCPU_ID:
+                    raise StreamError("Vcpu max_id out of range: %d > %d"
+                                      % (max_id, legacy.MAX_VCPU_ID))
+
+                vm.max_vcpu_id = max_id
+                bitmap = self.unpack_exact("Q" * ((max_id/64) + 1))
+
+                for idx, word in enumerate(bitmap):
+                    bit_idx = 0
+
+                    while word > 0:
+                        if word & 1:
+                            vm.online_vcpu_map.append((idx * 64) + bit_idx)
+
+                        bit_idx += 1
+                        word >>= 1
+
+                self.info("  Vcpu info: max_id %d, online map %s"
+                          % (vm.max_vcpu_id, vm.online_vcpu_map))
+
+            elif marker == legacy.CHUNK_hvm_ident_pt:
+                _, ident_pt = self.unpack_exact("=IQ")
+                self.info("  EPT Identity Pagetable: 0x%x" % (ident_pt, ))
+                vm.hvm_params.extend([public.HVM_PARAM_IDENT_PT, ident_pt])
+
+            elif marker == legacy.CHUNK_hvm_vm86_tss:
+                _, vm86_tss = self.unpack_exact("=IQ")
+                self.info("  VM86 TSS: 0x%x" % (vm86_tss, ))
+                vm.hvm_params.extend([public.HVM_PARAM_VM86_TSS, vm86_tss])
+
+            elif marker == legacy.CHUNK_tmem:
+                self.read_tmem()
+
+            elif marker == legacy.CHUNK_tmem_extra:
+                self.read_tmem_extra()
+
+            elif marker == legacy.CHUNK_tsc_info:
+                mode, nsec, khz, incarn = self.unpack_exact("=IQII")
+                self.info("  TSC_INFO: mode %s, %d ns, %d khz, %d incarn"
+                          % (mode, nsec, khz, incarn))
+                self.write_libxc_tsc_info(mode, khz, nsec, incarn)
+
+            elif marker == legacy.CHUNK_hvm_console_pfn:
+                _, console_pfn = self.unpack_exact("=IQ")
+                self.info("  Console pfn: 0x%x" % (console_pfn, ))
+                vm.hvm_params.extend(
+                    [public.HVM_PARAM_CONSOLE_PFN, console_pfn])
+
+            elif marker == legacy.CHUNK_last_checkpoint:
+                self.info("  Last Checkpoint")
+                # Nothing to do
+
+            elif marker == legacy.CHUNK_hvm_acpi_ioports_location:
+                _, loc = self.unpack_exact("=IQ")
+                self.info("  ACPI ioport location: 0x%x" % (loc, ))
+                vm.hvm_params.extend(
+                    [public.HVM_PARAM_ACPI_IOPORTS_LOCATION, loc])
+
+            elif marker == legacy.CHUNK_hvm_viridian:
+                _, loc = self.unpack_exact("=IQ")
+                self.info("  Viridian location: 0x%x" % (loc, ))
+                vm.hvm_params.extend([public.HVM_PARAM_VIRIDIAN, loc])
+
+            elif marker == legacy.CHUNK_compressed_data:
+                sz, = self.unpack_exact("I")
+                data = self.rdexact(sz)
+                self.info("  Compressed Data: sz 0x%x" % (sz, ))
+                raise RuntimeError("todo")
+
+            elif marker == legacy.CHUNK_enable_compression:
+                raise RuntimeError("todo")
+
+            elif marker == legacy.CHUNK_hvm_generation_id_addr:
+                _, genid_loc = self.unpack_exact("=IQ")
+                self.info("  Generation ID Address: 0x%x" % (genid_loc, ))
+                vm.hvm_params.extend(
+                    [public.HVM_PARAM_VM_GENERATION_ID_ADDR, genid_loc])
+
+            elif marker == legacy.CHUNK_hvm_paging_ring_pfn:
+                _, pfn = self.unpack_exact("=IQ")
+                self.info("  Paging ring pfn: 0x%x" % (pfn, ))
+                vm.hvm_params.extend([public.HVM_PARAM_PAGING_RING_PFN, pfn])
+
+            elif marker == legacy.CHUNK_hvm_monitor_ring_pfn:
+                _, pfn = self.unpack_exact("=IQ")
+                self.info("  Monitor ring pfn: 0x%x" % (pfn, ))
+                vm.hvm_params.extend([public.HVM_PARAM_MONITOR_RING_PFN, pfn])
+
+            elif marker == legacy.CHUNK_hvm_sharing_ring_pfn:
+                _, pfn = self.unpack_exact("=IQ")
+                self.info("  Sharing ring pfn: 0x%x" % (pfn, ))
+                vm.hvm_params.extend([public.HVM_PARAM_SHARING_RING_PFN, pfn])
+
+            elif marker == legacy.CHUNK_toolstack:
+                sz, = self.unpack_exact("I")
+
+                if sz:
+                    data = self.rdexact(sz)
+                    self.info("  Toolstack Data: sz 0x%x" % (sz, ))
+
+                    if vm.libxl:
+                        self.read_libxl_toolstack(vm, data)
+                    else:
+                        self.info("    Discarding")
+
+            elif marker == legacy.CHUNK_hvm_ioreq_server_pfn:
+                _, pfn = self.unpack_exact("=IQ")
+                self.info("  IOREQ server pfn: 0x%x" % (pfn, ))
+                vm.hvm_params.extend([public.HVM_PARAM_IOREQ_SERVER_PFN, pfn])
+
+            elif marker == legacy.CHUNK_hvm_nr_ioreq_server_pages:
+                _, nr_pages = self.unpack_exact("=IQ")
+                self.info("  IOREQ server pages: %d" % (nr_pages, ))
+                vm.hvm_params.extend(
+                    [public.HVM_PARAM_NR_IOREQ_SERVER_PAGES, nr_pages])
+
+            else:
+                raise StreamError("Unrecognised chunk %d" % (marker,))
+
+    def read_hvm_tail(self, vm):
+
+        io, bufio, store = self.unpack_exact("QQQ")
+        self.info("Magic pfns: 0x%x 0x%x 0x%x" % (io, bufio, store))
+        self.write_libxc_hvm_params([public.HVM_PARAM_IOREQ_PFN,    io,
+                                     public.HVM_PARAM_BUFIOREQ_PFN, bufio,
+                                     public.HVM_PARAM_STORE_PFN,    store])
+
+        blobsz, = self.unpack_exact("I")
+        self.info("Got HVM Context (0x%x bytes)" % (blobsz, ))
+        blob = self.rdexact(blobsz)
+
+        self.write_record(libxc.REC_TYPE_hvm_context, blob)
+        self.write_record(libxc.REC_TYPE_end, "")
+
+
+
+    def read_qemu(self, vm):
+
+        rawsig = self.rdexact(21)
+        sig, = unpack("21s", rawsig)
+        self.info("Qemu signature: %s" % (sig, ))
+
+        if sig == "DeviceModelRecord0002":
+            rawsz = self.rdexact(4)
+            sz, = unpack("I", rawsz)
+            qdata = self.rdexact(sz)
+
+            if vm.libxl:
+                self.write_libxl_emulator_context(qdata)
+            else:
+                self.stream_write(rawsig)
+                self.stream_write(rawsz)
+                self.stream_write(qdata)
+
+        else:
+            raise RuntimeError("Unrecognised Qemu sig '%s'" % (sig, ))
+
+
+    def skip_xl_header(self, fmt):
+        """Skip over an xl header in the stream"""
+
+        hdr = self.rdexact(len(xl.MAGIC))
+        if hdr != xl.MAGIC:
+            raise StreamError("No xl header")
+
+        byteorder, mflags, oflags, optlen = self.unpack_exact(xl.HEADER_FORMAT)
+
+        if fmt == "libxl":
+            mflags |= xl.MANDATORY_FLAG_STREAMV2
+
+        opts = pack(xl.HEADER_FORMAT, byteorder, mflags, oflags, optlen)
+
+        optdata = self.rdexact(optlen)
+
+        self.info("Processed xl header")
+
+        self.stream_write(hdr)
+        self.stream_write(opts)
+        self.stream_write(optdata)
+
+    def read_legacy_stream(self, vm, resume = False):
+
+        if resume:
+            self.resume_from_journal(vm)
+
+        if self.progress:
+            self.progress.begin(self)
+
+        if not resume:
+            vm.p2m_size, = self.unpack_ulongs(1)
+            self.info("P2M Size: 0x%x" % (vm.p2m_size,))
+
+            if vm.libxl:
+                self.write_libxl_hdr()
+                self.write_libxl_libxc_context()
+
+            self.write_libxc_ihdr()
+            self.write_libxc_dhdr()
+
+            if self.pv:
+                self.read_pv_extended_info(vm)
+                self.read_pv_p2m_frames(vm)
+
+        self.read_chunks(vm)
+
+        if self.pv:
+            self.read_pv_tail(vm)
+        else:
+            self.read_hvm_tail(vm)
+
+        if vm.libxl and len(vm.emu_xenstore):
+            self.write_libxl_emulator_xenstore_data(vm.emu_xenstore)
+
+        if not self.pv and (vm.libxl or self.qemu):
+            self.read_qemu(vm)
+
+        if vm.libxl:
+            self.write_libxl_end()
@@ -278,6 +278,52 @@ chunk_type_to_str = {
 # Up to 1024 pages (4MB) at a time
 MAX_BATCH = 1024
 
+# XEN_DOMCTL_PFINFO_* types, in bits 31-28 of a PFN array entry
+PFINFO_LTAB_MASK = 0xf0000000
+PFINFO_BROKEN    = 0xd0000000 # Pages of this type and above have no data
+PFINFO_XALLOC    = 0xe0000000
+PFINFO_XTAB      = 0xf0000000
+
+
+"""
+Tmem:
+
+XC_SAVE_ID_TMEM chunk, as written by the xc_tmem_save() of Xen 4.5 and
+earlier (all fields packed):
+
+  uint32_t version
+  uint32_t max_pools
+  uint32_t -1
+  uint32_t client flags
+  uint32_t client weight
+  uint32_t client cap
+  uint32_t -1
+
+  Then a series of pools, terminated by a pool_id of -1:
+
+    uint32_t pool_id
+    uint32_t pool flags      : TMEM_POOL_*
+    uint32_t n_pages         : Always 0 for non-persistent pools
+    uint64_t uuid[2]
+
+    Then up to n_pages pages:
+
+      uint64_t oid[3]        : All -1 terminates the pool's pages early
+      uint32_t index
+      bytes    page          : (1 << (TMEM_POOL_PAGESIZE + 12)) bytes
+
+XC_SAVE_ID_TMEM_EXTRA chunk, as written by xc_tmem_save_extra(), lists
+pages invalidated during live migration, terminated by a pool_id of -1:
+
+  uint32_t pool_id
+  uint64_t oid[3]
+  uint32_t index
+"""
+
+TMEM_POOL_PERSIST        = 1
+TMEM_POOL_PAGESIZE_SHIFT = 4
+TMEM_POOL_PAGESIZE_MASK  = 0xf
+
 # Maximum #VCPUs currently supported for save/restore
 MAX_VCPU_ID = 4095
 
@@ -5,11 +5,16 @@
 Unit tests for migration v2 streams
 """
 
+import json
+import os
+import tempfile
 import unittest
 
-from struct import calcsize
+from array import array
+from StringIO import StringIO
+from struct import calcsize, pack
 
-from xen.migration import libxc, libxl
+from xen.migration import libxc, libxl, legacy, convert
 
 class TestLibxc(unittest.TestCase):
 
@@ -41,12 +46,190 @@ class TestLibxl(unittest.TestCase):
                          ):
             self.assertEqual(calcsize(fmt), sz)
 
+class TestConvert(unittest.TestCase):
+
+    def test_filter_pfn_batch(self):
+
+        pfns, nr_pages = convert.filter_pfn_batch(
+            [3, legacy.PFINFO_XTAB, 1, legacy.PFINFO_BROKEN | 2, 0x10000000 | 4])
+        self.assertEqual(list(pfns), [3, 1, legacy.PFINFO_BROKEN | 2,
+                                      0x10000000 | 4])
+        self.assertEqual(nr_pages, 3)
+
+        self.assertRaises(convert.StreamError,
+                          convert.filter_pfn_batch, [1, 2, 1])
+
+        # XTAB entries may repeat, other duplicates are reported
+        pfns, nr_pages = convert.filter_pfn_batch(
+            array("I", [legacy.PFINFO_XTAB, 5, legacy.PFINFO_XTAB]))
+        self.assertEqual((list(pfns), nr_pages), ([5], 1))
+
+        try:
+            convert.filter_pfn_batch([7, legacy.PFINFO_XTAB,
+                                      0x10000000 | 6, 0x10000000 | 6])
+            self.fail("Duplicate pfn not detected")
+        except convert.StreamError, e:
+            self.assertEqual(str(e),
+                             "Duplicate pfn 0x6 (type 0x10000000) in batch")
+
+    def legacy_hvm_stream(self, nr_pfns = 4, chunks = "", batches = 1):
+        """A 64bit toolstack HVM legacy stream of batches of nr_pfns pages,
+        with chunks before the end"""
+        stream = pack("Q", nr_pfns * batches)
+        for batch in range(batches):
+            pfns = range(batch * nr_pfns, (batch + 1) * nr_pfns)
+            stream += (pack("=i", nr_pfns) +
+                       pack("Q" * nr_pfns, *pfns) +
+                       "".join([chr(pfn & 0xff) * 4096 for pfn in pfns]))
+        return (stream +
+                chunks +
+                pack("=i", legacy.CHUNK_end) +
+                pack("QQQ", 1, 2, 3) +     # Magic pfns
+                pack("I", 8) + "\x00" * 8) # HVM context
+
+    def test_convert_hvm(self):
+
+        legacy_stream = self.legacy_hvm_stream()
+
+        fin, fout = StringIO(legacy_stream), StringIO()
+        conv = convert.Converter(fin, fout, 64, False, qemu = False)
+        conv.convert()
+
+        self.assertEqual(conv.in_offset, len(legacy_stream))
+        self.assertEqual(conv.out_offset, len(fout.getvalue()))
+
+        # The result must be a complete and valid libxc v2 stream
+        libxc.VerifyLibxc(lambda msg: None,
+                          StringIO(fout.getvalue()).read).verify()
+
+    def legacy_tmem(self, pools = ()):
+        """A tmem chunk holding pools of (pool_id, pages) of 4k pages"""
+        chunk = (pack("=i", legacy.CHUNK_tmem) +
+                 pack("=III", 1, 16, 0xffffffff) +   # Version, max_pools
+                 pack("=IIII", 0, 0, 0, 0xffffffff)) # Flags, weight, cap
+        for pool_id, pages in pools:
+            chunk += pack("=IIIQQ", pool_id, 0, len(pages), 0, pool_id)
+            for index, page in enumerate(pages):
+                chunk += pack("=QQQI", 1, 2, 3, index) + page
+        return chunk + pack("=I", 0xffffffff)
+
+    def convert_hvm(self, chunks, **kwargs):
+        return self.convert_hvm_stream(self.legacy_hvm_stream(chunks = chunks),
+                                       **kwargs)
+
+    def convert_hvm_stream(self, legacy_stream, **kwargs):
+        fin = StringIO(legacy_stream)
+        fout = StringIO()
+        conv = convert.Converter(fin, fout, 64, False, qemu = False, **kwargs)
+        conv.convert()
+        return fout.getvalue()
+
+    def test_tmem(self):
+
+        plain = self.convert_hvm("")
+
+        # No pools, and no invalidations: nothing to carry across
+        extra = pack("=i", legacy.CHUNK_tmem_extra) + pack("=I", 0xffffffff)
+        self.assertEqual(self.convert_hvm(self.legacy_tmem() + extra), plain)
+
+        # Persistent pages may only be dropped on request
+        tmem = self.legacy_tmem([(0, ["\x01" * 4096, "\x02" * 4096]),
+                                 (1, [])])
+        extra = (pack("=i", legacy.CHUNK_tmem_extra) +
+                 pack("=IQQQI", 0, 1, 2, 3, 0) +
+                 pack("=I", 0xffffffff))
+        self.assertRaises(convert.StreamError, self.convert_hvm, tmem)
+
+        errors = []
+        self.assertEqual(self.convert_hvm(tmem + extra, discard_tmem = True,
+                                          err = errors.append), plain)
+        self.assertEqual(errors, ["Warning: Discarded 2 persistent tmem pages"
+                                  " from 2 pools"])
+
+        # A stream ending part way through a pool
+        fin = StringIO(self.legacy_hvm_stream(chunks = tmem)[:-140])
+        conv = convert.Converter(fin, StringIO(), 64, False, qemu = False,
+                                 discard_tmem = True)
+        self.assertRaises(IOError, conv.convert)
+
+    def test_progress_after_resume(self):
+
+        class Conv(object):
+            in_offset = out_offset = 0
+
+        status = tempfile.NamedTemporaryFile()
+        progress = convert.Progress(0, 3 << 20, status_file = status.name)
+
+        # Resuming 2MiB in, only the input from there on was converted now
+        conv = Conv()
+        conv.in_offset = 2 << 20
+        progress.begin(conv)
+        conv.in_offset += 1 << 20
+        progress.report(conv, "running")
+
+        state = json.load(open(status.name))
+        self.assertAlmostEqual(state["rate"] * state["elapsed"], 1 << 20)
+        self.assertEqual(state["in_bytes"], 3 << 20)
+        self.assertEqual(state["eta"], 0)
+
+    def test_journal_resume(self):
+
+        legacy_stream = self.legacy_hvm_stream(nr_pfns = 2, batches = 8)
+        expected = self.convert_hvm_stream(legacy_stream)
+
+        fin = tempfile.NamedTemporaryFile()
+        fout = tempfile.NamedTemporaryFile()
+        journal = tempfile.NamedTemporaryFile()
+
+        # Checkpoint after every batch, and stop part way through the fifth
+        fin.write(legacy_stream[:8 + 4 * (4 + 16 + 8192) + 100])
+        fin.flush()
+        fin.seek(0)
+        conv = convert.Converter(fin, fout, 64, False, qemu = False,
+                                 journal = journal.name,
+                                 journal_interval = 4096)
+        self.assertRaises(IOError, conv.convert)
+        self.assertTrue(json.load(open(journal.name))["in_offset"] > 0)
+
+        # Resume with all the input there, as the journal says
+        fin.seek(0)
+        fin.write(legacy_stream)
+        fin.flush()
+        fin.seek(0)
+        fout2 = open(fout.name, "r+b")
+        conv = convert.Converter(fin, fout2, 64, False, qemu = False,
+                                 journal = journal.name,
+                                 journal_interval = 4096)
+        conv.convert(resume = True)
+        fout2.close()
+
+        self.assertEqual(open(fout.name, "rb").read(), expected)
+
+    def test_journal_needs_regular_files(self):
+
+        fin = tempfile.TemporaryFile()
+        fin.write(self.legacy_hvm_stream())
+        fin.seek(0)
+
+        rfd, wfd = os.pipe()
+        fout = os.fdopen(wfd, "wb")
+        journal = tempfile.NamedTemporaryFile()
+        try:
+            conv = convert.Converter(fin, fout, 64, False, qemu = False,
+                                     journal = journal.name)
+            self.assertRaises(convert.StreamError, conv.convert)
+            self.assertEqual(conv.out_offset, 0)
+        finally:
+            fout.close()
+            os.close(rfd)
+
 
 def test_suite():
     suite = unittest.TestSuite()
 
     suite.addTest(unittest.makeSuite(TestLibxc))
     suite.addTest(unittest.makeSuite(TestLibxl))
+    suite.addTest(unittest.makeSuite(TestConvert))
 
     return suite
 
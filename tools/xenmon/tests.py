@@ -0,0 +1,1009 @@
+#!/usr/bin/env python
+
+"""
+Unit tests for xenmon, over synthetic xenbaked shared memory regions
+"""
+
+import csv
+import json
+import mmap
+import os
+import shutil
+import socket
+import tempfile
+import unittest
+
+from StringIO import StringIO
+
+import xenmon
+
+# build a region as xenbaked lays it out for ndomains and nsamples: for
+# each cpu, the samples (sample(cpu, k) giving the words of sample k), the
+# domain info of doms, a list of (domid, name), and the trailer with next
+def make_region(ndomains, nsamples, ncpu, next, sample, doms):
+    xenmon.set_layout(ndomains, nsamples)
+    slen = (xenmon.QOS_DATA_SIZE + mmap.PAGESIZE - 1) & ~(mmap.PAGESIZE - 1)
+
+    region = ""
+    for cpu in range(ncpu):
+        words = []
+        for k in range(nsamples):
+            words.extend(sample(cpu, k))
+        for slot in range(ndomains):
+            if slot < len(doms):
+                (domid, name) = doms[slot]
+                if domid == xenmon.IDLE_DOMAIN:
+                    domid = 32767
+                words.extend([0] * 6 + [0, 0, 1, domid, 0, name])
+            else:
+                words.extend([0] * 6 + [0, 0, 0, 0, 0, ""])
+        words.extend([next, ncpu, slen, 1000])
+        block = xenmon.cpu_data_struct.pack(*words)
+        region += block + "\0" * (slen - len(block))
+    return (region, slen)
+
+# a sample of ndomains domain slots, each domain dom getting cpu for
+# (dom + 1) * k ns and so on, over 100ms
+def simple_sample(ndomains, cpu, k):
+    words = []
+    for metric in range(6):
+        words.extend([(dom + 1) * (k + 1) * (metric + 1) * 1000
+                      for dom in range(ndomains)])
+    return words + [10**8, (k + 1) * 10**8, k % 3, cpu]
+
+# a sample of the domain slots (idle, 0 and 7) of a host of two cpus, of
+# 100ms each: the ns each domain got on cpu, and a tenth of that for ns
+# allocated, half for waited, 1ms blocked, 10 executions and 5 ios
+HOST_GOTTEN = [[5 * 10**7, 1 * 10**7, 2 * 10**7],
+               [1 * 10**7, 3 * 10**7, 6 * 10**7]]
+
+def host_sample(cpu, k):
+    gotten = HOST_GOTTEN[cpu]
+    return (gotten + [g / 10 for g in gotten] + [g / 2 for g in gotten] +
+            [10**6] * 3 + [10] * 3 + [5] * 3 +
+            [10**8, (k + 1) * 10**8, cpu + 1, 0])
+
+# a screen recording what is painted on it
+class FakeScreen:
+    def __init__(self, maxy = 40, maxx = 100):
+        self.size = [maxy, maxx]
+        self.lines = {}
+        self.painted = []       # rows painted, in order
+        self.cleared = []       # rows cleared, in order
+        self.cursor = 0
+
+    def getmaxyx(self):
+        return self.size
+
+    def addstr(self, row, col, str, attr = 0):
+        line = self.lines.get(row, "").ljust(col)
+        self.lines[row] = line[:col] + str + line[col + len(str):]
+        self.painted.append(row)
+
+    def move(self, row, col):
+        self.cursor = row
+
+    def clrtoeol(self):
+        self.lines[self.cursor] = ""
+        self.cleared.append(self.cursor)
+
+    def erase(self):
+        self.lines = {}
+
+    def text(self, row):
+        return self.lines.get(row, "")
+
+class XenmonTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.layout = (xenmon.NDOMAINS, xenmon.NSAMPLES)
+        self.dom_in_use = xenmon.dom_in_use
+        self.options = xenmon.options
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        xenmon.set_layout(*self.layout)
+        xenmon.dom_in_use = self.dom_in_use
+        xenmon.options = self.options
+        shutil.rmtree(self.tmpdir)
+
+    def region(self, ndomains = 3, nsamples = 20, ncpu = 2, next = 5):
+        doms = [(xenmon.IDLE_DOMAIN, "Idle"), (0, "Domain-0"), (7, "guest")]
+        return make_region(ndomains, nsamples, ncpu, next,
+                           lambda cpu, k: simple_sample(ndomains, cpu, k),
+                           doms[:ndomains])
+
+class TestSampleWindow(XenmonTestCase):
+
+    def test_window(self):
+        xenmon.set_layout(2, 20)
+        xenmon.dom_in_use = [1, 0]
+        samples = [simple_sample(2, 0, k) for k in range(20)]
+
+        # walking back from the sample before next, leaving out the 10
+        # after it, which xenbaked may be overwriting
+        window = xenmon.sample_window(15, samples)
+        self.assertEqual(window.order, [14, 13, 12, 11])
+
+        # less than 250ms takes 3 samples
+        [dominfos, passed, lost, ffp] = window.totals(250 * 10**6)
+        self.assertEqual(passed, 1 + 3 * 10**8)
+        self.assertEqual(dominfos[0].gotten_sum,
+                         sum([samples[k][0] for k in (14, 13, 12)]))
+        self.assertEqual(dominfos[0].iocount_sum,
+                         sum([samples[k][10] for k in (14, 13, 12)]))
+        self.assertEqual(dominfos[1], None)
+        self.assertEqual(lost, [0, 14 % 3 + 13 % 3 + 12 % 3, 2])
+
+        # longer ones take all there is
+        [dominfos, passed, lost, ffp] = window.totals(10 * 10**9)
+        self.assertEqual(passed, 1 + 4 * 10**8)
+
+        [ldoms, lost, ffp] = window.summarize(250 * 10**6)
+        gotten = sum([samples[k][0] for k in (14, 13, 12)])
+        self.assertAlmostEqual(ldoms[0][0][1],
+                               100.0 * gotten / (1 + 3 * 10**8))
+        self.assertEqual(ldoms[1], 0)
+
+    def test_wrap(self):
+        xenmon.set_layout(2, 20)
+        xenmon.dom_in_use = [1, 1]
+        samples = [simple_sample(2, 0, k) for k in range(20)]
+
+        # at next 0 the window starts at the end of the ring
+        window = xenmon.sample_window(0, samples)
+        self.assertEqual(window.order, range(19, 10, -1))
+
+        [ldoms, lost, ffp] = window.summarize(10 * 10**9)
+        expected = xenmon.summarize(19, 10, 10 * 10**9, samples)
+        self.assertEqual(ldoms, expected[0])
+
+        [dominfos, passed, lost, ffp] = window.totals(10 * 10**9)
+        self.assertEqual(dominfos[1].gotten_sum,
+                         sum([samples[k][1] for k in range(11, 20)]))
+
+class TestLayout(XenmonTestCase):
+
+    def test_detect(self):
+        (region, slen) = self.region(3, 7)
+        xenmon.set_layout(*self.layout)
+
+        self.assertEqual(xenmon.detect_layout(region, None, 7), (3, 7))
+        self.assertEqual(xenmon.detect_layout(region, 3, 7), (3, 7))
+        self.assertEqual(xenmon.detect_layout(region, 4, 7), None)
+        self.assertEqual(xenmon.detect_layout(region, None, 8), None)
+        self.assertEqual(xenmon.detect_layout("", None, 7), None)
+        self.assertEqual(xenmon.detect_layout("\0" * len(region), None, 7),
+                         None)
+
+    def test_default(self):
+        (region, slen) = self.region(32, 100, 4)
+        self.assertEqual(xenmon.detect_layout(region), (32, 100))
+        self.assertEqual(xenmon.read_cpu_layout(region), (4, slen))
+
+    def test_read_cpu_data(self):
+        (region, slen) = self.region(3, 20, 2, 5)
+        (samples, in_use, domain_id, next) = \
+            xenmon.read_cpu_data(region, 1, slen)
+        self.assertEqual(next, 5)
+        self.assertEqual(in_use, [1, 1, 1])
+        self.assertEqual(domain_id, [xenmon.IDLE_DOMAIN, 0, 7])
+        self.assertEqual(list(samples[4]), simple_sample(3, 1, 4))
+        self.assertEqual(xenmon.read_domain_names(region, 0, slen),
+                         {xenmon.IDLE_DOMAIN: "Idle", 0: "Domain-0",
+                          7: "guest"})
+
+class TestRecording(XenmonTestCase):
+
+    def test_round_trip(self):
+        (region, slen) = self.region(3, 20, 2)
+        shm = os.path.join(self.tmpdir, "shm")
+        open(shm, "wb").write(region)
+        recording = os.path.join(self.tmpdir, "rec.gz")
+
+        (xenmon.options, args) = xenmon.setup_cmdline_parser().parse_args(
+            ["--time", "0", "--interval", "1", "--nsamples", "20"])
+        xenmon.options.duration = 0.02
+        shm_file = xenmon.SHM_FILE
+        xenmon.SHM_FILE = shm
+        try:
+            xenmon.record_snapshots(recording)
+        finally:
+            xenmon.SHM_FILE = shm_file
+
+        xenmon.set_layout(*self.layout)
+        source = xenmon.ReplaySource(recording, 0)
+        self.assertEqual((xenmon.NDOMAINS, xenmon.NSAMPLES), (3, 20))
+        snapshots = []
+        while True:
+            snapshot = source.refresh()
+            if snapshot is None:
+                break
+            snapshots.append(snapshot)
+        source.close()
+
+        self.assertTrue(snapshots)
+        for snapshot in snapshots:
+            self.assertEqual(snapshot, (region, 2, slen))
+
+class TestLogs(XenmonTestCase):
+
+    def test_binary_log(self):
+        xenmon.set_layout(2, 20)
+        xenmon.dom_in_use = [1, 1]
+        samples = [simple_sample(2, 0, k) for k in range(20)]
+        [ldoms, lost, ffp] = xenmon.sample_window(3, samples).summarize(10**9)
+
+        filename = os.path.join(self.tmpdir, "log.xmlog")
+        log = xenmon.BinaryLog(filename)
+        log.write(1000.5, 0, 0, xenmon.IDLE_DOMAIN, ldoms[0])
+        log.write(1000.5, 0, 1, 3, ldoms[1])
+        log.end_interval()
+        log.write(2000.25, 1, 1, 3, ldoms[1])
+        log.close()
+
+        out = StringIO()
+        xenmon.convert_log(filename, out)
+        rows = list(csv.reader(StringIO(out.getvalue())))
+        self.assertEqual(rows[0], xenmon.LOG_COLUMNS)
+        self.assertEqual(len(rows), 4)
+
+        # the same values as the text logs would hold
+        for (row, (interval, cpu, domid, h)) in \
+                zip(rows[1:], [(1000.5, 0, -1, ldoms[0]),
+                               (1000.5, 0, 3, ldoms[1]),
+                               (2000.25, 1, 3, ldoms[1])]):
+            text = xenmon.LOG_FORMAT % ((interval, cpu, domid) +
+                                        xenmon.log_values(h))
+            self.assertEqual(row, text.split())
+
+    def test_bad_log(self):
+        filename = os.path.join(self.tmpdir, "log.xmlog")
+        open(filename, "wb").write("XENMONRC" + "\0" * 8)
+        self.assertRaises(ValueError, xenmon.convert_log, filename, StringIO())
+
+class TestMetrics(XenmonTestCase):
+
+    def test_format(self):
+        (region, slen) = self.region(3, 20, 2, 5)
+        text = xenmon.format_metrics(region, 2, slen, 10**9)
+        lines = text.splitlines()
+
+        for (name, help, value) in xenmon.METRICS:
+            self.assertEqual(lines.count("# TYPE xenmon_%s gauge" % name), 1)
+            self.assertEqual(len([l for l in lines if
+                                  l.startswith("xenmon_%s{" % name)]), 6)
+        self.assertTrue("xenmon_cpus 2" in lines)
+
+        # every sample line is a name, labels, and a number
+        for line in lines:
+            if line.startswith("#"):
+                continue
+            (metric, value) = line.rsplit(" ", 1)
+            float(value)
+
+        (samples, in_use, domain_id, next) = \
+            xenmon.read_cpu_data(region, 1, slen)
+        window = xenmon.sample_window(next, samples)
+        [ldoms, lost, ffp] = window.summarize(10**9)
+        self.assertTrue('xenmon_gotten_percent{cpu="1",domain="7"} %f'
+                        % ldoms[2][0][1] in lines)
+        self.assertTrue('xenmon_io_per_second{cpu="0",domain="idle"} %f'
+                        % ldoms[0][5][0] in lines)
+        self.assertTrue('xenmon_lost_records{cpu="1"} %d' % lost[1] in lines)
+        self.assertTrue(lost[1] > 0)
+
+class TestFleet(XenmonTestCase):
+
+    def stats(self, gotten):
+        return [[0, gotten, 0], 0, [0, 2.0, 0], [0, 3.0, 0], 4.0, [5.0, 0]]
+
+    def test_deltas(self):
+        encoder = xenmon.FleetEncoder("host1")
+        host = xenmon.FleetHost("host1")
+
+        frames = [{0: self.stats(10), 1: self.stats(20)},
+                  {0: self.stats(10), 1: self.stats(25)},
+                  {0: self.stats(11)},
+                  {0: self.stats(11), 2: self.stats(1)}]
+        for (n, h) in enumerate(frames):
+            msg = json.loads(encoder.encode(h, 100.0 + n))
+            if n == 0:
+                self.assertEqual(msg["full"], 1)
+            else:
+                self.assertFalse("full" in msg)
+            host.apply(msg)
+
+            expected = dict([(domid, [round(col[2](h[domid]), 2)
+                                      for col in xenmon.TOP_COLUMNS])
+                             for domid in h])
+            self.assertEqual(host.doms, expected)
+            self.assertEqual(host.time, 100.0 + n)
+
+        # only changes are sent
+        msg = json.loads(encoder.encode(frames[-1], 104.0))
+        self.assertEqual(msg["doms"], {})
+
+    def test_gap(self):
+        encoder = xenmon.FleetEncoder("host1")
+        host = xenmon.FleetHost("host1")
+
+        host.apply(json.loads(encoder.encode({0: self.stats(1)}, 1.0)))
+        encoder.encode({0: self.stats(2)}, 2.0)     # lost on the way
+        host.apply(json.loads(encoder.encode({0: self.stats(3)}, 3.0)))
+        self.assertEqual(host.gaps, 1)
+        self.assertFalse(host.synced)
+
+        # the host catches up at the next keyframe
+        encoder.keyframe = True
+        host.apply(json.loads(encoder.encode({1: self.stats(4)}, 4.0)))
+        self.assertTrue(host.synced)
+        self.assertEqual(host.doms.keys(), [1])
+
+# a source of the same region every interval, on a clock of its own
+class FakeSource:
+    def __init__(self, region, ncpu, slen):
+        self.snapshot = (region, ncpu, slen)
+        self.now = 0.0
+
+    def refresh(self):
+        return self.snapshot
+
+    def time(self):
+        return self.now
+
+    def sleep(self, secs):
+        self.now += secs
+
+    def close(self):
+        pass
+
+class TestForward(XenmonTestCase):
+
+    def setUp(self):
+        XenmonTestCase.setUp(self)
+        self.open_source = xenmon.open_source
+        self.socket = socket.socket
+
+        (region, slen) = self.region(3, 20, 2)
+        xenmon.open_source = lambda: FakeSource(region, 2, slen)
+        (xenmon.options, args) = xenmon.setup_cmdline_parser().parse_args(
+            ["--time", "20", "--interval", "1000", "--host", "host1"])
+
+    def tearDown(self):
+        xenmon.open_source = self.open_source
+        socket.socket = self.socket
+        XenmonTestCase.tearDown(self)
+
+    def test_file(self):
+        path = os.path.join(self.tmpdir, "stats")
+        xenmon.forward_stats(path)
+
+        collector = xenmon.FleetCollector([path])
+        try:
+            collector.poll(0)
+        finally:
+            collector.close()
+        host = collector.hosts["host1"]
+        self.assertEqual(host.seq, 19)
+        self.assertTrue(host.synced)
+        self.assertEqual(sorted(host.doms), [xenmon.IDLE_DOMAIN, 0, 7])
+
+    def test_no_collector(self):
+        attempts = []
+        class Socket(socket.socket):
+            def connect(self, addr):
+                attempts.append(addr)
+                return socket._socketobject.connect(self, addr)
+        socket.socket = Socket
+
+        path = os.path.join(self.tmpdir, "collector")
+        xenmon.forward_stats("unix:" + path)
+
+        # no file in the way of the collector, and fewer attempts as time
+        # goes on: at 0, 1, 3, 7 and 15s
+        self.assertFalse(os.path.exists(path))
+        self.assertEqual(attempts, [path] * 5)
+
+    def test_socket(self):
+        path = os.path.join(self.tmpdir, "collector")
+        collector = xenmon.FleetCollector(["unix:" + path])
+        try:
+            xenmon.options.duration = 2
+            xenmon.forward_stats("unix:" + path)
+            collector.poll(0.1)
+        finally:
+            collector.close()
+        self.assertFalse(os.path.exists(path))
+
+        host = collector.hosts["host1"]
+        self.assertEqual(host.seq, 1)
+        self.assertEqual(host.time, 1.0)
+        self.assertEqual(sorted(host.doms), [xenmon.IDLE_DOMAIN, 0, 7])
+
+    def test_address(self):
+        self.assertEqual(xenmon.fleet_address("unix:/run/x"),
+                         ("unix", "/run/x"))
+        self.assertEqual(xenmon.fleet_address("/run/x"), ("file", "/run/x"))
+
+class TestHostTotals(XenmonTestCase):
+
+    def host_region(self):
+        return make_region(3, 40, 2, 15, host_sample,
+                           [(xenmon.IDLE_DOMAIN, "Idle"), (0, "Domain-0"),
+                            (7, "guest")])
+
+    def test_totals(self):
+        (region, slen) = self.host_region()
+        (h1, h2, lost, usage) = xenmon.host_totals(region, 2, slen)
+
+        # 10 samples of both cpus over the last second, all 29 a window
+        # holds over 10 seconds
+        for (h, nr, passed) in ((h1, 10, 1 + 10 * 10**8),
+                                (h2, 29, 1 + 29 * 10**8)):
+            self.assertEqual(sorted(h), [xenmon.IDLE_DOMAIN, 0, 7])
+            for (slot, domid) in enumerate([xenmon.IDLE_DOMAIN, 0, 7]):
+                gotten = nr * (HOST_GOTTEN[0][slot] + HOST_GOTTEN[1][slot])
+                self.assertAlmostEqual(h[domid][0][0],
+                                       gotten / (passed / 1e9))
+                # percentages are of one cpu
+                self.assertAlmostEqual(h[domid][0][1],
+                                       100.0 * gotten / passed)
+                self.assertAlmostEqual(h[domid][0][2], gotten / (nr * 20.0))
+                self.assertAlmostEqual(h[domid][3][1],
+                                       50.0 * gotten / passed)
+                self.assertAlmostEqual(h[domid][4], nr * 20 / (passed / 1e9))
+
+        self.assertAlmostEqual(h1[0][0][1], 40.0, 5)
+        self.assertAlmostEqual(h1[7][0][1], 80.0, 5)
+        self.assertEqual([l[1] for l in lost[0]], [10, 20])
+        self.assertEqual([l[1] for l in lost[1]], [29, 58])
+
+        # how busy each cpu was, idle aside
+        self.assertEqual(len(usage), 2)
+        self.assertAlmostEqual(usage[0], 30.0, 5)
+        self.assertAlmostEqual(usage[1], 90.0, 5)
+
+    def test_heat_strip(self):
+        self.assertEqual(xenmon.heat_char(0), " ")
+        self.assertEqual(xenmon.heat_char(30.0), "-")
+        self.assertEqual(xenmon.heat_char(90.0), "%")
+        self.assertEqual(xenmon.heat_char(100.0), "@")
+        self.assertEqual(xenmon.heat_char(250.0), "@")
+
+        (region, slen) = self.host_region()
+        (xenmon.options, args) = xenmon.setup_cmdline_parser().parse_args(
+            [])
+        scr = FakeScreen()
+        xenmon.display_allcpus(scr, region, 2, slen, 100, 1)
+        self.assertTrue("Last 10 seconds (60.00%)" in scr.text(0))
+        self.assertTrue("Last 1 second (60.00%)" in scr.text(0))
+        self.assertEqual(scr.text(1), " Load  -%")
+
+class TestRollingStats(XenmonTestCase):
+
+    def setUp(self):
+        XenmonTestCase.setUp(self)
+        xenmon.set_layout(2, 20)
+        self.samples = [[0] * (6 * 2 + 4) for k in range(20)]
+        self.next = 0
+
+    # have xenbaked write the sample of a whole bucket, n, in which domain
+    # 0 gets half the cpu and domain 7, while in use, a fifth of it
+    def feed(self, rolling, n, in_use):
+        gotten = [25 * 10**8, in_use[1] and 10**9 or 0]
+        self.samples[self.next] = (gotten + [0, 0] +
+                                   [g / 2 for g in gotten] + [10**8] * 2 +
+                                   [10, 5] + [20, 10] +
+                                   [5 * 10**9, (n + 1) * 10**9, 0, 0])
+        self.next = (self.next + 1) % 20
+        rolling.take_samples(0, self.samples, in_use, [0, 7], self.next,
+                             now = n * xenmon.ROLLING_BUCKET + 1)
+
+    def assertStats(self, stats, expected):
+        self.assertEqual(len(stats), len(expected))
+        for (got, want) in zip(stats, expected):
+            for (g, w) in zip(got, want):
+                self.assertAlmostEqual(g, w)
+
+    def test_windows(self):
+        rolling = xenmon.RollingStats()
+        for n in range(12):
+            self.feed(rolling, n, [1, 1])
+        self.assertEqual(rolling.domains(), [(0, 0), (0, 7)])
+
+        # a minute of buckets, the same over every window
+        for cpu in (0, None):
+            self.assertStats(rolling.stats(cpu, 0),
+                             [[50.0, 2.0, 25.0, 2.0, 4.0]] * 3)
+            self.assertStats(rolling.stats(cpu, 7),
+                             [[20.0, 2.0, 10.0, 1.0, 2.0]] * 3)
+
+        # domain 7 is destroyed, and out of the last minute after another
+        for n in range(12, 24):
+            self.feed(rolling, n, [1, 0])
+        self.assertStats(rolling.stats(0, 0),
+                         [[50.0, 2.0, 25.0, 2.0, 4.0]] * 3)
+        self.assertStats(rolling.stats(0, 7),
+                         [[0.0] * 5] + [[10.0, 1.0, 5.0, 0.5, 1.0]] * 2)
+        self.assertFalse((0, 7) in rolling.totals[0])
+        self.assertFalse((None, 7) in rolling.totals[0])
+
+        # then out of the 5 and 15 minutes, as its last bucket leaves them
+        for n in range(24, 72):
+            self.feed(rolling, n, [1, 0])
+        self.assertStats(rolling.stats(0, 7)[1:],
+                         [[0.0] * 5, [20.0 / 6, 2.0 / 6, 10.0 / 6,
+                                      1.0 / 6, 2.0 / 6]])
+        self.assertEqual(rolling.domains(), [(0, 0), (0, 7)])
+        for n in range(72, 192):
+            self.feed(rolling, n, [1, 0])
+        self.assertEqual(rolling.domains(), [(0, 0)])
+        for totals in rolling.totals:
+            self.assertEqual(sorted(totals),
+                             [(None, None), (None, 0), (0, None), (0, 0)])
+
+    def test_gap(self):
+        rolling = xenmon.RollingStats()
+        for n in range(12):
+            self.feed(rolling, n, [1, 1])
+
+        # nothing taken in for longer than the longest window starts over
+        self.feed(rolling, 12 + 180, [1, 0])
+        self.assertEqual(rolling.domains(), [(0, 0)])
+        self.assertStats(rolling.stats(None, 0),
+                         [[50.0, 2.0, 25.0, 2.0, 4.0]] * 3)
+
+class TestLatencyHistogram(XenmonTestCase):
+
+    def bucket(self, ns):
+        hist = xenmon.LatencyHistogram()
+        hist.add(ns)
+        return hist.buckets.index(1)
+
+    def test_buckets(self):
+        self.assertEqual(xenmon.HIST_BUCKETS, 160)
+        self.assertEqual(self.bucket(0), 0)
+        self.assertEqual(self.bucket(0.5), 0)
+        self.assertEqual(self.bucket(1), 0)
+        hist = xenmon.LatencyHistogram()
+        self.assertEqual(hist.bound(0), 1.25)
+
+        # each power of two starts the first of its 4 buckets, whose
+        # bounds split it evenly; the ns before it end the previous one
+        for shift in (3, 10, 20, 39):
+            edge = 2**shift
+            idx = self.bucket(edge)
+            self.assertEqual(idx, 4 * shift)
+            self.assertEqual(self.bucket(edge - 1), idx - 1)
+            self.assertEqual(hist.bound(idx - 1), edge)
+            self.assertEqual([hist.bound(idx + sub) for sub in range(4)],
+                             [edge * 1.25, edge * 1.5, edge * 1.75, edge * 2])
+            self.assertEqual(self.bucket(edge * 1.25), idx + 1)
+            self.assertEqual(self.bucket(edge * 1.25 - 1), idx)
+
+        # past the last power of two, everything is in the last bucket
+        self.assertEqual(self.bucket(2**40 - 1), 159)
+        self.assertEqual(self.bucket(2**40), 159)
+        self.assertEqual(self.bucket(2**50), 159)
+
+    def test_percentiles(self):
+        hist = xenmon.LatencyHistogram()
+        self.assertEqual(hist.summary(), [0, 0, 0, 0])
+
+        # 1 to 100us: the 50th is in [2**15 * 1.5, 2**15 * 1.75), the
+        # 95th in [2**16 * 1.25, 2**16 * 1.5) and the 99th in a bucket
+        # whose bound is over the maximum
+        for us in range(1, 101):
+            hist.add(us * 1000)
+        self.assertEqual(hist.count, 100)
+        self.assertEqual(hist.percentile(50), 2**15 * 1.75)
+        self.assertEqual(hist.percentile(99), 100000)
+        self.assertEqual(hist.summary(), [2**15 * 1.75, 2**16 * 1.5, 100000,
+                                          100000])
+
+        # a long tail only shows past the percentiles it is in
+        hist = xenmon.LatencyHistogram()
+        for n in range(98):
+            hist.add(1000)
+        hist.add(50000)
+        hist.add(10**6)
+        self.assertEqual(hist.percentile(50), 1024)
+        self.assertEqual(hist.percentile(98), 1024)
+        self.assertEqual(hist.percentile(99), 2**15 * 1.75)
+        self.assertEqual(hist.percentile(100), 10**6)
+
+        # the last bucket has no bound, so is as far as the maximum
+        hist = xenmon.LatencyHistogram()
+        hist.add(2**42)
+        hist.add(2**41)
+        self.assertEqual(hist.summary(), [2**42] * 4)
+
+    def test_window(self):
+        # one domain, waiting 2us per execution and blocking 10us per io
+        # in each sample but every third, in which it does neither
+        xenmon.set_layout(1, 20)
+        xenmon.dom_in_use = [1]
+        samples = []
+        for k in range(20):
+            (excount, iocount) = k % 3 and (k, 2 * k) or (0, 0)
+            samples.append([10**7, 0, 2000 * excount, 10000 * iocount,
+                            excount, iocount, 10**8, (k + 1) * 10**8, 0, 0])
+        # of samples 14 to 11, those but 12
+        [(waited, blocked)] = xenmon.sample_window(15, samples).histograms(
+            10**9)
+        self.assertEqual(waited.count, 3)
+        self.assertEqual(blocked.count, 3)
+        self.assertEqual(waited.max, 2000)
+        self.assertEqual(blocked.max, 10000)
+
+        xenmon.dom_in_use = [0]
+        self.assertEqual(xenmon.sample_window(15, samples).histograms(10**9),
+                         [None])
+
+class TestFrame(XenmonTestCase):
+
+    def paint(self, frame, rows):
+        for (row, cells) in rows.items():
+            for (col, str) in cells:
+                frame.addstr(row, col, str)
+        frame.scr.painted = []
+        frame.scr.cleared = []
+        return frame.flush()
+
+    def test_changed_rows(self):
+        scr = FakeScreen(5, 20)
+        frame = xenmon.Frame(scr)
+        rows = {0: [(0, "header")], 1: [(1, "dom 0"), (10, "50%")],
+                2: [(1, "dom 7")]}
+
+        self.assertEqual(self.paint(frame, rows), (3, 19))
+        self.assertEqual(scr.cleared, [0, 1, 2])
+        self.assertEqual(sorted(set(scr.painted)), [0, 1, 2])
+        self.assertEqual(scr.text(1), " dom 0    50%")
+
+        # nothing changed, nothing painted
+        self.assertEqual(self.paint(frame, rows), (0, 0))
+        self.assertEqual(scr.painted, [])
+        self.assertEqual(scr.cleared, [])
+
+        # only the row changed
+        rows[1] = [(1, "dom 0"), (10, "75%")]
+        self.assertEqual(self.paint(frame, rows), (1, 8))
+        self.assertEqual(scr.cleared, [1])
+        self.assertEqual(scr.painted, [1, 1])
+        self.assertEqual(scr.text(1), " dom 0    75%")
+
+        # a row no longer written is cleared
+        del rows[2]
+        self.assertEqual(self.paint(frame, rows), (1, 0))
+        self.assertEqual(scr.cleared, [2])
+        self.assertEqual(scr.painted, [])
+        self.assertEqual(scr.text(2), "")
+
+    def test_spilling_rows(self):
+        scr = FakeScreen(5, 20)
+        frame = xenmon.Frame(scr)
+        rows = {1: [(15, "wraps around")], 2: [(0, "next")],
+                3: [(0, "after")]}
+        self.assertEqual(self.paint(frame, rows), (3, 21))
+
+        # the row it wraps into is painted over again with it
+        rows[1] = [(15, "wraps again!")]
+        self.assertEqual(self.paint(frame, rows), (2, 16))
+        self.assertEqual(scr.cleared, [1, 2])
+
+        # and the other way around
+        rows[2] = [(0, "later")]
+        self.assertEqual(self.paint(frame, rows), (2, 17))
+        self.assertEqual(scr.cleared, [1, 2])
+
+        # a row that stops wrapping still clears what it wrapped into
+        rows[1] = [(0, "short")]
+        self.assertEqual(self.paint(frame, rows), (2, 10))
+        self.assertEqual(scr.cleared, [1, 2])
+
+        # rows past the bottom of the screen are not cleared
+        rows[6] = [(0, "off screen")]
+        self.assertEqual(self.paint(frame, rows), (1, 10))
+        self.assertEqual(scr.cleared, [])
+        self.assertEqual(scr.painted, [6])
+
+    def test_refresh_delay(self):
+        # nothing but the heartbeat changing doubles the delay, up to
+        # the maximum
+        self.assertEqual(xenmon.refresh_delay(1000, 1, 1), 2000)
+        self.assertEqual(xenmon.refresh_delay(2000, 0, 0), 4000)
+        self.assertEqual(xenmon.refresh_delay(5000, 1, 1), 8000)
+        self.assertEqual(xenmon.refresh_delay(8000, 1, 1), 8000)
+
+        # otherwise it is back to the minimum, or as long as the
+        # characters painted take to send
+        self.assertEqual(xenmon.refresh_delay(8000, 2, 100), 1000)
+        self.assertEqual(xenmon.refresh_delay(1000, 40, 8192), 1000)
+        self.assertEqual(xenmon.refresh_delay(1000, 40, 4 * 8192), 4000)
+        self.assertEqual(xenmon.refresh_delay(1000, 40, 20 * 8192), 8000)
+
+# an alert engine noting what it reports, instead of logging it
+class RecordingAlerts(xenmon.AlertEngine):
+    def __init__(self, rules):
+        xenmon.AlertEngine.__init__(self, rules)
+        self.reported = []
+
+    def notify(self, rule, cpu, domid, value, raised):
+        self.reported.append((cpu, domid, value, raised))
+
+# domain stats as summarize gives them, with the given cpu% and waited%
+def alert_stats(cpu, waited):
+    return [[0, cpu, 0], 0, [0, 0, 0], [0, waited, 0], 0, [0, 0]]
+
+class TestAlerts(XenmonTestCase):
+
+    def test_rules(self):
+        rule = xenmon.AlertRule("waited% > 30 for 10s")
+        self.assertEqual(rule.text, "waited% > 30 for 10s")
+        self.assertEqual((rule.metric, rule.threshold, rule.hold),
+                         ("waited%", 30.0, 10.0))
+        self.assertEqual((rule.domid, rule.cpu), (None, None))
+        self.assertEqual(rule.value_of(alert_stats(10, 42)), 42)
+        self.assertTrue(rule.holds(30.5))
+        self.assertFalse(rule.holds(30))
+
+        rule = xenmon.AlertRule("dom 7 cpu 1: cpu% <= 5.5 for 2")
+        self.assertEqual((rule.domid, rule.cpu), (7, 1))
+        self.assertEqual((rule.metric, rule.threshold, rule.hold),
+                         ("cpu%", 5.5, 2.0))
+        self.assertTrue(rule.holds(5.5))
+
+        rule = xenmon.AlertRule("cpu 0: busy%>=90")
+        self.assertEqual((rule.domid, rule.cpu), (None, 0))
+        self.assertEqual((rule.metric, rule.threshold, rule.hold),
+                         ("busy%", 90.0, 0.0))
+
+        rule = xenmon.AlertRule("dom idle: cpu% < 10")
+        self.assertEqual(rule.domid, xenmon.IDLE_DOMAIN)
+
+    def test_bad_rules(self):
+        for (text, error) in [
+                ("waited% >", "invalid alert rule"),
+                ("waited% ~ 30", "invalid alert rule"),
+                ("waited% > 30 for", "invalid alert rule"),
+                ("dom: waited% > 30", "invalid alert rule"),
+                ("dom x: waited% > 30", "invalid scope 'dom x'"),
+                ("vcpu 1: waited% > 30", "invalid scope 'vcpu 1'"),
+                ("latency > 30", "unknown metric 'latency'"),
+                ("dom 0: lost > 1", "'lost' is not a domain metric"),
+                ("waited% > lots", "invalid number"),
+                ("waited% > 30 for ever", "invalid number")]:
+            try:
+                xenmon.AlertRule(text)
+            except ValueError, e:
+                self.assertTrue(error in str(e), "%s: %s" % (text, e))
+                self.assertTrue(text in str(e), "%s: %s" % (text, e))
+            else:
+                self.fail("'%s' parsed" % text)
+
+    def test_hysteresis(self):
+        xenmon.set_layout(3, 20)
+        xenmon.dom_in_use = [1, 1, 1]
+        domain_id = [xenmon.IDLE_DOMAIN, 0, 7]
+        alerts = RecordingAlerts([xenmon.AlertRule("waited% > 30 for 10s")])
+
+        def check(now, cpu, waited):
+            alerts.check(cpu, domain_id,
+                         [alert_stats(0, w) for w in waited], [0, 0, 0], now)
+
+        # raised once the rule held for 10s, on the domain it held for
+        check(0, 0, [90, 40, 10])
+        check(5, 0, [90, 40, 10])
+        self.assertEqual(alerts.reported, [])
+        check(10, 0, [90, 40, 10])
+        self.assertEqual(alerts.reported, [(0, 0, 40, True)])
+
+        # and not again while it goes on holding, nor on another cpu yet
+        check(10, 1, [90, 50, 50])
+        check(20, 0, [90, 45, 10])
+        check(30, 0, [90, 45, 10])
+        self.assertEqual(alerts.reported, [(0, 0, 40, True)])
+
+        # cleared after no longer holding for as long, but not before
+        check(31, 0, [90, 20, 10])
+        check(35, 0, [90, 50, 10])
+        check(36, 0, [90, 20, 10])
+        check(45, 0, [90, 20, 10])
+        self.assertEqual(alerts.reported, [(0, 0, 40, True)])
+        check(46, 0, [90, 20, 10])
+        self.assertEqual(alerts.reported, [(0, 0, 40, True),
+                                           (0, 0, 20, False)])
+        check(60, 0, [90, 20, 10])
+
+        # the other cpu's have their own state
+        check(20, 1, [90, 50, 50])
+        self.assertEqual(alerts.reported[2:], [(1, 0, 50, True),
+                                               (1, 7, 50, True)])
+
+    def test_scopes(self):
+        xenmon.set_layout(3, 20)
+        xenmon.dom_in_use = [1, 1, 1]
+        domain_id = [xenmon.IDLE_DOMAIN, 0, 7]
+        alerts = RecordingAlerts([xenmon.AlertRule("dom 7: cpu% > 10"),
+                                  xenmon.AlertRule("cpu 1: busy% > 50"),
+                                  xenmon.AlertRule("lost > 5")])
+        for cpu in (0, 1):
+            alerts.check(cpu, domain_id,
+                         [alert_stats(c, 0) for c in (90, 30, 40)],
+                         [0, 3 + 3 * cpu, 0], 0)
+        self.assertEqual(alerts.reported, [(0, 7, 40, True),
+                                           (1, 7, 40, True),
+                                           (1, None, 70, True),
+                                           (1, None, 6, True)])
+
+# stands in for the xenstore bindings, knowing the names of some domains
+class FakeXenstore:
+    class Error(Exception):
+        pass
+
+    def __init__(self, names):
+        self.names = names
+        self.reads = []
+
+    def xs(self):
+        return self
+
+    def read(self, transaction, path):
+        self.reads.append(path)
+        domid = int(path.split("/")[3])
+        if domid not in self.names:
+            raise self.Error(2, "No such file or directory")
+        return self.names[domid]
+
+# the domain slots of the top view: idle, then domains 0, 3, 7 and 9,
+# getting and waiting for the cpu for so many ns of each 100ms sample
+TOP_DOMS = [(xenmon.IDLE_DOMAIN, "Idle"), (0, "Domain-0"), (3, "web"),
+            (7, "guest"), (9, "")]
+TOP_GOTTEN = [10**7, 2 * 10**7, 4 * 10**7, 2 * 10**7, 10**7]
+TOP_WAITED = [0, 5 * 10**6, 10**6, 9 * 10**6, 3 * 10**6]
+
+def top_sample(cpu, k):
+    return (TOP_GOTTEN + [0] * 5 + TOP_WAITED + [0] * 15 +
+            [10**8, (k + 1) * 10**8, 0, 0])
+
+class TestTop(XenmonTestCase):
+
+    def setUp(self):
+        XenmonTestCase.setUp(self)
+        self.xs = xenmon._xs
+
+    def tearDown(self):
+        xenmon._xs = self.xs
+        XenmonTestCase.tearDown(self)
+
+    def top(self, sortby, top, names):
+        (region, slen) = make_region(5, 20, 2, 5, top_sample, TOP_DOMS)
+        scr = FakeScreen()
+        xenmon.display_top(scr, region, 2, slen, 100, 40, 1, sortby, top,
+                           names)
+        return scr
+
+    def test_ranking(self):
+        xenmon._xs = FakeXenstore({0: "Domain-0", 3: "web", 7: "guest",
+                                   9: "batch"})
+        names = xenmon.DomainNames()
+
+        # domains 0 and 7 tie, and go by domain id
+        scr = self.top("gotten", 3, names)
+        self.assertTrue("Domains by Gotten% over the last 10 seconds (3 of 4)"
+                        in scr.text(0))
+        self.assertEqual([scr.text(row)[2:32].split() for row in (3, 4, 5)],
+                         [["web", "3"], ["Domain-0", "0"], ["guest", "7"]])
+        self.assertEqual(scr.text(6), " *")
+
+        scr = self.top("waited", 0, names)
+        self.assertTrue("(4 of 4)" in scr.text(0))
+        self.assertEqual([scr.text(row)[2:32].split()
+                          for row in (3, 4, 5, 6)],
+                         [["guest", "7"], ["Domain-0", "0"], ["batch", "9"],
+                          ["web", "3"]])
+        self.assertEqual(scr.text(3)[33:].split()[:2], ["40.00%", "18.00%"])
+
+        # each name is only read once
+        self.assertEqual(sorted(xenmon._xs.reads),
+                         ["/local/domain/%d/name" % domid
+                          for domid in (0, 3, 7, 9)])
+
+    def test_names(self):
+        (region, slen) = make_region(5, 20, 2, 5, top_sample, TOP_DOMS)
+
+        # names xenstore has not are those of xenbaked, if it has any
+        xenmon._xs = FakeXenstore({0: "Domain-0", 3: "www"})
+        names = xenmon.DomainNames()
+        self.assertEqual(names.missing([xenmon.IDLE_DOMAIN, 0, 3, 42]),
+                         [0, 3, 42])
+        names.update([0, 3, 7, 42], region, 2, slen)
+        self.assertEqual([names[domid] for domid in (0, 3, 7, 42)],
+                         ["Domain-0", "www", "guest", "Domain#42"])
+        self.assertEqual(names.missing([xenmon.IDLE_DOMAIN, 0, 3, 42]), [])
+
+        # without xenstore, they are all xenbaked's
+        xenmon._xs = None
+        names = xenmon.DomainNames()
+        names.update([0, 3, 9, 42], region, 2, slen)
+        self.assertEqual([names[domid] for domid in (0, 3, 9, 42)],
+                         ["Domain-0", "web", "Domain#9", "Domain#42"])
+
+        # nor if xenstore cannot be reached
+        class Unreachable(FakeXenstore):
+            def xs(self):
+                raise self.Error(13, "Permission denied")
+        xenmon._xs = Unreachable({0: "Domain-0"})
+        names = xenmon.DomainNames()
+        self.assertEqual(names.xs, None)
+        names.update([0], region, 2, slen)
+        self.assertEqual(names[0], "Domain-0")
+        self.assertEqual(xenmon._xs.reads, [])
+
+class TestDiagnostics(XenmonTestCase):
+
+    def test_diagnostics(self):
+        # 100ms samples taken at jittered times, sample k losing k % 4
+        # records and with k flip free periods, and 11 never written; what
+        # the domain got, waited and blocked plays no part
+        xenmon.set_layout(1, 20)
+        xenmon.dom_in_use = [1]
+        samples = []
+        for k in range(20):
+            stamp = k * 10**8 + (k % 2) * 10**7
+            samples.append([6 * 10**7, 0, 2 * 10**7, 10**7, 10, 5,
+                            10**8, k != 11 and stamp, k % 4, k])
+        window = xenmon.sample_window(15, samples)
+        self.assertEqual(window.order, [14, 13, 12, 11])
+
+        # samples 14 to 12: 90ms then 110ms apart
+        [lost, lost_rate, lost_max, ffp, ffp_max,
+         mean, stddev, low, high] = xenmon.cpu_diagnostics(window,
+                                                           250 * 10**6)
+        self.assertEqual([lost, lost_max, ffp, ffp_max], [3, 2, 39, 14])
+        self.assertAlmostEqual(lost_rate, 3 / ((1 + 3 * 10**8) / 1e9))
+        self.assertAlmostEqual(mean, 100.0)
+        self.assertAlmostEqual(stddev, 10.0)
+        self.assertAlmostEqual(low, 90.0)
+        self.assertAlmostEqual(high, 110.0)
+
+        # sample 11 too, whose time never was
+        d = xenmon.cpu_diagnostics(window, 10 * 10**9)
+        self.assertEqual(d[0:1] + d[2:5], [6, 3, 50, 14])
+        self.assertAlmostEqual(d[1], 6 / ((1 + 4 * 10**8) / 1e9))
+        self.assertEqual(len(window.intervals(10 * 10**9)), 2)
+        self.assertAlmostEqual(d[5], 100.0)
+
+        # a single sample has no interval
+        d = xenmon.cpu_diagnostics(window, 50 * 10**6)
+        self.assertEqual(d[0:1] + d[2:5], [2, 2, 14, 14])
+        self.assertEqual(d[5:], [0, 0, 0, 0])
+        self.assertEqual(xenmon.DIAG_COLUMNS[5:],
+                         ["interval(mean)", "interval(stddev)",
+                          "interval(min)", "interval(max)"])
+
+
+def test_suite():
+    suite = unittest.TestSuite()
+
+    suite.addTest(unittest.makeSuite(TestSampleWindow))
+    suite.addTest(unittest.makeSuite(TestLayout))
+    suite.addTest(unittest.makeSuite(TestHostTotals))
+    suite.addTest(unittest.makeSuite(TestRollingStats))
+    suite.addTest(unittest.makeSuite(TestLatencyHistogram))
+    suite.addTest(unittest.makeSuite(TestFrame))
+    suite.addTest(unittest.makeSuite(TestAlerts))
+    suite.addTest(unittest.makeSuite(TestTop))
+    suite.addTest(unittest.makeSuite(TestDiagnostics))
+    suite.addTest(unittest.makeSuite(TestRecording))
+    suite.addTest(unittest.makeSuite(TestLogs))
+    suite.addTest(unittest.makeSuite(TestMetrics))
+    suite.addTest(unittest.makeSuite(TestFleet))
+    suite.addTest(unittest.makeSuite(TestForward))
+
+    return suite
+
+if __name__ == "__main__":
+    unittest.main()
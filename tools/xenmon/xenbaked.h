@@ -37,11 +37,18 @@
 #define MAX_NAME_SIZE 32
 #define IDLE_DOMAIN_ID 32767
 
-/* Number of domains we can keep track of in memory */
+/*
+ * Number of domains we can keep track of in memory.  May be overridden at
+ * build time (e.g. -DNDOMAINS=1024); xenmon detects the resulting layout.
+ */
+#ifndef NDOMAINS
 #define NDOMAINS 32
+#endif
 
-/* Number of data points to keep */
+/* Number of data points to keep (xenmon needs --nsamples if changed) */
+#ifndef NSAMPLES
 #define NSAMPLES 100
+#endif
 
 #define ID(X) ((X>NDOMAINS-1)?(NDOMAINS-1):X)
 #define DEFAULT_TBUF_SIZE 20
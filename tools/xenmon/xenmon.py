@@ -31,18 +31,60 @@ import optparse as _o
 import curses as _c
 import math
 import sys
+import csv
+import threading
+import BaseHTTPServer
+import gzip
+import re
+import subprocess
+import syslog
+import heapq
+import json
+import socket
+import select
+import stat
+from bisect import bisect_left
+from operator import add, sub, itemgetter
+
+# domain names come from xenstore when its python bindings are available,
+# and otherwise from the names xenbaked makes up
+try:
+    from xen.lowlevel import xs as _xs
+except ImportError:
+    _xs = None
 
 # constants
-NSAMPLES = 100
-NDOMAINS = 32
+NSAMPLES = 100   # default number of samples kept by xenbaked
+NDOMAINS = 32    # default number of domain slots in xenbaked
 IDLE_DOMAIN = -1 # idle domain's ID
 
 # the struct strings for qos_info
 ST_DOM_INFO = "6Q3i2H32s"
-ST_QDATA = "%dQ" % (6*NDOMAINS + 4)
+DOM_INFO_FIELDS = 12
+dom_info_struct = struct.Struct(ST_DOM_INFO)
+trailer_struct = struct.Struct("4i")
 
-# size of mmaped file
-QOS_DATA_SIZE = struct.calcsize(ST_QDATA)*NSAMPLES + struct.calcsize(ST_DOM_INFO)*NDOMAINS + struct.calcsize("4i")
+# xenbaked may be built with other values of NDOMAINS and NSAMPLES, which
+# change the layout of its shared region; size everything to match it
+def set_layout(ndomains, nsamples):
+    global NDOMAINS, NSAMPLES, ST_QDATA, QOS_DATA_SIZE
+    global QDATA_WORDS, cpu_data_struct, TRAILER_OFFSET
+
+    NDOMAINS = ndomains
+    NSAMPLES = nsamples
+    ST_QDATA = "%dQ" % (6*NDOMAINS + 4)
+
+    # size of mmaped file
+    QOS_DATA_SIZE = struct.calcsize(ST_QDATA)*NSAMPLES + struct.calcsize(ST_DOM_INFO)*NDOMAINS + trailer_struct.size
+
+    # precompiled decoder for the data xenbaked keeps for each cpu: the whole
+    # block (samples, then domain info, then the 4i trailer) is unpacked at once
+    QDATA_WORDS = 6*NDOMAINS + 4
+    cpu_data_struct = struct.Struct("%dQ" % (QDATA_WORDS*NSAMPLES) +
+                                    ST_DOM_INFO*NDOMAINS + "4i")
+    TRAILER_OFFSET = QOS_DATA_SIZE - trailer_struct.size
+
+set_layout(NDOMAINS, NSAMPLES)
 
 # location of mmaped file, hard coded right now
 SHM_FILE = "/var/run/xenq-shm"
@@ -59,6 +101,8 @@ EXCOUNT = "Exec Count"
 
 # globals
 dom_in_use = []
+rolling = None         # RollingStats, with --rolling
+alerts = None           # AlertEngine, with --alert
 
 # our curses screen
 stdscr = None
@@ -87,6 +131,56 @@ def setup_cmdline_parser():
             help = "determines how many ms worth of data goes in a sample")
     parser.add_option("--cpu", dest="cpu", action="store", type="int", default=0,
             help = "specifies which cpu to display data for")
+    parser.add_option("--allcpus", dest="allcpus", action="store_true",
+            default=False, help = "show totals across all cpus in live mode; toggle with 'a'")
+    parser.add_option("--logformat", dest="logformat", type="choice",
+            choices=["text", "binary"], default="text",
+            help="format of the logs: a text file per domain (default), or one binary file, PREFIX.xmlog")
+    parser.add_option("--fsync", dest="fsync", action="store", type="int", default=0,
+            help="with binary logs, fsync the log file at most this often (in seconds). 0 never syncs (default)")
+    parser.add_option("--convert", dest="convert", metavar="FILE",
+            help="convert the binary log FILE to csv on stdout, and exit")
+    parser.add_option("--rolling", dest="rolling", action="store_true",
+            default=False, help="keep 1, 5 and 15 minute rolling stats; shown in live mode on wide enough screens, written to PREFIX-rolling.log in log mode")
+    parser.add_option("--export", dest="export", metavar="[HOST:]PORT",
+            help="instead of live monitoring or logging, serve metrics over http on PORT (of HOST, default 127.0.0.1), refreshed every --interval")
+    parser.add_option("--shm-file", dest="shm_file", metavar="FILE",
+            help="read xenbaked's data from FILE rather than %s; xenbaked is then not started" % SHM_FILE)
+    parser.add_option("--ndomains", dest="ndomains", action="store", type="int",
+            default=None, help = "number of domain slots xenbaked was built with (NDOMAINS; detected by default from the size of its data, given --nsamples)")
+    parser.add_option("--nsamples", dest="nsamples", action="store", type="int",
+            default=None, help = "number of samples xenbaked was built to keep (NSAMPLES; default %d). This cannot be detected, so must be given for a xenbaked built with another NSAMPLES" % NSAMPLES)
+    parser.add_option("--latency", dest="latency", action="store_true",
+            default=False, help="keep histograms of the wait per execution and block per io of each sample; shown in live mode (toggle with 'l'), written to PREFIX-latency.log in log mode")
+    parser.add_option("--alert", dest="alerts", action="append", default=[],
+            metavar="RULE", help="in log mode, raise an alert when RULE holds, e.g. 'waited% > 30 for 10' or 'dom 3: cpu% > 90'. May be given more than once")
+    parser.add_option("--alert-file", dest="alert_file", metavar="FILE",
+            help="read alert rules from FILE, one per line")
+    parser.add_option("--alert-hook", dest="alert_hook", metavar="CMD",
+            help="run CMD for every alert raised or cleared, rather than logging it to syslog")
+    parser.add_option("--forward", dest="forward", metavar="DEST",
+            help="instead of live monitoring or logging, send this host's domain stats every --interval for --time seconds to DEST: unix:PATH for the socket of a collector, retried until it listens, or else a file they are appended to")
+    parser.add_option("--host", dest="host", default=os.uname()[1],
+            help="with --forward, the name of this host (default %default)")
+    parser.add_option("--collect", dest="collect", action="append", default=[],
+            metavar="SOURCE", help="show (or with -n, log) the stats forwarded by many hosts: SOURCE is unix:PATH for a socket to listen on for forwarders, or else a file of forwarded stats. May be given more than once")
+    parser.add_option("--record", dest="record", metavar="FILE",
+            help="instead of live monitoring or logging, record snapshots of xenbaked's data to FILE every --interval for --time seconds")
+    parser.add_option("--replay", dest="replay", metavar="FILE",
+            help="read the snapshots recorded in FILE rather than xenbaked's data; xenbaked is then not started")
+    parser.add_option("--speed", dest="speed", action="store", type="float",
+            default=1.0, help="with --replay, play the recording back this many times faster. 0 goes through it as fast as possible")
+    parser.add_option("--benchmark", dest="benchmark", action="store_true",
+            default=False, help="with --replay, time decoding and summarizing every snapshot of the recording, and exit")
+
+    parser.add_option("--diagnostics", dest="diagnostics", action="store_true",
+            default=False, help="show the records lost, flip free periods and sample interval of each cpu in live mode (toggle with 'd'); write them to PREFIX-diag.log in log mode")
+    parser.add_option("--top", dest="top", action="store", type="int",
+            default=None, help="in live mode, start in the top domains view (toggle with 't'), showing this many domains. 0 shows as many as fit (default)")
+    parser.add_option("--sort", dest="sort", type="choice",
+            choices=[col[0] for col in TOP_COLUMNS], default="gotten",
+            help="column the top domains view is sorted by: %s (default gotten); cycle with 's'" %
+            ", ".join([col[0] for col in TOP_COLUMNS]))
 
     parser.add_option("--allocated", dest="allocated", action="store_true",
                       default=False, help="Display allocated time for each domain")
@@ -176,56 +270,600 @@ class DomainInfo:
             avg = 0
         return [total/(float(passed)/10**9), avg]
 
+    # accumulate the sums of another DomainInfo, e.g. from another cpu
+    def add(self, other):
+        self.allocated_sum += other.allocated_sum
+        self.gotten_sum += other.gotten_sum
+        self.blocked_sum += other.blocked_sum
+        self.waited_sum += other.waited_sum
+        self.exec_count += other.exec_count
+        self.iocount_sum += other.iocount_sum
+
     def stats(self, passed):
         return [self.gotten_stats(passed), self.allocated_stats(passed), self.blocked_stats(passed), 
                 self.waited_stats(passed), self.ec_stats(passed), self.io_stats(passed)]
 
-# report values over desired interval
-def summarize(startat, endat, duration, samples):
-    dominfos = {}
-    for i in range(0, NDOMAINS):
-        dominfos[i] = DomainInfo()
-        
-    passed = 1              # to prevent zero division
-    curid = startat
-    numbuckets = 0
-    lost_samples = []
-    ffp_samples = []
-    
-    while passed < duration:
-        for i in range(0, NDOMAINS):
-            if dom_in_use[i]:
-                dominfos[i].gotten_sum += samples[curid][0*NDOMAINS + i]
-                dominfos[i].allocated_sum += samples[curid][1*NDOMAINS + i]
-                dominfos[i].waited_sum += samples[curid][2*NDOMAINS + i]
-                dominfos[i].blocked_sum += samples[curid][3*NDOMAINS + i]
-                dominfos[i].exec_count += samples[curid][4*NDOMAINS + i]
-                dominfos[i].iocount_sum += samples[curid][5*NDOMAINS + i]
-    
-        passed += samples[curid][6*NDOMAINS]
-        lost_samples.append(samples[curid][6*NDOMAINS + 2])
-        ffp_samples.append(samples[curid][6*NDOMAINS + 3])
+# read the number of cpus and the per-cpu stride of the shared region,
+# which xenbaked stores in the trailer of every cpu's data
+def read_cpu_layout(shm):
+    (next, ncpu, slen, freq) = trailer_struct.unpack_from(shm, TRAILER_OFFSET)
+    return (ncpu, slen)
+
+# work out the NDOMAINS and NSAMPLES of the running xenbaked: only with the
+# right ones does the trailer of the first cpu's data agree with the size
+# of the whole region (shm).  Returns (ndomains, nsamples), or None if
+# nothing fits.
+def detect_layout(shm, ndomains=None, nsamples=None):
+    filesize = len(shm)
+    if filesize == 0:
+        return None
+
+    if nsamples is None:
+        nsamples = NSAMPLES
+    if ndomains is None:
+        candidates = [NDOMAINS] + range(1, filesize / (48*nsamples) + 1)
+    else:
+        candidates = [ndomains]
+
+    layout = None
+    for ndoms in candidates:
+        size = (6*ndoms + 4)*8*nsamples + struct.calcsize(ST_DOM_INFO)*ndoms + trailer_struct.size
+        slen = (size + mmap.PAGESIZE - 1) & ~(mmap.PAGESIZE - 1)
+        if filesize % slen:
+            continue
+        (next, ncpu, structlen, freq) = trailer_struct.unpack_from(shm, size - trailer_struct.size)
+        if structlen == slen and ncpu * slen == filesize and 0 <= next < nsamples:
+            layout = (ndoms, nsamples)
+            break
 
-        numbuckets += 1
+    return layout
 
-        if curid > 0:
-            curid -= 1
-        else:
-            curid = NSAMPLES - 1
-        if curid == endat:
-            break
+# size everything for the shared region, or bail out if it can't be made sense of
+def setup_layout(shm, name):
+    layout = detect_layout(shm, options.ndomains, options.nsamples)
+    if layout is None:
+        print "Unable to work out the layout of %s;" % name
+        print "please give xenbaked's NDOMAINS and NSAMPLES with --ndomains and --nsamples."
+        sys.exit(1)
+    set_layout(*layout)
+
+# xenbaked's live shared region.  refresh() returns (shm, ncpu, slen) for
+# the region as it is now; time() and sleep() are those of the wall clock.
+class ShmSource:
+    def __init__(self, filename):
+        self.file = open(filename, "r+")
+        size = os.fstat(self.file.fileno()).st_size
+        if size == 0:
+            print "%s is empty; is xenbaked running?" % filename
+            sys.exit(1)
+        self.shm = mmap.mmap(self.file.fileno(), size)
+        setup_layout(self.shm, filename)
+
+    def refresh(self):
+        # xenbaked tells us how many cpu's it's got, so re-do
+        # the mmap if necessary to get multiple cpu data
+        (ncpu, slen) = read_cpu_layout(self.shm)
+        if ncpu*slen != len(self.shm):
+            self.shm.close()
+            self.shm = mmap.mmap(self.file.fileno(), ncpu*slen)
+        return (self.shm, ncpu, slen)
+
+    def time(self):
+        return time.time()
+
+    def sleep(self, secs):
+        time.sleep(secs)
+
+    def close(self):
+        self.shm.close()
+        self.file.close()
+
+# recordings of the shared region: a header, then gzipped snapshots, each
+# the time it was taken and the length of the region, then the region
+RECORD_MAGIC = "XENMONRC"
+RECORD_VERSION = 1
+record_header_struct = struct.Struct("<8sI")     # magic, version
+snapshot_struct = struct.Struct("<dI")           # time, length
+
+# take snapshots of the shared region every interval, for later replay
+def record_snapshots(filename):
+    source = ShmSource(SHM_FILE)
+    out = gzip.open(filename, "wb", 6)
+    out.write(record_header_struct.pack(RECORD_MAGIC, RECORD_VERSION))
+
+    start = time.time()
+    try:
+        while options.duration == 0 or time.time() - start < options.duration:
+            (shm, ncpu, slen) = source.refresh()
+            out.write(snapshot_struct.pack(time.time(), ncpu*slen))
+            out.write(shm[:ncpu*slen])
+            time.sleep(options.interval / 1000.0)
+    finally:
+        out.close()
+        source.close()
+
+# a recording played back in place of the live region.  Time runs at speed
+# times the wall clock, starting from the first snapshot; refresh() returns
+# the latest snapshot as of then, or None once the recording is over.  At
+# speed 0 every refresh moves on to the next snapshot, without sleeping.
+class ReplaySource:
+    def __init__(self, filename, speed=1.0):
+        self.file = gzip.open(filename, "rb")
+        header = self.file.read(record_header_struct.size)
+        if len(header) != record_header_struct.size or \
+           record_header_struct.unpack(header) != (RECORD_MAGIC, RECORD_VERSION):
+            print "%s is not a version %d xenmon recording" % (filename, RECORD_VERSION)
+            sys.exit(1)
+        self.name = filename
+        self.speed = speed
+        self.pending = self.read_snapshot()
+        if self.pending is None:
+            print "%s holds no snapshots" % filename
+            sys.exit(1)
+        self.current = None
+        self.start = self.pending[0]
+        self.wall_start = time.time()
+        setup_layout(self.pending[1], filename)
+
+    def read_snapshot(self):
+        header = self.file.read(snapshot_struct.size)
+        if len(header) < snapshot_struct.size:
+            return None
+        (when, length) = snapshot_struct.unpack(header)
+        data = self.file.read(length)
+        if len(data) < length:
+            return None
+        return (when, data)
+
+    def time(self):
+        if not self.speed:
+            return self.current and self.current[0] or self.start
+        return self.start + (time.time() - self.wall_start) * self.speed
+
+    def sleep(self, secs):
+        if self.speed:
+            time.sleep(secs / self.speed)
+
+    def refresh(self):
+        now = self.time()
+        taken = False
+        while self.pending and (not self.speed and not taken or
+                                self.pending[0] <= now):
+            self.current = self.pending
+            self.pending = self.read_snapshot()
+            taken = True
+        if not taken and self.pending is None:
+            return None
+        (ncpu, slen) = read_cpu_layout(self.current[1])
+        return (self.current[1], ncpu, slen)
+
+    def close(self):
+        self.file.close()
 
-    lostinfo = [min(lost_samples), sum(lost_samples), max(lost_samples)]
-    ffpinfo = [min(ffp_samples), sum(ffp_samples), max(ffp_samples)]
+# the region to read: the live one, or a recording with --replay
+def open_source():
+    if options.replay:
+        return ReplaySource(options.replay, options.speed)
+    return ShmSource(SHM_FILE)
 
-    ldoms = []
-    for x in range(0, NDOMAINS):
-        if dom_in_use[x]:
-            ldoms.append(dominfos[x].stats(passed))
+# time decoding and summarizing every cpu of every snapshot in a recording
+def benchmark(filename):
+    global dom_in_use
+
+    source = ReplaySource(filename, 0)
+    nsnapshots = ncpus = 0
+    decode = summary = 0.0
+    while True:
+        region = source.refresh()
+        if region is None:
+            break
+        (shm, ncpu, slen) = region
+        for cpuidx in range(0, ncpu):
+            t0 = time.time()
+            (samples, dom_in_use, domain_id, next) = \
+                read_cpu_data(shm, cpuidx, slen)
+            t1 = time.time()
+            window = sample_window(next, samples)
+            window.summarize(10**9)
+            window.summarize(10 * 10**9)
+            t2 = time.time()
+            decode += t1 - t0
+            summary += t2 - t1
+        nsnapshots += 1
+        ncpus += ncpu
+    source.close()
+
+    if not nsnapshots:
+        print "No snapshots in %s" % filename
+        return
+    print "%d snapshots, %d cpus, %d domain slots" % (nsnapshots, ncpus, NDOMAINS)
+    print "per snapshot: %.3f ms decoding, %.3f ms summarizing" % \
+          (1000 * decode / nsnapshots, 1000 * summary / nsnapshots)
+    print "per cpu:      %.3f ms decoding, %.3f ms summarizing" % \
+          (1000 * decode / ncpus, 1000 * summary / ncpus)
+
+# decode the samples and domain info of one cpu with a single unpack
+def read_cpu_data(shm, cpuidx, slen):
+    data = cpu_data_struct.unpack_from(shm, cpuidx * slen)
+
+    nwords = QDATA_WORDS*NSAMPLES
+    samples = [data[i:i+QDATA_WORDS] for i in xrange(0, nwords, QDATA_WORDS)]
+
+#   (last_update_time, start_time, runnable_start_time, blocked_start_time,
+#    ns_since_boot, ns_oncpu_since_boot, runnable_at_last_update,
+#    runnable, in_use, domid, junk, name) = dom
+    end = nwords + DOM_INFO_FIELDS*NDOMAINS
+    dom_in_use = list(data[nwords+8:end:DOM_INFO_FIELDS])
+    domain_id = []
+    for domid in data[nwords+9:end:DOM_INFO_FIELDS]:
+        if domid == 32767:
+            domid = IDLE_DOMAIN
+        domain_id.append(domid)
+
+    (next, ncpu, slen, freq) = data[end:]
+    return (samples, dom_in_use, domain_id, next)
+
+# the names xenbaked gives the domains in use on one cpu, by domain id
+def read_domain_names(shm, cpuidx, slen):
+    names = {}
+    base = cpuidx * slen + 8 * QDATA_WORDS * NSAMPLES
+    for dom in range(0, NDOMAINS):
+        info = dom_info_struct.unpack_from(shm, base + dom * dom_info_struct.size)
+        if info[8]:
+            domid = info[9]
+            if domid == 32767:
+                domid = IDLE_DOMAIN
+            names[domid] = info[11].split("\0", 1)[0]
+    return names
+
+# names of domains by id, from xenstore if it can be read and otherwise
+# from xenbaked.  Domain ids are not reused until they wrap, so each
+# domain's name is only looked up once.
+class DomainNames:
+    def __init__(self):
+        self.names = {IDLE_DOMAIN: "Idle"}
+        self.xs = None
+        if _xs:
+            try:
+                self.xs = _xs.xs()
+            except _xs.Error:
+                pass
+
+    def missing(self, domids):
+        return [domid for domid in domids if domid not in self.names]
+
+    # look up the names of domids, falling back on xenbaked's in shm
+    def update(self, domids, shm, ncpu, slen):
+        fallback = {}
+        for cpuidx in range(0, ncpu):
+            fallback.update(read_domain_names(shm, cpuidx, slen))
+        for domid in domids:
+            name = None
+            if self.xs:
+                try:
+                    name = self.xs.read("", "/local/domain/%d/name" % domid)
+                except _xs.Error:
+                    pass
+            self.names[domid] = name or fallback.get(domid) or "Domain#%d" % domid
+
+    def __getitem__(self, domid):
+        return self.names[domid]
+
+# running totals over the samples of one snapshot, walking back in time
+# from startat to (but excluding) endat.  Summaries over windows of any
+# duration are then a lookup of the totals at the right number of samples,
+# rather than a fresh pass over the samples each time.
+class SampleWindow:
+    def __init__(self, startat, endat, samples):
+        startat %= NSAMPLES
+        self.nr_samples = (startat - endat - 1) % NSAMPLES + 1
+        self.order = [(startat - k) % NSAMPLES for k in range(self.nr_samples)]
+        self.samples = samples
+
+        # only the columns of domains in use are totalled, followed by
+        # ns_passed, lost_records and flip_free_periods
+        self.doms = [i for i in range(0, NDOMAINS) if dom_in_use[i]]
+        cols = [m*NDOMAINS + i for m in range(0, 6) for i in self.doms]
+        cols += [6*NDOMAINS, 6*NDOMAINS + 2, 6*NDOMAINS + 3]
+        self.columns = itemgetter(*cols)
+        self.passed_col = 6*len(self.doms)
+
+        # index k holds the totals over the first k samples of the window
+        self.sums = [[0] * len(cols)]
+        self.passed = [1]           # to prevent zero division
+        self.lost_range = [(0, 0)]
+        self.ffp_range = [(0, 0)]
+
+    # take more samples into the totals, until duration has passed
+    def extend(self, duration):
+        sums, passed = self.sums, self.passed
+        col = self.passed_col
+        while passed[-1] < duration and len(sums) <= self.nr_samples:
+            sample = self.columns(self.samples[self.order[len(sums) - 1]])
+            total = map(add, sums[-1], sample)
+            sums.append(total)
+            passed.append(1 + total[col])
+
+            lost = sample[col + 1]
+            ffp = sample[col + 2]
+            if len(sums) == 2:
+                self.lost_range.append((lost, lost))
+                self.ffp_range.append((ffp, ffp))
+            else:
+                (lo, hi) = self.lost_range[-1]
+                self.lost_range.append((min(lo, lost), max(hi, lost)))
+                (lo, hi) = self.ffp_range[-1]
+                self.ffp_range.append((min(lo, ffp), max(hi, ffp)))
+
+    # raw totals over desired interval: a DomainInfo for each domain slot
+    # in use (None for the others), the time passed, and the lost records
+    # and ffp as [min, sum, max]
+    def totals(self, duration):
+        self.extend(duration)
+
+        # samples are taken for as long as less than duration has passed
+        numbuckets = bisect_left(self.passed, duration, 0, len(self.passed) - 1)
+        passed = self.passed[numbuckets]
+        sums = self.sums[numbuckets]
+        col = self.passed_col
+
+        (lo, hi) = self.lost_range[numbuckets]
+        lostinfo = [lo, sums[col + 1], hi]
+        (lo, hi) = self.ffp_range[numbuckets]
+        ffpinfo = [lo, sums[col + 2], hi]
+
+        dominfos = [None] * NDOMAINS
+        ndoms = len(self.doms)
+        for (n, i) in enumerate(self.doms):
+            dominfo = DomainInfo()
+            dominfo.gotten_sum = sums[0*ndoms + n]
+            dominfo.allocated_sum = sums[1*ndoms + n]
+            dominfo.waited_sum = sums[2*ndoms + n]
+            dominfo.blocked_sum = sums[3*ndoms + n]
+            dominfo.exec_count = sums[4*ndoms + n]
+            dominfo.iocount_sum = sums[5*ndoms + n]
+            dominfos[i] = dominfo
+
+        return [dominfos, passed, lostinfo, ffpinfo]
+
+    # report values over desired interval
+    def summarize(self, duration):
+        [dominfos, passed, lostinfo, ffpinfo] = self.totals(duration)
+
+        ldoms = []
+        for dominfo in dominfos:
+            if dominfo:
+                ldoms.append(dominfo.stats(passed))
+            else:
+                ldoms.append(0)
+
+        return [ldoms, lostinfo, ffpinfo]
+
+    # the samples over desired interval, newest first
+    def samples_within(self, duration):
+        self.extend(duration)
+        numbuckets = bisect_left(self.passed, duration, 0, len(self.passed) - 1)
+        return [self.samples[i] for i in self.order[:numbuckets]]
+
+    # the ns between the timestamps of successive samples over desired
+    # interval, leaving out samples never written
+    def intervals(self, duration):
+        stamps = [sample[6*NDOMAINS + 1] for sample in self.samples_within(duration)]
+        return [newer - older for (newer, older) in zip(stamps, stamps[1:])
+                if newer and older]
+
+    # histograms of the wait per execution and the block per io of each
+    # sample over desired interval: a (waited, blocked) pair of
+    # LatencyHistogram for each domain slot in use, None for the others
+    def histograms(self, duration):
+        samples = self.samples_within(duration)
+
+        hists = [None] * NDOMAINS
+        for i in self.doms:
+            waited = LatencyHistogram()
+            blocked = LatencyHistogram()
+            for sample in samples:
+                excount = sample[4*NDOMAINS + i]
+                if excount:
+                    waited.add(float(sample[2*NDOMAINS + i]) / excount)
+                iocount = sample[5*NDOMAINS + i]
+                if iocount:
+                    blocked.add(float(sample[3*NDOMAINS + i]) / iocount)
+            hists[i] = (waited, blocked)
+        return hists
+
+# a histogram of latencies in ns, in a fixed array of logarithmic buckets:
+# HIST_SUB to each power of two from 1 ns up to 2**HIST_MAX_SHIFT ns, past
+# which everything goes in the last bucket.  Percentiles are the upper
+# bound of the bucket they fall in, so they are at most 1/HIST_SUB over,
+# or the maximum for the last bucket, which has no bound.
+HIST_SUB = 4
+HIST_MAX_SHIFT = 40
+HIST_BUCKETS = HIST_SUB * HIST_MAX_SHIFT
+HIST_PERCENTILES = [50, 95, 99]
+
+class LatencyHistogram:
+    def __init__(self):
+        self.buckets = [0] * HIST_BUCKETS
+        self.count = 0
+        self.max = 0
+
+    def add(self, ns):
+        if ns < 1:
+            idx = 0
         else:
-            ldoms.append(0)
+            (m, e) = math.frexp(ns)
+            idx = min((e - 1) * HIST_SUB + int((m - 0.5) * 2 * HIST_SUB),
+                      HIST_BUCKETS - 1)
+        self.buckets[idx] += 1
+        self.count += 1
+        self.max = max(self.max, ns)
+
+    # the upper bound of bucket idx
+    def bound(self, idx):
+        (e, sub) = divmod(idx, HIST_SUB)
+        return math.ldexp(1 + float(sub + 1) / HIST_SUB, e)
+
+    # the latency below which p percent of the samples fall
+    def percentile(self, p):
+        if not self.count:
+            return 0
+        rank = max(1, int(math.ceil(self.count * p / 100.0)))
+        seen = 0
+        for (idx, n) in enumerate(self.buckets):
+            seen += n
+            if seen >= rank:
+                if idx == HIST_BUCKETS - 1:
+                    return self.max
+                return min(self.bound(idx), self.max)
+        return self.max
+
+    # the percentiles of HIST_PERCENTILES, followed by the maximum
+    def summary(self):
+        return [self.percentile(p) for p in HIST_PERCENTILES] + [self.max]
+
+# trace diagnostics of one cpu over desired interval: the records lost, in
+# total, per second and at most in one sample, the flip free periods, in
+# total and at most in one sample, then the mean, standard deviation,
+# minimum and maximum of the ms between samples
+def cpu_diagnostics(window, duration):
+    [dominfos, passed, lostinfo, ffpinfo] = window.totals(duration)
+    secs = float(passed) / 10**9
+    intervals = [float(i) / 10**6 for i in window.intervals(duration)]
+    if intervals:
+        mean = sum(intervals) / len(intervals)
+        stddev = math.sqrt(sum([(i - mean)**2 for i in intervals]) / len(intervals))
+        spread = [mean, stddev, min(intervals), max(intervals)]
+    else:
+        spread = [0, 0, 0, 0]
+    return [lostinfo[1], lostinfo[1] / secs, lostinfo[2], ffpinfo[1], ffpinfo[2]] + spread
+
+DIAG_COLUMNS = ["lost", "lost/s", "lost(max)", "ffp", "ffp(max)",
+                "interval(mean)", "interval(stddev)", "interval(min)", "interval(max)"]
+
+# the window of samples to summarize, going back from the one before
+# "next", which represents live data that may be in transition
+def sample_window(next, samples):
+    startat = next - 1
+    if next + 10 < NSAMPLES:
+        endat = next + 10
+    else:
+        endat = 10
+    return SampleWindow(startat, endat, samples)
+
+# rolling totals over the last 1, 5 and 15 minutes, for load average like
+# figures.  Samples are taken in as they appear in xenbaked's ring, into a
+# fixed ring of buckets each covering ROLLING_BUCKET seconds, and running
+# totals are kept for every window so that looking them up is cheap.
+ROLLING_BUCKET = 5
+ROLLING_WINDOWS = [60, 300, 900]
+ROLLING_NAMES = ["1 min", "5 min", "15 min"]
+
+class RollingStats:
+    def __init__(self):
+        self.nbuckets = ROLLING_WINDOWS[-1] / ROLLING_BUCKET
+        self.ring = [None] * self.nbuckets   # (bucket number, {key: sums})
+        self.totals = [{} for w in ROLLING_WINDOWS]
+        self.current = None                  # number of the current bucket
+        self.last_timestamp = {}             # cpu -> newest sample taken in
+        self.cpus = set()
+
+    # start a new bucket if the current one is over, dropping the oldest
+    # bucket of each window out of its totals, along with the keys left
+    # with nothing in them, such as those of domains since destroyed
+    def advance(self, now):
+        number = int(now / ROLLING_BUCKET)
+        if self.current is not None and number - self.current >= self.nbuckets:
+            self.ring = [None] * self.nbuckets
+            self.totals = [{} for w in ROLLING_WINDOWS]
+            self.current = None
+        if self.current is None:
+            self.current = number - 1
+
+        while self.current < number:
+            self.current += 1
+            for (w, window) in enumerate(ROLLING_WINDOWS):
+                bucket = self.ring[(self.current - window / ROLLING_BUCKET) % self.nbuckets]
+                if bucket and bucket[0] == self.current - window / ROLLING_BUCKET:
+                    totals = self.totals[w]
+                    for (key, sums) in bucket[1].iteritems():
+                        left = map(sub, totals[key], sums)
+                        if any(left):
+                            totals[key] = left
+                        else:
+                            del totals[key]
+            self.ring[self.current % self.nbuckets] = (self.current, {})
+
+    def add(self, key, sums):
+        bucket = self.ring[self.current % self.nbuckets][1]
+        for totals in [bucket] + self.totals:
+            if key in totals:
+                totals[key] = map(add, totals[key], sums)
+            else:
+                totals[key] = list(sums)
+
+    # take in the samples of a cpu which completed since the last call;
+    # the sums of each domain go in under (cpu, domid) and (None, domid),
+    # and the time passed under (cpu, None) and (None, None)
+    def take_samples(self, cpu, samples, in_use, domain_id, next, now=None):
+        if now is None:
+            now = time.time()
+        self.advance(now)
+        self.cpus.add(cpu)
+
+        # never look at "next", which may be in transition
+        last = self.last_timestamp.get(cpu, 0)
+        new = []
+        for k in range(1, NSAMPLES):
+            sample = samples[(next - k) % NSAMPLES]
+            if sample[6*NDOMAINS + 1] > last:
+                new.append(sample)
+        if not new:
+            return
+        self.last_timestamp[cpu] = max([sample[6*NDOMAINS + 1] for sample in new])
+
+        passed = sum([sample[6*NDOMAINS] for sample in new])
+        self.add((cpu, None), (passed, 0, 0, 0, 0))
+        self.add((None, None), (passed, 0, 0, 0, 0))
+        for i in range(0, NDOMAINS):
+            if not in_use[i]:
+                continue
+            sums = [0] * 5
+            for sample in new:
+                sums[0] += sample[0*NDOMAINS + i]   # gotten
+                sums[1] += sample[3*NDOMAINS + i]   # blocked
+                sums[2] += sample[2*NDOMAINS + i]   # waited
+                sums[3] += sample[4*NDOMAINS + i]   # exec count
+                sums[4] += sample[5*NDOMAINS + i]   # io count
+            self.add((cpu, domain_id[i]), sums)
+            self.add((None, domain_id[i]), sums)
+
+    # the (cpu, domid) keys with data in any of the windows
+    def domains(self):
+        keys = [key for key in self.totals[-1] if None not in key]
+        keys.sort()
+        return keys
+
+    # [gotten %, blocked %, waited %, executions/s, io/s] of a domain over
+    # each window, on one cpu or, for cpu None, summed over all cpus
+    def stats(self, cpu, domid):
+        ret = []
+        for totals in self.totals:
+            passed = float(totals.get((cpu, None), [0])[0])
+            if cpu is None and self.cpus:
+                passed /= len(self.cpus)
+            sums = totals.get((cpu, domid))
+            if not sums or passed <= 0:
+                ret.append([0.0] * 5)
+                continue
+            ret.append([100 * sums[0] / passed, 100 * sums[1] / passed,
+                        100 * sums[2] / passed, sums[3] / (passed / 10**9),
+                        sums[4] / (passed / 10**9)])
+        return ret
 
-    return [ldoms, lostinfo, ffpinfo]
+# report values over desired interval
+def summarize(startat, endat, duration, samples):
+    return SampleWindow(startat, endat, samples).summarize(duration)
 
 # scale microseconds to milliseconds or seconds as necessary
 def time_scale(ns):
@@ -238,6 +876,29 @@ def time_scale(ns):
     else:
         return "%4.2f s" % (float(ns)/10**9)
 
+# column headers of the latency panel
+LATENCY_HEADER = "".join(["%10s" % ("p%d" % p) for p in HIST_PERCENTILES]) + "%10s" % "max"
+
+# display the percentiles of the wait per execution and the block per io
+# of the domains in use, over the last 10 seconds (hists); returns the last
+# row used
+def display_latency(scr, row, hists, domain_id):
+    row += 1
+    display(scr, row, 2, "Latency, last 10 seconds", _c.A_BOLD)
+    display(scr, row, 30, "Waited/ex" + LATENCY_HEADER[9:], _c.A_BOLD)
+    display(scr, row, 74, "Blocked/io" + LATENCY_HEADER[10:], _c.A_BOLD)
+    for dom in range(0, NDOMAINS):
+        if not hists[dom]:
+            continue
+        (waited, blocked) = hists[dom]
+        if not waited.count and not blocked.count:
+            continue
+        row += 1
+        display_domain_id(scr, row, 2, domain_id[dom])
+        display(scr, row, 30, "".join(["%10s" % time_scale(v) for v in waited.summary()]))
+        display(scr, row, 74, "".join(["%10s" % time_scale(v) for v in blocked.summary()]))
+    return row
+
 # paint message on curses screen, but detect screen size errors
 def display(scr, row, col, str, attr=0):
     try:
@@ -253,6 +914,74 @@ def display(scr, row, col, str, attr=0):
         sys.exit(1)
 
 
+# a frame of the live display, drawn into in place of the screen.  Each
+# row is kept as the cells drawn in it, and flush() paints only the rows
+# that differ from the previous frame, rather than the whole screen.
+class Frame:
+    def __init__(self, scr):
+        self.scr = scr
+        [self.maxy, self.maxx] = scr.getmaxyx()
+        self.rows = {}
+        self.shown = {}
+
+    def addstr(self, row, col, str, attr=0):
+        self.rows.setdefault(row, []).append((col, str, attr))
+
+    # whether any of cells runs past the end of its row into the next
+    def spills(self, cells):
+        for (col, str, attr) in cells or []:
+            if col + len(str) > self.maxx:
+                return True
+        return False
+
+    # paint the rows that changed and clear those no longer drawn, then
+    # start a new frame; returns the number of rows and characters painted.
+    # Text running past the end of a row wraps into the next, so a row
+    # repainted is repainted along with any row that wraps into it or that
+    # it wraps into.
+    def flush(self):
+        rows = sorted(set(self.rows) | set(self.shown))
+        dirty = set([row for row in rows
+                     if self.rows.get(row, []) != self.shown.get(row)])
+        spilling = set([row for row in rows
+                        if self.spills(self.rows.get(row)) or
+                           self.spills(self.shown.get(row))])
+        grown = True
+        while grown:
+            grown = False
+            for row in spilling:
+                if (row in dirty) != (row + 1 in dirty):
+                    dirty.update([row, row + 1])
+                    grown = True
+        dirty = sorted(dirty)
+
+        for row in dirty:
+            if row < self.maxy:
+                self.scr.move(row, 0)
+                self.scr.clrtoeol()
+        nchars = 0
+        for row in dirty:
+            for (col, str, attr) in self.rows.get(row, []):
+                display(self.scr, row, col, str, attr)
+                nchars += len(str)
+
+        self.shown = self.rows
+        self.rows = {}
+        return (len(dirty), nchars)
+
+# the live display is refreshed every REFRESH_MIN ms while it changes, but
+# no faster than REFRESH_RATE characters a second can be sent, so that
+# large displays stay responsive over slow links.  While nothing but the
+# heartbeat changes, the delay doubles up to REFRESH_MAX ms.
+REFRESH_MIN = 1000
+REFRESH_MAX = 8000
+REFRESH_RATE = 8192
+
+def refresh_delay(delay, nrows, nchars):
+    if nrows <= 1:
+        return min(2 * delay, REFRESH_MAX)
+    return max(REFRESH_MIN, min(REFRESH_MAX, 1000 * nchars / REFRESH_RATE))
+
 # diplay domain id
 def display_domain_id(scr, row, col, dom):
     if dom == IDLE_DOMAIN:
@@ -261,6 +990,320 @@ def display_domain_id(scr, row, col, dom):
         display(scr, row, col, "%d" % dom)
 
 
+# column of the rolling 1/5/15 minute figures, shown if there is room
+ROLLING_COL = 108
+
+ROLLING_HEADER = " ".join(["%7s" % name for name in ROLLING_NAMES])
+
+def display_rolling(scr, row, values, fmt):
+    display(scr, row, ROLLING_COL, " ".join([fmt % v for v in values]))
+
+# display the rows for one domain, given its stats over the last second
+# (s1) and the last 10 seconds (s2), and optionally the rolling stats (r);
+# returns the last row used
+def display_domain(scr, row, domid, s1, s2, r=None):
+    # display gotten
+    row += 1
+    col = 2
+    display_domain_id(scr, row, col, domid)
+    col += 4
+    display(scr, row, col, "%s" % time_scale(s2[0][0]))
+    col += 12
+    display(scr, row, col, "%3.2f%%" % s2[0][1])
+    col += 12
+    display(scr, row, col, "%s/ex" % time_scale(s2[0][2]))
+    col += 18
+    display(scr, row, col, "%s" % time_scale(s1[0][0]))
+    col += 12
+    display(scr, row, col, "%3.2f%%" % s1[0][1], _c.A_STANDOUT)
+    col += 12
+    display(scr, row, col, "%s/ex" % time_scale(s1[0][2]))
+    col += 18
+    display(scr, row, col, "Gotten")
+    if r:
+        display_rolling(scr, row, [w[0] for w in r], "%6.2f%%")
+
+    # display allocated
+    if options.allocated:
+        row += 1
+        col = 2
+        display_domain_id(scr, row, col, domid)
+        col += 28
+        display(scr, row, col, "%s/ex" % time_scale(s2[1]))
+        col += 42
+        display(scr, row, col, "%s/ex" % time_scale(s1[1]))
+        col += 18
+        display(scr, row, col, "Allocated")
+
+    # display blocked
+    if options.blocked:
+        row += 1
+        col = 2
+        display_domain_id(scr, row, col, domid)
+        col += 4
+        display(scr, row, col, "%s" % time_scale(s2[2][0]))
+        col += 12
+        display(scr, row, col, "%3.2f%%" % s2[2][1])
+        col += 12
+        display(scr, row, col, "%s/io" % time_scale(s2[2][2]))
+        col += 18
+        display(scr, row, col, "%s" % time_scale(s1[2][0]))
+        col += 12
+        display(scr, row, col, "%3.2f%%" % s1[2][1])
+        col += 12
+        display(scr, row, col, "%s/io" % time_scale(s1[2][2]))
+        col += 18
+        display(scr, row, col, "Blocked")
+        if r:
+            display_rolling(scr, row, [w[1] for w in r], "%6.2f%%")
+
+    # display waited
+    if options.waited:
+        row += 1
+        col = 2
+        display_domain_id(scr, row, col, domid)
+        col += 4
+        display(scr, row, col, "%s" % time_scale(s2[3][0]))
+        col += 12
+        display(scr, row, col, "%3.2f%%" % s2[3][1])
+        col += 12
+        display(scr, row, col, "%s/ex" % time_scale(s2[3][2]))
+        col += 18
+        display(scr, row, col, "%s" % time_scale(s1[3][0]))
+        col += 12
+        display(scr, row, col, "%3.2f%%" % s1[3][1])
+        col += 12
+        display(scr, row, col, "%s/ex" % time_scale(s1[3][2]))
+        col += 18
+        display(scr, row, col, "Waited")
+        if r:
+            display_rolling(scr, row, [w[2] for w in r], "%6.2f%%")
+
+    # display ex count
+    if options.excount:
+        row += 1
+        col = 2
+        display_domain_id(scr, row, col, domid)
+
+        col += 28
+        display(scr, row, col, "%d/s" % s2[4])
+        col += 42
+        display(scr, row, col, "%d" % s1[4])
+        col += 18
+        display(scr, row, col, "Execution count")
+        if r:
+            display_rolling(scr, row, [w[3] for w in r], "%5d/s")
+
+    # display io count
+    if options.iocount:
+        row += 1
+        col = 2
+        display_domain_id(scr, row, col, domid)
+        col += 4
+        display(scr, row, col, "%d/s" % s2[5][0])
+        col += 24
+        display(scr, row, col, "%d/ex" % s2[5][1])
+        col += 18
+        display(scr, row, col, "%d" % s1[5][0])
+        col += 24
+        display(scr, row, col, "%3.2f/ex" % s1[5][1])
+        col += 18
+        display(scr, row, col, "I/O Count")
+        if r:
+            display_rolling(scr, row, [w[4] for w in r], "%5d/s")
+
+    return row
+
+# characters for the cpu utilisation heat strip, from idle to busy
+HEAT_CHARS = " .:-=+*#%@"
+
+def heat_char(usage):
+    level = int(usage * (len(HEAT_CHARS) - 1) / 100.0 + 0.5)
+    return HEAT_CHARS[max(0, min(level, len(HEAT_CHARS) - 1))]
+
+# each domain's stats across all cpus over the last second and the last
+# 10 seconds, by domain id, along with the records lost on each cpu and
+# how busy each cpu was over the last second.  Every cpu's data is decoded
+# exactly once.
+def host_totals(shm, ncpu, slen):
+    global dom_in_use
+
+    totals = {}                 # domid -> DomainInfo over 1s and 10s
+    passed = [0, 0]             # time passed over 1s and 10s, all cpus
+    lost = [[], []]             # lost records over 1s and 10s, per cpu
+    usage = []                  # non-idle percentage of each cpu over 1s
+
+    for cpuidx in range(0, ncpu):
+        (samples, dom_in_use, domain_id, next) = \
+            read_cpu_data(shm, cpuidx, slen)
+        window = sample_window(next, samples)
+
+        busy = 0.0
+        for (n, duration) in enumerate((10**9, 10 * 10**9)):
+            [dominfos, cpu_passed, lostinfo, ffpinfo] = window.totals(duration)
+            passed[n] += cpu_passed
+            lost[n].append(lostinfo)
+
+            for dom in range(0, NDOMAINS):
+                if not dominfos[dom]:
+                    continue
+                domid = domain_id[dom]
+                if domid not in totals:
+                    totals[domid] = [DomainInfo(), DomainInfo()]
+                totals[domid][n].add(dominfos[dom])
+                if n == 0 and domid != IDLE_DOMAIN:
+                    busy += 100.0 * dominfos[dom].gotten_sum / cpu_passed
+        usage.append(busy)
+
+    # percentages are of one cpu, so a domain may use up to ncpu*100%
+    passed = [float(p) / ncpu for p in passed]
+    h1 = {}
+    h2 = {}
+    for domid in totals:
+        h1[domid] = totals[domid][0].stats(passed[0])
+        h2[domid] = totals[domid][1].stats(passed[1])
+
+    return (h1, h2, lost, usage)
+
+# the host wide view: each domain's totals across all cpus, and a strip
+# showing how busy each cpu was over the last second.
+def display_allcpus(scr, shm, ncpu, slen, maxx, heartbeat, show_rolling=False):
+    (h1, h2, lost, usage) = host_totals(shm, ncpu, slen)
+
+    host_1sec_usage = sum(usage) / ncpu
+    host_10sec_usage = 0.0
+    for domid in h2:
+        if domid != IDLE_DOMAIN:
+            host_10sec_usage += h2[domid][0][1] / ncpu
+
+    row = 0
+    display(scr, row, 1, "CPU = all", _c.A_STANDOUT)
+    display(scr, row, 10, "%sLast 10 seconds (%3.2f%%)%sLast 1 second (%3.2f%%)" % (6*' ', host_10sec_usage, 30*' ', host_1sec_usage), _c.A_BOLD)
+    if show_rolling:
+        display(scr, row, ROLLING_COL, ROLLING_HEADER, _c.A_BOLD)
+
+    # one character per cpu, wrapped to the width of the screen
+    width = max(maxx - 9, 1)
+    for start in range(0, ncpu, width):
+        row += 1
+        if start == 0:
+            display(scr, row, 1, "Load")
+        display(scr, row, 7, ''.join([heat_char(u) for u in usage[start:start+width]]))
+
+    row += 1
+    display(scr, row, 1, "%s" % ((maxx-2)*'='))
+
+    total_h1_cpu = 0
+    total_h2_cpu = 0
+    for domid in sorted(h2, key=lambda d: (d != IDLE_DOMAIN, d)):
+        if h1[domid][0][1] > 0 or domid == IDLE_DOMAIN:
+            r = None
+            if show_rolling:
+                r = rolling.stats(None, domid)
+            row = display_domain(scr, row, domid, h1[domid], h2[domid], r)
+        total_h1_cpu += h1[domid][0][1]
+        total_h2_cpu += h2[domid][0][1]
+
+    row += 1
+    display(scr, row, 1, heartbeat * '*')
+    display(scr, row, 2, TOTALS % (total_h2_cpu, total_h1_cpu))
+    row += 1
+
+    [l1, l2] = [[min([l[0] for l in lost[n]]), sum([l[1] for l in lost[n]]),
+                 max([l[2] for l in lost[n]])] for n in (0, 1)]
+    if l1[1] > 1 :
+        row += 1
+        display(scr, row, 2,
+                "\tRecords lost: %d (Min: %d, Max: %d)\t\t\tRecords lost: %d (Min: %d, Max %d)" %
+                (math.ceil(l2[1]), l2[0], l2[2], math.ceil(l1[1]), l1[0], l1[2]), _c.A_BOLD)
+
+# the diagnostics view: for each cpu, how many trace records were lost and
+# how many flip free periods there were over the last 10 seconds, and how
+# regular the samples were, to help tune --ms_per_sample and xenbaked's
+# trace buffers
+def display_diagnostics(scr, shm, ncpu, slen, maxx, heartbeat):
+    global dom_in_use
+
+    row = 0
+    display(scr, row, 1, "Diagnostics", _c.A_STANDOUT)
+    display(scr, row, 14, "%sLast 10 seconds, %d ms per sample" %
+            (2*' ', options.mspersample), _c.A_BOLD)
+    row += 1
+    display(scr, row, 1, "%s" % ((maxx-2)*'='))
+    row += 1
+    display(scr, row, 2, "%4s %10s %10s %10s %8s %8s   %s" %
+            ("CPU", "Lost", "Lost/s", "Max lost", "FFP", "Max FFP",
+             "Sample interval: mean   stddev      min      max"), _c.A_BOLD)
+
+    total_lost = 0.0
+    for cpuidx in range(0, ncpu):
+        (samples, dom_in_use, domain_id, next) = read_cpu_data(shm, cpuidx, slen)
+        d = cpu_diagnostics(sample_window(next, samples), 10 * 10**9)
+        total_lost += d[1]
+        attr = 0
+        if d[0] > 0:
+            attr = _c.A_BOLD
+        row += 1
+        display(scr, row, 2, "%4d %10d %10.1f %10d %8d %8d   %19.2f %8.2f %8.2f %8.2f" %
+                tuple([cpuidx] + d), attr)
+
+    row += 1
+    display(scr, row, 1, heartbeat * '*')
+    display(scr, row, 2, "%4s %10s %10.1f" % ("all", "", total_lost))
+
+# the columns of the top domains view: (sort key, header, function picking
+# the value out of the stats, format)
+TOP_COLUMNS = [
+    ("gotten", "Gotten%", lambda h: h[0][1], "%9.2f%%"),
+    ("waited", "Waited%", lambda h: h[3][1], "%9.2f%%"),
+    ("blocked", "Blocked%", lambda h: h[2][1], "%9.2f%%"),
+    ("ex", "Ex/s", lambda h: h[4], "%10.1f"),
+    ("io", "IO/s", lambda h: h[5][0], "%10.1f"),
+    ]
+TOP_NAME_WIDTH = 24
+
+# the top domains view: one row per domain, with its totals across all
+# cpus over the last 10 seconds, for the top domains by column sortby.
+# Only the domains shown are sorted, out of a heap.
+def display_top(scr, shm, ncpu, slen, maxx, maxy, heartbeat, sortby, top, names):
+    (h1, h2, lost, usage) = host_totals(shm, ncpu, slen)
+    domids = [domid for domid in h2 if domid != IDLE_DOMAIN]
+    missing = names.missing(domids)
+    if missing:
+        names.update(missing, shm, ncpu, slen)
+
+    # what fits below the headers and above the heartbeat
+    count = maxy - 4
+    if top > 0:
+        count = min(count, top)
+    col = [c for c in TOP_COLUMNS if c[0] == sortby][0]
+    shown = heapq.nlargest(count, domids, key=lambda d: (col[2](h2[d]), -d))
+
+    row = 0
+    display(scr, row, 1, "Top", _c.A_STANDOUT)
+    display(scr, row, 10, "%sDomains by %s over the last 10 seconds (%d of %d)" %
+            (6*' ', col[1], len(shown), len(domids)), _c.A_BOLD)
+    row += 1
+    display(scr, row, 1, "%s" % ((maxx-2)*'='))
+
+    row += 1
+    display(scr, row, 2, "%-*s %5s" % (TOP_NAME_WIDTH, "Domain", "ID"), _c.A_BOLD)
+    x = TOP_NAME_WIDTH + 9
+    for c in TOP_COLUMNS:
+        attr = _c.A_BOLD
+        if c is col:
+            attr = _c.A_STANDOUT
+        display(scr, row, x, "%10s" % c[1], attr)
+        x += 11
+
+    for domid in shown:
+        row += 1
+        display(scr, row, 2, "%-*s %5d " % (TOP_NAME_WIDTH, names[domid][:TOP_NAME_WIDTH], domid) +
+                " ".join([c[3] % c[2](h2[domid]) for c in TOP_COLUMNS]))
+
+    row += 1
+    display(scr, row, 1, heartbeat * '*')
+
 # the live monitoring code
 def show_livestats(cpu):
     ncpu = 1         # number of cpu's on this platform
@@ -268,11 +1311,17 @@ def show_livestats(cpu):
     cpu_1sec_usage = 0.0
     cpu_10sec_usage = 0.0
     heartbeat = 1
-    global dom_in_use, options
+    global dom_in_use, options, rolling
+    allcpus = options.allcpus
+    latency = options.latency
+    top = options.top is not None
+    diagnostics = options.diagnostics
+    sortby = options.sort
+    names = DomainNames()
+    if options.rolling:
+        rolling = RollingStats()
     
-    # mmap the (the first chunk of the) file
-    shmf = open(SHM_FILE, "r+")
-    shm = mmap.mmap(shmf.fileno(), QOS_DATA_SIZE)
+    source = open_source()
 
     # initialize curses
     stdscr = _c.initscr()
@@ -280,225 +1329,105 @@ def show_livestats(cpu):
     _c.cbreak()
 
     stdscr.keypad(1)
-    stdscr.timeout(1000)
     [maxy, maxx] = stdscr.getmaxyx()
+    frame = Frame(stdscr)
+    delay = REFRESH_MIN
     
     # display in a loop
     while True:
 
-        cpuidx = 0
-        while cpuidx < ncpu:
-
-            # calculate offset in mmap file to start from
-            idx = cpuidx * slen
-
-
-            samples = []
-            doms = []
-            dom_in_use = []
-            domain_id = []
-
-            # read in data
-            for i in range(0, NSAMPLES):
-                len = struct.calcsize(ST_QDATA)
-                sample = struct.unpack(ST_QDATA, shm[idx:idx+len])
-                samples.append(sample)
-                idx += len
-
-            for i in range(0, NDOMAINS):
-                len = struct.calcsize(ST_DOM_INFO)
-                dom = struct.unpack(ST_DOM_INFO, shm[idx:idx+len])
-                doms.append(dom)
-#               (last_update_time, start_time, runnable_start_time, blocked_start_time,
-#                ns_since_boot, ns_oncpu_since_boot, runnable_at_last_update,
-#                runnable, in_use, domid, junk, name) = dom
-#               dom_in_use.append(in_use)
-                dom_in_use.append(dom[8])
-                domid = dom[9]
-                if domid == 32767 :
-                    domid = IDLE_DOMAIN
-                domain_id.append(domid)
-                idx += len
-#            print "dom_in_use(cpu=%d): " % cpuidx, dom_in_use
-
-
-            len = struct.calcsize("4i")
-            oldncpu = ncpu
-            (next, ncpu, slen, freq) = struct.unpack("4i", shm[idx:idx+len])
-            idx += len
-
-            # xenbaked tells us how many cpu's it's got, so re-do
-            # the mmap if necessary to get multiple cpu data
-            if oldncpu != ncpu:
-                shm = mmap.mmap(shmf.fileno(), ncpu*slen)
-
-            # if we've just calculated data for the cpu of interest, then
-            # stop examining mmap data and start displaying stuff
-            if cpuidx == cpu:
-                break
-
-            cpuidx = cpuidx + 1
-
-        # calculate starting and ending datapoints; never look at "next" since
-        # it represents live data that may be in transition. 
-        startat = next - 1
-        if next + 10 < NSAMPLES:
-            endat = next + 10
+        region = source.refresh()
+        if region is None:
+            break
+        (shm, ncpu, slen) = region
+
+        # the rolling stats need the samples of every cpu
+        if rolling:
+            for cpuidx in range(0, ncpu):
+                rolling.take_samples(cpuidx, *read_cpu_data(shm, cpuidx, slen),
+                                     now=source.time())
+        show_rolling = rolling and maxx > ROLLING_COL + len(ROLLING_HEADER)
+
+        if diagnostics:
+            display_diagnostics(frame, shm, ncpu, slen, maxx, heartbeat)
+            heartbeat = 1 - heartbeat
+        elif top:
+            display_top(frame, shm, ncpu, slen, maxx, maxy, heartbeat, sortby,
+                        options.top or 0, names)
+            heartbeat = 1 - heartbeat
+        elif allcpus:
+            display_allcpus(frame, shm, ncpu, slen, maxx, heartbeat, show_rolling)
+            heartbeat = 1 - heartbeat
         else:
-            endat = 10
+            # only the cpu of interest needs decoding
+            (samples, dom_in_use, domain_id, next) = \
+                read_cpu_data(shm, min(cpu, ncpu - 1), slen)
 
-        # get summary over desired interval
-        [h1, l1, f1] = summarize(startat, endat, 10**9, samples)
-        [h2, l2, f2] = summarize(startat, endat, 10 * 10**9, samples)
+            # get summary over desired interval
+            window = sample_window(next, samples)
+            [h1, l1, f1] = window.summarize(10**9)
+            [h2, l2, f2] = window.summarize(10 * 10**9)
 
 
-        # the actual display code
-        row = 0
-        display(stdscr, row, 1, "CPU = %d" % cpu, _c.A_STANDOUT)
+            # the actual display code
+            row = 0
+            display(frame, row, 1, "CPU = %d" % cpu, _c.A_STANDOUT)
 
-        display(stdscr, row, 10, "%sLast 10 seconds (%3.2f%%)%sLast 1 second (%3.2f%%)" % (6*' ', cpu_10sec_usage, 30*' ', cpu_1sec_usage), _c.A_BOLD)
-        row +=1
-        display(stdscr, row, 1, "%s" % ((maxx-2)*'='))
+            display(frame, row, 10, "%sLast 10 seconds (%3.2f%%)%sLast 1 second (%3.2f%%)" % (6*' ', cpu_10sec_usage, 30*' ', cpu_1sec_usage), _c.A_BOLD)
+            if show_rolling:
+                display(frame, row, ROLLING_COL, ROLLING_HEADER, _c.A_BOLD)
+            row +=1
+            display(frame, row, 1, "%s" % ((maxx-2)*'='))
 
-        total_h1_cpu = 0
-        total_h2_cpu = 0
+            total_h1_cpu = 0
+            total_h2_cpu = 0
 
-        cpu_1sec_usage = 0.0
-        cpu_10sec_usage = 0.0
+            cpu_1sec_usage = 0.0
+            cpu_10sec_usage = 0.0
 
-        for dom in range(0, NDOMAINS):
-            if not dom_in_use[dom]:
-                continue
+            for dom in range(0, NDOMAINS):
+                if not dom_in_use[dom]:
+                    continue
 
-            if h1[dom][0][1] > 0 or domain_id[dom] == IDLE_DOMAIN:
-                # display gotten
-                row += 1 
-                col = 2
-                display_domain_id(stdscr, row, col, domain_id[dom])
-                col += 4
-                display(stdscr, row, col, "%s" % time_scale(h2[dom][0][0]))
-                col += 12
-                display(stdscr, row, col, "%3.2f%%" % h2[dom][0][1])
-                if dom != IDLE_DOMAIN:
-                    cpu_10sec_usage += h2[dom][0][1]
-                col += 12
-                display(stdscr, row, col, "%s/ex" % time_scale(h2[dom][0][2]))
-                col += 18
-                display(stdscr, row, col, "%s" % time_scale(h1[dom][0][0]))
-                col += 12
-                display(stdscr, row, col, "%3.2f%%" % h1[dom][0][1], _c.A_STANDOUT)
-                col += 12
-                display(stdscr, row, col, "%s/ex" % time_scale(h1[dom][0][2]))
-                col += 18
-                display(stdscr, row, col, "Gotten")
-
-                if dom != IDLE_DOMAIN:
-                    cpu_1sec_usage = cpu_1sec_usage + h1[dom][0][1]
-    
-                # display allocated
-                if options.allocated:
-                    row += 1
-                    col = 2
-                    display_domain_id(stdscr, row, col, domain_id[dom])
-                    col += 28
-                    display(stdscr, row, col, "%s/ex" % time_scale(h2[dom][1]))
-                    col += 42
-                    display(stdscr, row, col, "%s/ex" % time_scale(h1[dom][1]))
-                    col += 18
-                    display(stdscr, row, col, "Allocated")
-
-                # display blocked
-                if options.blocked:
-                    row += 1
-                    col = 2
-                    display_domain_id(stdscr, row, col, domain_id[dom])
-                    col += 4
-                    display(stdscr, row, col, "%s" % time_scale(h2[dom][2][0]))
-                    col += 12
-                    display(stdscr, row, col, "%3.2f%%" % h2[dom][2][1])
-                    col += 12
-                    display(stdscr, row, col, "%s/io" % time_scale(h2[dom][2][2]))
-                    col += 18
-                    display(stdscr, row, col, "%s" % time_scale(h1[dom][2][0]))
-                    col += 12
-                    display(stdscr, row, col, "%3.2f%%" % h1[dom][2][1])
-                    col += 12
-                    display(stdscr, row, col, "%s/io" % time_scale(h1[dom][2][2]))
-                    col += 18
-                    display(stdscr, row, col, "Blocked")
-
-                # display waited
-                if options.waited:
-                    row += 1
-                    col = 2
-                    display_domain_id(stdscr, row, col, domain_id[dom])
-                    col += 4
-                    display(stdscr, row, col, "%s" % time_scale(h2[dom][3][0]))
-                    col += 12
-                    display(stdscr, row, col, "%3.2f%%" % h2[dom][3][1])
-                    col += 12
-                    display(stdscr, row, col, "%s/ex" % time_scale(h2[dom][3][2]))
-                    col += 18
-                    display(stdscr, row, col, "%s" % time_scale(h1[dom][3][0]))
-                    col += 12
-                    display(stdscr, row, col, "%3.2f%%" % h1[dom][3][1])
-                    col += 12
-                    display(stdscr, row, col, "%s/ex" % time_scale(h1[dom][3][2]))
-                    col += 18
-                    display(stdscr, row, col, "Waited")
-
-                # display ex count
-                if options.excount:
-                    row += 1
-                    col = 2
-                    display_domain_id(stdscr, row, col, domain_id[dom])
-                    
-                    col += 28
-                    display(stdscr, row, col, "%d/s" % h2[dom][4])
-                    col += 42
-                    display(stdscr, row, col, "%d" % h1[dom][4])
-                    col += 18
-                    display(stdscr, row, col, "Execution count")
-
-                # display io count
-                if options.iocount:
-                    row += 1
-                    col = 2
-                    display_domain_id(stdscr, row, col, domain_id[dom])
-                    col += 4
-                    display(stdscr, row, col, "%d/s" % h2[dom][5][0])
-                    col += 24
-                    display(stdscr, row, col, "%d/ex" % h2[dom][5][1])
-                    col += 18
-                    display(stdscr, row, col, "%d" % h1[dom][5][0])
-                    col += 24
-                    display(stdscr, row, col, "%3.2f/ex" % h1[dom][5][1])
-                    col += 18
-                    display(stdscr, row, col, "I/O Count")
-
-            #row += 1
-            #stdscr.hline(row, 1, '-', maxx - 2)
-            total_h1_cpu += h1[dom][0][1]
-            total_h2_cpu += h2[dom][0][1]
+                if h1[dom][0][1] > 0 or domain_id[dom] == IDLE_DOMAIN:
+                    r = None
+                    if show_rolling:
+                        r = rolling.stats(min(cpu, ncpu - 1), domain_id[dom])
+                    row = display_domain(frame, row, domain_id[dom], h1[dom], h2[dom], r)
+                    if dom != IDLE_DOMAIN:
+                        cpu_10sec_usage += h2[dom][0][1]
+                        cpu_1sec_usage = cpu_1sec_usage + h1[dom][0][1]
 
+                #row += 1
+                #stdscr.hline(row, 1, '-', maxx - 2)
+                total_h1_cpu += h1[dom][0][1]
+                total_h2_cpu += h2[dom][0][1]
 
-        row += 1
-        star = heartbeat * '*'
-        heartbeat = 1 - heartbeat
-        display(stdscr, row, 1, star)
-        display(stdscr, row, 2, TOTALS % (total_h2_cpu, total_h1_cpu))
-        row += 1
-#        display(stdscr, row, 2, 
-#                "\tFFP: %d (Min: %d, Max: %d)\t\t\tFFP: %d (Min: %d, Max %d)" % 
-#                (math.ceil(f2[1]), f2[0], f2[2], math.ceil(f1[1]), f1[0], f1[2]), _c.A_BOLD)
 
-        if l1[1] > 1 :
             row += 1
-            display(stdscr, row, 2, 
-                    "\tRecords lost: %d (Min: %d, Max: %d)\t\t\tRecords lost: %d (Min: %d, Max %d)" % 
-                    (math.ceil(l2[1]), l2[0], l2[2], math.ceil(l1[1]), l1[0], l1[2]), _c.A_BOLD)
+            star = heartbeat * '*'
+            heartbeat = 1 - heartbeat
+            display(frame, row, 1, star)
+            display(frame, row, 2, TOTALS % (total_h2_cpu, total_h1_cpu))
+            row += 1
+#            display(frame, row, 2, 
+#                    "\tFFP: %d (Min: %d, Max: %d)\t\t\tFFP: %d (Min: %d, Max %d)" % 
+#                    (math.ceil(f2[1]), f2[0], f2[2], math.ceil(f1[1]), f1[0], f1[2]), _c.A_BOLD)
+
+            if l1[1] > 1 :
+                row += 1
+                display(frame, row, 2, 
+                        "\tRecords lost: %d (Min: %d, Max: %d)\t\t\tRecords lost: %d (Min: %d, Max %d)" % 
+                        (math.ceil(l2[1]), l2[0], l2[2], math.ceil(l1[1]), l1[0], l1[2]), _c.A_BOLD)
+
+            if latency:
+                row += 1
+                row = display_latency(frame, row, window.histograms(10 * 10**9), domain_id)
+
+        delay = refresh_delay(delay, *frame.flush())
 
         # grab a char from tty input; exit if interrupt hit
+        stdscr.timeout(delay)
         try:
             c = stdscr.getch()
         except:
@@ -518,14 +1447,34 @@ def show_livestats(cpu):
         if c == ord('p'):
             cpu = (cpu - 1) % ncpu
 
-        stdscr.erase()
+        # a = toggle between the cpu of interest and all cpus
+        if c == ord('a'):
+            allcpus = not allcpus
+
+        # l = toggle the latency panel
+        if c == ord('l'):
+            latency = not latency
+
+        # d = toggle the diagnostics view
+        if c == ord('d'):
+            diagnostics = not diagnostics
+
+        # t = toggle the top domains view, s = sort it by the next column
+        if c == ord('t'):
+            top = not top
+        if c == ord('s'):
+            keys = [col[0] for col in TOP_COLUMNS]
+            sortby = keys[(keys.index(sortby) + 1) % len(keys)]
+
+        # after a key press, show its effect without delay
+        if c != -1:
+            delay = REFRESH_MIN
 
     _c.nocbreak()
     stdscr.keypad(0)
     _c.echo()
     _c.endwin()
-    shm.close()
-    shmf.close()
+    source.close()
 
 
 # simple functions to allow initialization of log files without actually
@@ -560,94 +1509,805 @@ class Delayed(file):
             self.file.close()
             
 
+# the columns of a log record, as named in the text logs
+LOG_COLUMNS = ["passed", "cpu", "dom", "cpu(tot)", "cpu(%)", "cpu/ex",
+               "allocated/ex", "blocked(tot)", "blocked(%)", "blocked/io",
+               "waited(tot)", "waited(%)", "waited/ex", "ex/s", "io(tot)",
+               "io/ex"]
+LOG_FORMAT = "%.3f %d %d" + " %.3f" * 13
+
+# flatten a domain's stats from summarize() into the columns after "dom"
+def log_values(h):
+    return (h[0][0], h[0][1], h[0][2],
+            h[1],
+            h[2][0], h[2][1], h[2][2],
+            h[3][0], h[3][1], h[3][2],
+            h[4],
+            h[5][0], h[5][1])
+
+# the text logs: one file per domain, flushed after every line
+class TextLog:
+    def __init__(self, prefix):
+        self.prefix = prefix
+        self.outfiles = {}
+        for dom in range(0, NDOMAINS):
+            self.outfiles[dom] = Delayed("%s-dom%d.log" % (prefix, dom), 'w')
+            self.outfiles[dom].delayed_write("# " + " ".join(LOG_COLUMNS) + "\n")
+
+    def set_domain(self, slot, domid):
+        if domid == IDLE_DOMAIN:
+            self.outfiles[slot].rename("%s-idle.log" % self.prefix)
+        else:
+            self.outfiles[slot].rename("%s-dom%d.log" % (self.prefix, domid))
+
+    def write(self, interval, cpu, slot, domid, h):
+        self.outfiles[slot].write(LOG_FORMAT % ((interval, cpu, domid) + log_values(h)) + "\n")
+        self.outfiles[slot].flush()
+
+    def end_interval(self):
+        pass
+
+    def close(self):
+        for dom in range(0, NDOMAINS):
+            self.outfiles[dom].close()
+
+# the binary log: a header, then fixed size records for all domains and
+# cpus in one file.  Each interval's records go out in a single write.
+LOG_MAGIC = "XENMONLG"
+LOG_VERSION = 1
+log_header_struct = struct.Struct("<8sII")     # magic, version, record size
+log_record_struct = struct.Struct("<dii13d")   # as LOG_COLUMNS
+
+class BinaryLog:
+    def __init__(self, filename, fsync_interval=0):
+        self.file = open(filename, "wb")
+        self.file.write(log_header_struct.pack(LOG_MAGIC, LOG_VERSION,
+                                               log_record_struct.size))
+        self.records = []
+        self.fsync_interval = fsync_interval    # seconds; 0 = never
+        self.last_sync = time.time()
+
+    def set_domain(self, slot, domid):
+        pass
+
+    def write(self, interval, cpu, slot, domid, h):
+        self.records.append(log_record_struct.pack(interval, cpu, domid, *log_values(h)))
+
+    def end_interval(self):
+        self.file.write(''.join(self.records))
+        self.file.flush()
+        self.records = []
+
+        now = time.time()
+        if self.fsync_interval and now - self.last_sync >= self.fsync_interval:
+            os.fsync(self.file.fileno())
+            self.last_sync = now
+
+    def close(self):
+        self.end_interval()
+        self.file.close()
+
+# convert a binary log to csv, for the tools which analyse the text logs
+def convert_log(filename, out):
+    f = open(filename, "rb")
+    header = f.read(log_header_struct.size)
+    if len(header) != log_header_struct.size:
+        raise ValueError("%s: too short for a xenmon log" % filename)
+    (magic, version, reclen) = log_header_struct.unpack(header)
+    if magic != LOG_MAGIC or version != LOG_VERSION or reclen != log_record_struct.size:
+        raise ValueError("%s: not a version %d xenmon log" % (filename, LOG_VERSION))
+
+    writer = csv.writer(out, lineterminator="\n")
+    writer.writerow(LOG_COLUMNS)
+    while True:
+        data = f.read(reclen * 1024)
+        for off in range(0, len(data) - reclen + 1, reclen):
+            rec = log_record_struct.unpack_from(data, off)
+            writer.writerow(["%.3f" % rec[0], rec[1], rec[2]] +
+                            ["%.3f" % v for v in rec[3:]])
+        if len(data) < reclen * 1024:
+            break
+    f.close()
+
 def writelog():
     global options
     global dom_in_use
+    global rolling
 
     ncpu = 1        # number of cpu's
     slen = 0        # size of shared structure inc. padding
 
-    shmf = open(SHM_FILE, "r+")
-    shm = mmap.mmap(shmf.fileno(), QOS_DATA_SIZE)
+    source = open_source()
 
     interval = 0
-    curr = last = time.time()
-    outfiles = {}
-    for dom in range(0, NDOMAINS):
-        outfiles[dom] = Delayed("%s-dom%d.log" % (options.prefix, dom), 'w')
-        outfiles[dom].delayed_write("# passed cpu dom cpu(tot) cpu(%) cpu/ex allocated/ex blocked(tot) blocked(%) blocked/io waited(tot) waited(%) waited/ex ex/s io(tot) io/ex\n")
-
-    while options.duration == 0 or interval < (options.duration * 1000):
-        cpuidx = 0
-        while cpuidx < ncpu:
-
-            idx = cpuidx * slen      # offset needed in mmap file
-
-            samples = []
-            doms = []
-            dom_in_use = []
-            domain_id = []
-
-            for i in range(0, NSAMPLES):
-                len = struct.calcsize(ST_QDATA)
-                sample = struct.unpack(ST_QDATA, shm[idx:idx+len])
-                samples.append(sample)
-                idx += len
-
-            for i in range(0, NDOMAINS):
-                len = struct.calcsize(ST_DOM_INFO)
-                dom = struct.unpack(ST_DOM_INFO, shm[idx:idx+len])
-#                doms.append(dom)
-#               (last_update_time, start_time, runnable_start_time, blocked_start_time,
-#                ns_since_boot, ns_oncpu_since_boot, runnable_at_last_update,
-#                runnable, in_use, domid, junk, name) = dom
-                dom_in_use.append(dom[8])
-                domid = dom[9]
-                if domid == 32767:
-                    domid = IDLE_DOMAIN
-                domain_id.append(domid)
-                if domid == IDLE_DOMAIN:
-                    outfiles[i].rename("%s-idle.log" % options.prefix)
+    curr = last = source.time()
+    if options.logformat == "binary":
+        log = BinaryLog("%s.xmlog" % options.prefix, options.fsync)
+    else:
+        log = TextLog(options.prefix)
+
+    # the rolling stats all go in one text file, written every interval
+    if options.rolling:
+        rolling = RollingStats()
+        rolling_log = open("%s-rolling.log" % options.prefix, "w")
+        rolling_log.write("# passed cpu dom" +
+                          "".join([" %s(%s)" % (col, name.replace(" ", ""))
+                                   for col in ("cpu(%)", "blocked(%)", "waited(%)", "ex/s", "io/s")
+                                   for name in ROLLING_NAMES]) + "\n")
+
+    # so do the diagnostics of every cpu
+    if options.diagnostics:
+        diag_log = open("%s-diag.log" % options.prefix, "w")
+        diag_log.write("# passed cpu " + " ".join(DIAG_COLUMNS) + "\n")
+
+    # so do the latency percentiles
+    if options.latency:
+        latency_log = open("%s-latency.log" % options.prefix, "w")
+        latency_log.write("# passed cpu dom" +
+                          "".join([" %s(%s)" % (col, name)
+                                   for col in ("waited/ex", "blocked/io")
+                                   for name in LATENCY_HEADER.split()]) + "\n")
+
+    # on interrupt, the records of the interval in progress are still kept
+    try:
+        while options.duration == 0 or interval < (options.duration * 1000):
+            region = source.refresh()
+            if region is None:
+                break
+            (shm, ncpu, slen) = region
+
+            for cpuidx in range(0, ncpu):
+
+                (samples, dom_in_use, domain_id, next) = \
+                    read_cpu_data(shm, cpuidx, slen)
+
+                for i in range(0, NDOMAINS):
+                    log.set_domain(i, domain_id[i])
+
+                if rolling:
+                    rolling.take_samples(cpuidx, samples, dom_in_use, domain_id, next,
+                                         source.time())
+
+                window = sample_window(next, samples)
+                [h1,l1, f1] = window.summarize(options.interval * 10**6)
+                for dom in range(0, NDOMAINS):
+                    if not dom_in_use[dom]:
+                        continue
+                    if h1[dom][0][1] > 0 or dom == IDLE_DOMAIN:
+                        log.write(interval, cpuidx, dom, domain_id[dom], h1[dom])
+
+                if options.diagnostics:
+                    d = cpu_diagnostics(window, options.interval * 10**6)
+                    diag_log.write("%.3f %d" % (interval, cpuidx) +
+                                   "".join([" %.3f" % v for v in d]) + "\n")
+
+                if alerts:
+                    alerts.check(cpuidx, domain_id, h1, l1, source.time())
+
+                if options.latency:
+                    hists = window.histograms(options.interval * 10**6)
+                    for dom in range(0, NDOMAINS):
+                        if hists[dom]:
+                            (waited, blocked) = hists[dom]
+                            latency_log.write("%.3f %d %d" % (interval, cpuidx, domain_id[dom]) +
+                                              "".join([" %.3f" % v for v in waited.summary() + blocked.summary()]) + "\n")
+                curr = source.time()
+                interval += (curr - last) * 1000
+                last = curr
+            log.end_interval()
+            if rolling:
+                for (cpuidx, domid) in rolling.domains():
+                    r = rolling.stats(cpuidx, domid)
+                    rolling_log.write("%.3f %d %d" % (interval, cpuidx, domid) +
+                                      "".join([" %.3f" % w[n] for n in range(0, 5) for w in r]) + "\n")
+                rolling_log.flush()
+            if options.latency:
+                latency_log.flush()
+            if options.diagnostics:
+                diag_log.flush()
+            source.sleep(options.interval / 1000.0)
+    finally:
+        log.close()
+        source.close()
+        if rolling:
+            rolling_log.close()
+        if options.latency:
+            latency_log.close()
+        if options.diagnostics:
+            diag_log.close()
+
+# the metrics exported over http, from the stats of each domain on each cpu:
+# (name, help, function picking the value out of the stats)
+METRICS = [
+    ("gotten_percent", "Percentage of the cpu the domain got",
+     lambda h: h[0][1]),
+    ("gotten_ns_per_exec", "Average ns the domain ran for per execution",
+     lambda h: h[0][2]),
+    ("allocated_ns_per_exec", "Average ns allocated to the domain per execution",
+     lambda h: h[1]),
+    ("blocked_percent", "Percentage of the time the domain was blocked",
+     lambda h: h[2][1]),
+    ("blocked_ns_per_io", "Average ns the domain was blocked for per I/O",
+     lambda h: h[2][2]),
+    ("waited_percent", "Percentage of the time the domain was runnable but waiting",
+     lambda h: h[3][1]),
+    ("waited_ns_per_exec", "Average ns the domain waited for per execution",
+     lambda h: h[3][2]),
+    ("executions_per_second", "Executions of the domain per second",
+     lambda h: h[4]),
+    ("io_per_second", "I/O count of the domain per second",
+     lambda h: h[5][0]),
+    ("io_per_exec", "Average I/O count of the domain per execution",
+     lambda h: h[5][1]),
+    ]
+
+# the text exposition of the latest metrics, served as is to every scrape
+metrics_snapshot = ""
+
+# format the metrics of all domains on all cpus, over the last duration ns
+def format_metrics(shm, ncpu, slen, duration):
+    global dom_in_use
+
+    values = dict([(name, []) for (name, help, value) in METRICS])
+    lost = []
+    for cpuidx in range(0, ncpu):
+        (samples, dom_in_use, domain_id, next) = \
+            read_cpu_data(shm, cpuidx, slen)
+        [h, l, f] = sample_window(next, samples).summarize(duration)
+
+        for dom in range(0, NDOMAINS):
+            if not dom_in_use[dom]:
+                continue
+            if domain_id[dom] == IDLE_DOMAIN:
+                labels = 'cpu="%d",domain="idle"' % cpuidx
+            else:
+                labels = 'cpu="%d",domain="%d"' % (cpuidx, domain_id[dom])
+            for (name, help, value) in METRICS:
+                values[name].append("xenmon_%s{%s} %f\n" % (name, labels, value(h[dom])))
+        lost.append('xenmon_lost_records{cpu="%d"} %d\n' % (cpuidx, l[1]))
+
+    out = []
+    for (name, help, value) in METRICS:
+        out.append("# HELP xenmon_%s %s.\n" % (name, help))
+        out.append("# TYPE xenmon_%s gauge\n" % name)
+        out.extend(values[name])
+    out.append("# HELP xenmon_lost_records Trace records lost by xenbaked.\n")
+    out.append("# TYPE xenmon_lost_records gauge\n")
+    out.extend(lost)
+    out.append("# HELP xenmon_cpus Number of cpus xenbaked reports on.\n")
+    out.append("# TYPE xenmon_cpus gauge\n")
+    out.append("xenmon_cpus %d\n" % ncpu)
+    return ''.join(out)
+
+class MetricsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+        body = metrics_snapshot
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    # no logging of every scrape to stderr
+    def log_message(self, format, *args):
+        pass
+
+# serve the metrics over http on [host:]port, refreshing them every interval
+def export_metrics(address):
+    global metrics_snapshot
+
+    ncpu = 1        # number of cpu's
+    slen = 0        # size of shared structure inc. padding
+
+    source = open_source()
+
+    (host, sep, port) = address.rpartition(":")
+    server = None
+
+    try:
+        while True:
+            region = source.refresh()
+            if region is None:
+                break
+            (shm, ncpu, slen) = region
+
+            metrics_snapshot = format_metrics(shm, ncpu, slen, options.interval * 10**6)
+
+            # start serving once there is something to serve
+            if server is None:
+                server = BaseHTTPServer.HTTPServer((host or "127.0.0.1", int(port)), MetricsHandler)
+                thread = threading.Thread(target=server.serve_forever)
+                thread.daemon = True
+                thread.start()
+
+            source.sleep(options.interval / 1000.0)
+    finally:
+        if server:
+            server.shutdown()
+        source.close()
+
+# stats forwarded by a host to a collector: every --interval, the stats of
+# each domain over the last second, totalled across the host's cpus, are
+# sent as a line of json.  Only the domains whose stats changed since the
+# previous message are sent, along with those that went away; a full
+# snapshot is sent every FLEET_KEYFRAME messages, and whenever a new
+# connection is made, for collectors to start from.
+FLEET_VERSION = 1
+FLEET_KEYFRAME = 60
+
+class FleetEncoder:
+    def __init__(self, host):
+        self.host = host
+        self.seq = 0
+        self.last = {}
+        self.keyframe = True
+
+    # the message for the stats of each domain (h, by domain id) at now
+    def encode(self, h, now):
+        values = {}
+        for domid in h:
+            values[domid] = [round(col[2](h[domid]), 2) for col in TOP_COLUMNS]
+
+        msg = {"v": FLEET_VERSION, "host": self.host, "seq": self.seq,
+               "time": round(now, 3)}
+        if self.keyframe or self.seq % FLEET_KEYFRAME == 0:
+            msg["full"] = 1
+            changed = values
+            self.keyframe = False
+        else:
+            changed = {}
+            for domid in values:
+                if self.last.get(domid) != values[domid]:
+                    changed[domid] = values[domid]
+            gone = [domid for domid in self.last if domid not in values]
+            if gone:
+                msg["gone"] = gone
+        msg["doms"] = dict([(str(domid), changed[domid]) for domid in changed])
+
+        self.last = values
+        self.seq += 1
+        return json.dumps(msg, separators=(",", ":")) + "\n"
+
+# a forwarding destination or collecting source: "unix:PATH" is the socket
+# PATH, anything else a file
+def fleet_address(spec):
+    if spec.startswith("unix:"):
+        return ("unix", spec[len("unix:"):])
+    return ("file", spec)
+
+# the longest wait, in seconds, between attempts to reach a collector
+FLEET_RETRY_MAX = 30.0
+
+# send this host's stats to dest every interval, for a collector.  Stats
+# are appended to a file destination; a socket destination is connected to
+# whenever the collector is listening, backing off between attempts while
+# it is not, and the stats of meanwhile are dropped.
+def forward_stats(dest):
+    (kind, path) = fleet_address(dest)
+    source = open_source()
+    encoder = FleetEncoder(options.host)
+    out = None
+    sock = None
+    retry_at = 0
+    backoff = options.interval / 1000.0
+
+    if kind == "file":
+        out = open(path, "a")
+    start = source.time()
+    try:
+        while options.duration == 0 or source.time() - start < options.duration:
+            region = source.refresh()
+            if region is None:
+                break
+            (shm, ncpu, slen) = region
+            (h1, h2, lost, usage) = host_totals(shm, ncpu, slen)
+
+            # (re)connect to the collector, if it is time to try again
+            if kind == "unix" and sock is None and source.time() >= retry_at:
+                try:
+                    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                    sock.connect(path)
+                    encoder.keyframe = True
+                    backoff = options.interval / 1000.0
+                except socket.error:
+                    sock.close()
+                    sock = None
+                    retry_at = source.time() + backoff
+                    backoff = min(backoff * 2, FLEET_RETRY_MAX)
+
+            msg = encoder.encode(h1, source.time())
+            if sock:
+                try:
+                    sock.sendall(msg)
+                except socket.error:
+                    sock.close()
+                    sock = None
+            elif out:
+                out.write(msg)
+                out.flush()
+            source.sleep(options.interval / 1000.0)
+    finally:
+        if sock:
+            sock.close()
+        if out:
+            out.close()
+        source.close()
+
+# the stats of one host, as forwarded to the collector
+class FleetHost:
+    def __init__(self, name):
+        self.name = name
+        self.doms = {}          # domid -> values of TOP_COLUMNS
+        self.seq = None
+        self.synced = False     # whether doms are up to date
+        self.time = 0           # time of the latest message, on the host
+        self.gaps = 0           # messages missed
+
+    # apply a message from the host
+    def apply(self, msg):
+        seq = msg["seq"]
+        if msg.get("full"):
+            self.doms = {}
+            self.synced = True
+        elif not self.synced or seq != self.seq + 1:
+            # changes can't be applied to stats missing some, so wait for
+            # the next full snapshot
+            if self.synced:
+                self.gaps += 1
+            self.synced = False
+            self.seq = seq
+            return
+        for domid in msg.get("gone", []):
+            self.doms.pop(domid, None)
+        for domid in msg["doms"]:
+            self.doms[int(domid)] = msg["doms"][domid]
+        self.seq = seq
+        self.time = msg["time"]
+
+    # how far behind the stats of the host are, at now
+    def lag(self, now):
+        return now - self.time
+
+# receives the stats of many hosts, from files and from forwarders
+# connecting to its sockets, as given by fleet_address
+class FleetCollector:
+    def __init__(self, sources):
+        self.hosts = {}         # name -> FleetHost
+        self.listeners = []
+        self.conns = {}         # socket -> data not yet parsed
+        self.files = []         # [file, data not yet parsed]
+        for spec in sources:
+            (kind, path) = fleet_address(spec)
+            if kind == "file":
+                self.files.append([open(path), ""])
+                continue
+            if os.path.exists(path) and stat.S_ISSOCK(os.stat(path).st_mode):
+                os.unlink(path)
+            listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            listener.bind(path)
+            listener.listen(64)
+            self.listeners.append((listener, path))
+
+    # handle the complete lines of data, returning what is left over
+    def parse(self, data):
+        lines = data.split("\n")
+        for line in lines[:-1]:
+            try:
+                msg = json.loads(line)
+                if msg["v"] != FLEET_VERSION:
+                    continue
+                host = self.hosts.setdefault(msg["host"], FleetHost(msg["host"]))
+                host.apply(msg)
+            except (ValueError, KeyError, TypeError):
+                # not a message of ours
+                pass
+        return lines[-1]
+
+    # take in whatever arrives over the next timeout seconds
+    def poll(self, timeout):
+        for f in self.files:
+            f[1] = self.parse(f[1] + f[0].read())
+
+        end = time.time() + timeout
+        while True:
+            left = end - time.time()
+            if left <= 0:
+                break
+            socks = [l for (l, path) in self.listeners] + self.conns.keys()
+            if not socks:
+                time.sleep(left)
+                break
+            (ready, w, x) = select.select(socks, [], [], left)
+            for sock in ready:
+                if sock in self.conns:
+                    try:
+                        data = sock.recv(65536)
+                    except socket.error:
+                        data = ""
+                    if data:
+                        self.conns[sock] = self.parse(self.conns[sock] + data)
+                    else:
+                        sock.close()
+                        del self.conns[sock]
                 else:
-                    outfiles[i].rename("%s-dom%d.log" % (options.prefix, domid))
-                idx += len
+                    (conn, addr) = sock.accept()
+                    self.conns[conn] = ""
 
-            len = struct.calcsize("4i")
-            oldncpu = ncpu
-            (next, ncpu, slen, freq) = struct.unpack("4i", shm[idx:idx+len])
-            idx += len
+    def close(self):
+        for sock in self.conns:
+            sock.close()
+        for (listener, path) in self.listeners:
+            listener.close()
+            os.unlink(path)
+        for f in self.files:
+            f[0].close()
+
+# the total of column n over the domains of a host but idle
+def fleet_total(host, n):
+    total = 0.0
+    for domid in host.doms:
+        if domid != IDLE_DOMAIN:
+            total += host.doms[domid][n]
+    return total
+
+# the fleet view: one row per host, with its busy cpu time, its busiest
+# domain, how much its domains waited and did io, and how far behind its
+# stats are
+def display_fleet(scr, collector, maxx, heartbeat):
+    now = time.time()
+    hosts = [collector.hosts[name] for name in sorted(collector.hosts)]
+
+    row = 0
+    display(scr, row, 1, "Fleet", _c.A_STANDOUT)
+    display(scr, row, 10, "%s%d hosts, %d domains, last second" %
+            (6*' ', len(hosts), sum([len(h.doms) for h in hosts])), _c.A_BOLD)
+    row += 1
+    display(scr, row, 1, "%s" % ((maxx-2)*'='))
+    row += 1
+    display(scr, row, 2, "%-20s %5s %10s %10s %10s %12s %8s %6s" %
+            ("Host", "Doms", "Gotten%", "Waited%", "IO/s", "Busiest", "Lag", "Gaps"), _c.A_BOLD)
+
+    for host in hosts:
+        row += 1
+        busiest = [d for d in host.doms if d != IDLE_DOMAIN]
+        if busiest:
+            busiest = "dom %d" % max(busiest, key=lambda d: host.doms[d][0])
+        else:
+            busiest = "-"
+        if host.synced:
+            lag = "%.1fs" % host.lag(now)
+        else:
+            lag = "resync"
+        display(scr, row, 2, "%-20s %5d %9.2f%% %9.2f%% %10.1f %12s %8s %6d" %
+                (host.name[:20], len(host.doms), fleet_total(host, 0),
+                 fleet_total(host, 1), fleet_total(host, 4), busiest, lag,
+                 host.gaps))
+
+    row += 1
+    display(scr, row, 1, heartbeat * '*')
+
+# show the stats forwarded by many hosts, or log them with -n
+def collect_stats(paths):
+    collector = FleetCollector(paths)
+    try:
+        if options.live:
+            show_fleet(collector)
+        else:
+            log_fleet(collector)
+    finally:
+        collector.close()
 
-            if oldncpu != ncpu:
-                shm = mmap.mmap(shmf.fileno(), ncpu*slen)
+def show_fleet(collector):
+    stdscr = _c.initscr()
+    _c.noecho()
+    _c.cbreak()
+    stdscr.keypad(1)
+    stdscr.timeout(0)
+    [maxy, maxx] = stdscr.getmaxyx()
+    frame = Frame(stdscr)
+    heartbeat = 1
 
-            startat = next - 1
-            if next + 10 < NSAMPLES:
-                endat = next + 10
-            else:
-                endat = 10
+    try:
+        while True:
+            collector.poll(options.interval / 1000.0)
+            display_fleet(frame, collector, maxx, heartbeat)
+            heartbeat = 1 - heartbeat
+            frame.flush()
+            if stdscr.getch() == ord('q'):
+                break
+    finally:
+        _c.nocbreak()
+        stdscr.keypad(0)
+        _c.echo()
+        _c.endwin()
 
-            [h1,l1, f1] = summarize(startat, endat, options.interval * 10**6, samples)
-            for dom in range(0, NDOMAINS):
-                if not dom_in_use[dom]:
+# the rolled up log: every interval, a line per domain of every host
+def log_fleet(collector):
+    log = open("%s-fleet.log" % options.prefix, "w")
+    log.write("# passed host dom" +
+              "".join([" %s" % col[1].lower() for col in TOP_COLUMNS]) + " lag\n")
+    start = time.time()
+    try:
+        while options.duration == 0 or time.time() - start < options.duration:
+            collector.poll(options.interval / 1000.0)
+            now = time.time()
+            for name in sorted(collector.hosts):
+                host = collector.hosts[name]
+                if not host.synced:
                     continue
-                if h1[dom][0][1] > 0 or dom == IDLE_DOMAIN:
-                    outfiles[dom].write("%.3f %d %d %.3f %.3f %.3f %.3f %.3f %.3f %.3f %.3f %.3f %.3f %.3f %.3f %.3f\n" %
-                                     (interval, cpuidx, domain_id[dom],
-                                     h1[dom][0][0], h1[dom][0][1], h1[dom][0][2],
-                                     h1[dom][1],
-                                     h1[dom][2][0], h1[dom][2][1], h1[dom][2][2],
-                                     h1[dom][3][0], h1[dom][3][1], h1[dom][3][2],
-                                     h1[dom][4], 
-                                     h1[dom][5][0], h1[dom][5][1]))
-                    outfiles[dom].flush()
-            curr = time.time()
-            interval += (curr - last) * 1000
-            last = curr
-            cpuidx = cpuidx + 1
-        time.sleep(options.interval / 1000.0)
+                for domid in sorted(host.doms):
+                    log.write("%.3f %s %d" % ((now - start) * 1000, name, domid) +
+                              "".join([" %.3f" % v for v in host.doms[domid]]) +
+                              " %.3f\n" % host.lag(now))
+            log.flush()
+    finally:
+        log.close()
+
+# alert rules, of the form "[dom D] [cpu C]: METRIC OP VALUE [for SECS]".
+# Domain metrics are the stats of each domain on each cpu; without "dom"
+# the rule holds for every domain but idle.  CPU metrics are figures of
+# the cpu as a whole.
+ALERT_DOMAIN_METRICS = {
+    "cpu%":         lambda h: h[0][1],
+    "cpu/ex":       lambda h: h[0][2],
+    "allocated/ex": lambda h: h[1],
+    "blocked%":     lambda h: h[2][1],
+    "blocked/io":   lambda h: h[2][2],
+    "waited%":      lambda h: h[3][1],
+    "waited/ex":    lambda h: h[3][2],
+    "ex/s":         lambda h: h[4],
+    "io/s":         lambda h: h[5][0],
+    "io/ex":        lambda h: h[5][1],
+    }
+ALERT_CPU_METRICS = ["busy%", "lost"]
+
+ALERT_OPS = {
+    ">":  lambda a, b: a > b,
+    ">=": lambda a, b: a >= b,
+    "<":  lambda a, b: a < b,
+    "<=": lambda a, b: a <= b,
+    "==": lambda a, b: a == b,
+    "!=": lambda a, b: a != b,
+    }
+
+alert_re = re.compile(r"^\s*(\S+)\s*(>=|<=|==|!=|>|<)\s*(\S+)" +
+                      r"(?:\s+for\s+(\S+?)\s*s?)?\s*$")
+
+class AlertRule:
+    def __init__(self, text):
+        self.text = text.strip()
+        self.domid = None
+        self.cpu = None
+
+        (scope, sep, cond) = text.rpartition(":")
+        words = scope.split()
+        if len(words) % 2:
+            raise ValueError("invalid alert rule '%s'" % text)
+        for (kind, val) in zip(words[::2], words[1::2]):
+            try:
+                if kind == "dom":
+                    if val == "idle":
+                        self.domid = IDLE_DOMAIN
+                    else:
+                        self.domid = int(val)
+                elif kind == "cpu":
+                    self.cpu = int(val)
+                else:
+                    raise ValueError
+            except ValueError:
+                raise ValueError("invalid scope '%s %s' in alert rule '%s'" %
+                                 (kind, val, text))
+
+        m = alert_re.match(cond)
+        if m is None:
+            raise ValueError("invalid alert rule '%s'" % text)
+        (self.metric, op, value, hold) = m.groups()
+        if self.metric in ALERT_DOMAIN_METRICS:
+            self.value_of = ALERT_DOMAIN_METRICS[self.metric]
+        elif self.metric in ALERT_CPU_METRICS:
+            if self.domid is not None:
+                raise ValueError("'%s' is not a domain metric, in alert rule '%s'" %
+                                 (self.metric, text))
+        else:
+            raise ValueError("unknown metric '%s' in alert rule '%s'" %
+                             (self.metric, text))
+        self.op = ALERT_OPS[op]
+        try:
+            self.threshold = float(value)
+            self.hold = float(hold or 0)
+        except ValueError:
+            raise ValueError("invalid number in alert rule '%s'" % text)
+
+    def holds(self, value):
+        return self.op(value, self.threshold)
+
+# the rules of --alert and --alert-file
+def load_alert_rules(rules, filename):
+    rules = list(rules)
+    if filename:
+        for line in open(filename):
+            line = line.split("#", 1)[0].strip()
+            if line:
+                rules.append(line)
+    return [AlertRule(rule) for rule in rules]
+
+# evaluates the alert rules on every summary.  To keep an alert from being
+# raised over and over, a rule has to hold for its whole "for" time before
+# its alert is raised, and then no longer hold for as long before the
+# alert is cleared; each is reported once.
+class AlertEngine:
+    def __init__(self, rules, hook=None):
+        self.rules = rules
+        self.hook = hook
+        self.hooks = []
+        # (rule index, cpu, domid) -> [raised, time it began to change]
+        self.state = {}
+
+    # the stats (as of summarize) of the domains of a cpu, at time now
+    def check(self, cpu, domain_id, ldoms, lostinfo, now):
+        busy = 0.0
+        for dom in range(0, NDOMAINS):
+            if dom_in_use[dom] and domain_id[dom] != IDLE_DOMAIN:
+                busy += ldoms[dom][0][1]
 
-    for dom in range(0, NDOMAINS):
-        outfiles[dom].close()
+        for (n, rule) in enumerate(self.rules):
+            if rule.cpu is not None and rule.cpu != cpu:
+                continue
+            if rule.metric == "busy%":
+                self.update(n, rule, cpu, None, busy, now)
+            elif rule.metric == "lost":
+                self.update(n, rule, cpu, None, lostinfo[1], now)
+            else:
+                for dom in range(0, NDOMAINS):
+                    if not dom_in_use[dom]:
+                        continue
+                    domid = domain_id[dom]
+                    if rule.domid is None and domid == IDLE_DOMAIN or \
+                       rule.domid is not None and rule.domid != domid:
+                        continue
+                    self.update(n, rule, cpu, domid, rule.value_of(ldoms[dom]), now)
+
+    def update(self, n, rule, cpu, domid, value, now):
+        state = self.state.setdefault((n, cpu, domid), [False, None])
+        if rule.holds(value) == state[0]:
+            state[1] = None
+            return
+        if state[1] is None:
+            state[1] = now
+        if now - state[1] >= rule.hold:
+            state[0] = not state[0]
+            state[1] = None
+            self.notify(rule, cpu, domid, value, state[0])
+
+    def notify(self, rule, cpu, domid, value, raised):
+        if domid is None:
+            where = "cpu %d" % cpu
+        elif domid == IDLE_DOMAIN:
+            where = "cpu %d idle" % cpu
+        else:
+            where = "cpu %d dom %d" % (cpu, domid)
+        state = raised and "raised" or "cleared"
+        msg = "alert %s on %s: %s (now %.3f)" % (state, where, rule.text, value)
+
+        if not self.hook:
+            syslog.syslog(raised and syslog.LOG_WARNING or syslog.LOG_NOTICE, msg)
+            return
+
+        # reap the hooks that are done, without waiting for the others
+        self.hooks = [p for p in self.hooks if p.poll() is None]
+        env = dict(os.environ)
+        env.update({"XENMON_ALERT": state,
+                    "XENMON_RULE": rule.text,
+                    "XENMON_CPU": str(cpu),
+                    "XENMON_DOMAIN": "",
+                    "XENMON_VALUE": "%.3f" % value,
+                    "XENMON_MESSAGE": msg})
+        if domid is not None:
+            env["XENMON_DOMAIN"] = str(domid)
+        self.hooks.append(subprocess.Popen(self.hook, shell=True, env=env))
 
 # start xenbaked
 def start_xenbaked():
@@ -668,7 +2328,8 @@ def stop_xenbaked():
 def main():
     global options
     global args
-    global domains
+    global SHM_FILE
+    global alerts
     global stop_cmd
     global kill_cmd
     global xenbaked_cmd
@@ -691,21 +2352,90 @@ def main():
     if options.mspersample < 0:
         parser.error("option --ms_per_sample: invalid negative value: '%d'" %
                      options.mspersample)
+    for (opt, val) in (("--ndomains", options.ndomains), ("--nsamples", options.nsamples)):
+        if val is not None and val <= 0:
+            parser.error("option %s: invalid non-positive value: '%d'" % (opt, val))
+    if options.export and not options.export.rpartition(":")[2].isdigit():
+        parser.error("option --export: invalid port: '%s'" % options.export)
+    if options.fsync < 0:
+        parser.error("option --fsync: invalid negative value: '%d'" %
+                     options.fsync)
+    if options.top is not None and options.top < 0:
+        parser.error("option --top: invalid negative value: '%d'" %
+                     options.top)
+    if options.speed < 0:
+        parser.error("option --speed: invalid negative value: '%g'" %
+                     options.speed)
+    try:
+        rules = load_alert_rules(options.alerts, options.alert_file)
+    except (IOError, ValueError), e:
+        parser.error("option --alert: %s" % e)
+    if rules:
+        if options.live or options.export or options.record or \
+           options.forward or options.collect:
+            parser.error("alerts are only raised in log mode (--notlive)")
+        alerts = AlertEngine(rules, options.alert_hook)
+    if options.benchmark and not options.replay:
+        parser.error("option --benchmark requires --replay")
+    if options.record and options.replay:
+        parser.error("options --record and --replay are mutually exclusive")
+    for spec in [options.forward or ""] + options.collect:
+        if spec == "unix:":
+            parser.error("socket path missing in '%s'" % spec)
     # If --ms_per_sample= is too large, no data may be logged.
     if not options.live and options.duration != 0 and \
        options.mspersample > options.duration * 1000:
         parser.error("option --ms_per_sample: too large (> %d ms)" %
                      (options.duration * 1000))
     
-    start_xenbaked()
-    if options.live:
+    if options.convert:
+        try:
+            convert_log(options.convert, sys.stdout)
+        except (IOError, ValueError), e:
+            print >> sys.stderr, e
+            sys.exit(1)
+        return
+    if options.benchmark:
+        benchmark(options.replay)
+        return
+    if options.collect:
+        try:
+            collect_stats(options.collect)
+        except KeyboardInterrupt:
+            pass
+        except (IOError, socket.error), e:
+            print >> sys.stderr, e
+            sys.exit(1)
+        return
+
+    if options.shm_file:
+        SHM_FILE = options.shm_file
+    elif not options.replay:
+        start_xenbaked()
+    if options.record:
+        try:
+            record_snapshots(options.record)
+        except KeyboardInterrupt:
+            pass
+    elif options.forward:
+        try:
+            forward_stats(options.forward)
+        except KeyboardInterrupt:
+            pass
+    elif options.export:
+        try:
+            export_metrics(options.export)
+        except KeyboardInterrupt:
+            pass
+    elif options.live:
         show_livestats(options.cpu)
     else:
         try:
             writelog()
         except:
             print 'Quitting.'
-    stop_xenbaked()
+    if not options.shm_file and not options.replay:
+        stop_xenbaked()
 
 if __name__ == "__main__":
     main()